@@ -43,8 +43,8 @@ def init_feature_extractor(backbone='vgg16', device=torch.device('cuda')):
     return feat_extractor
 
 
-def bbox_sampling(bbox_result, nbox=19, imsize=None, topN=5):
-    """
+def bbox_sampling(bbox_result, nbox=19, imsize=None):
+    """ Keep at most nbox boxes, frames with fewer boxes are not padded with duplicates (the missing objects are masked).
     imsize[0]: height
     imsize[1]: width
     """
@@ -66,18 +66,7 @@ def bbox_sampling(bbox_result, nbox=19, imsize=None, topN=5):
     if len(new_boxes) == 0:  # no bboxes
         new_boxes.append([0, 0, imsize[1]-1, imsize[0]-1, 1.0, 0])
     new_boxes = np.array(new_boxes, dtype=int)
-    # sampling
-    n_candidate = min(topN, len(new_boxes))
-    if len(new_boxes) <= nbox - n_candidate:
-        indices = np.random.choice(n_candidate, nbox - len(new_boxes), replace=True)
-        sampled_boxes = np.vstack((new_boxes, new_boxes[indices]))
-    elif len(new_boxes) > nbox - n_candidate and len(new_boxes) <= nbox:
-        indices = np.random.choice(n_candidate, nbox - len(new_boxes), replace=False)
-        sampled_boxes = np.vstack((new_boxes, new_boxes[indices]))
-    else:
-        sampled_boxes = new_boxes[:nbox]
-    
-    return sampled_boxes
+    return new_boxes[:nbox]
 
 
 def bbox_to_imroi(transform, bboxes, image):
@@ -90,6 +79,20 @@ def bbox_to_imroi(transform, bboxes, image):
     return imroi_data
 
 def extract_features(detector, feat_extractor, video_file, n_frames=100, n_boxes=19):
+    features = np.zeros((n_frames, n_boxes + 1, feat_extractor.dim_feat), dtype=np.float32)
+    detections = np.zeros((n_frames, n_boxes, 6))  # (50 x 19 x 6)
+    num_boxes = np.zeros((n_frames,), dtype=np.int32)  # the number of real boxes of each frame
+    for idx, (bboxes, feature) in enumerate(iter_frame_features(detector, feat_extractor, video_file, n_frames=n_frames, n_boxes=n_boxes)):
+        num_boxes[idx] = len(bboxes)
+        detections[idx, :len(bboxes), :] = bboxes
+        features[idx, :len(bboxes)+1, :] = feature
+    return detections, features, num_boxes
+
+
+def iter_frame_features(detector, feat_extractor, video_file, n_frames=100, n_boxes=19):
+    """ Detect and featurize the frames one at a time, and yield the boxes (at most n_boxes x 6) of each frame
+    with its features ((1 + boxes) x D, the frame feature first).
+    """
     assert os.path.join(video_file), video_file
     # prepare video reader and data transformer
     videoReader = mmcv.VideoReader(video_file)
@@ -98,8 +101,6 @@ def extract_features(detector, feat_extractor, video_file, n_frames=100, n_boxes
         transforms.CenterCrop(224),
         transforms.ToTensor()]
     )
-    features = np.zeros((n_frames, n_boxes + 1, feat_extractor.dim_feat), dtype=np.float32)
-    detections = np.zeros((n_frames, n_boxes, 6))  # (50 x 19 x 6)
     frame_prev = None
     for idx in range(n_frames):
         if idx >= len(videoReader):
@@ -109,9 +110,8 @@ def extract_features(detector, feat_extractor, video_file, n_frames=100, n_boxes
             frame = videoReader.get_frame(idx)
         # run object detection inference
         bbox_result = inference_detector(detector, frame)
-        # sampling a fixed number of bboxes
+        # at most n_boxes bboxes
         bboxes = bbox_sampling(bbox_result, nbox=n_boxes, imsize=frame.shape[:2])
-        detections[idx, :, :] = bboxes
         # prepare frame data
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         with torch.no_grad():
@@ -124,100 +124,53 @@ def extract_features(detector, feat_extractor, video_file, n_frames=100, n_boxes
             ims_frame = torch.unsqueeze(ims_frame, dim=0).float().to(device=device)
             feature_frame = feat_extractor(ims_frame)
         # obtain feature matrix
-        features[idx, 0, :] = np.squeeze(feature_frame.cpu().numpy()) if feature_frame.is_cuda else np.squeeze(feature_frame.detach().numpy())
-        features[idx, 1:, :] = np.squeeze(feature_roi.cpu().numpy()) if feature_roi.is_cuda else np.squeeze(feature_roi.detach().numpy())
+        feature_frame = feature_frame.cpu().numpy() if feature_frame.is_cuda else feature_frame.detach().numpy()
+        feature_roi = feature_roi.cpu().numpy() if feature_roi.is_cuda else feature_roi.detach().numpy()
         frame_prev = frame
-    return detections, features
+        yield bboxes, np.concatenate([feature_frame.reshape(1, -1), feature_roi.reshape(len(bboxes), -1)], axis=0)
 
 
-def init_accident_model(model_file, dim_feature=4096, hidden_dim=256, latent_dim=256, n_obj=19, n_frames=50, fps=10.0):
+def init_accident_model(model_file, dim_feature=4096, hidden_dim=256, latent_dim=256, n_obj=19, n_frames=50, fps=10.0,
+                        n_layers=1, graph_knn=None, device=torch.device('cuda')):
+    from src.Models import UString
     # building model
     model = UString(dim_feature, hidden_dim, latent_dim, 
-        n_layers=1, n_obj=n_obj, n_frames=n_frames, fps=fps, with_saa=True, uncertain_ranking=True)
+        n_layers=n_layers, n_obj=n_obj, n_frames=n_frames, fps=fps, with_saa=True, uncertain_ranking=True, graph_knn=graph_knn)
     model = model.to(device=device)
     model.eval()
-    # load check point
-    model, _, _ = load_checkpoint(model, filename=model_file, isTraining=False)
+    # load check point, the model is initialized randomly without model_file
+    if model_file is not None:
+        model, _, _ = load_checkpoint(model, filename=model_file, isTraining=False, map_location=device)
     return model
 
 
-def load_input_data(feature_file, device=torch.device('cuda')):
+def load_input_data(feature_file, n_obj=19, device=torch.device('cuda')):
+    from src.DataLoader import build_st_graph
+    from src.quantize import dequantize
+    from src.rois import load_rois, load_detections
     # load feature file and return the transformed data
     data = np.load(feature_file)
-    features = data['data']  # 50 x 20 x 4096
-    labels = [0, 1]
-    detections = data['det']  # 50 x 19 x 6
-    toa = [45]  # [useless]
-
-    def generate_st_graph(detections):
-        # create graph edges
-        num_frames, num_boxes = detections.shape[:2]
-        num_edges = int(num_boxes * (num_boxes - 1) / 2)
-        graph_edges = []
-        edge_weights = np.zeros((num_frames, num_edges), dtype=np.float32)
-        for i in range(num_frames):
-            # generate graph edges (fully-connected)
-            edge = generate_graph_from_list(range(num_boxes))
-            graph_edges.append(np.transpose(np.stack(edge).astype(np.int32)))  # 2 x 171
-            # compute the edge weights by distance
-            edge_weights[i] = compute_graph_edge_weights(detections[i, :, :4], edge)  # 171,
-        return graph_edges, edge_weights
-
-    def generate_graph_from_list(L, create_using=None):
-        import networkx, itertools
-        G = networkx.empty_graph(len(L),create_using)
-        if len(L)>1:
-            if G.is_directed():
-                    edges = itertools.permutations(L,2)
-            else:
-                    edges = itertools.combinations(L,2)
-            G.add_edges_from(edges)
-        graph_edges = list(G.edges())
-
-        return graph_edges
-
-    def compute_graph_edge_weights(boxes, edges):
-        """
-        :param: boxes: (19, 4)
-        :param: edges: (171, 2)
-        :return: weights: (171,)
-        """
-        N = boxes.shape[0]
-        assert len(edges) == N * (N-1) / 2
-        weights = np.ones((len(edges),), dtype=np.float32)
-        for i, edge in enumerate(edges):
-            c1 = [0.5 * (boxes[edge[0], 0] + boxes[edge[0], 2]),
-                0.5 * (boxes[edge[0], 1] + boxes[edge[0], 3])]
-            c2 = [0.5 * (boxes[edge[1], 0] + boxes[edge[1], 2]),
-                0.5 * (boxes[edge[1], 1] + boxes[edge[1], 3])]
-            d = (c1[0] - c2[0])**2 + (c1[1] - c2[1])**2
-            weights[i] = np.exp(-d)
-        # normalize weights
-        if np.sum(weights) > 0:
-            weights = weights / np.sum(weights)  # N*(N-1)/2,
-        else:
-            weights = np.ones((len(edges),), dtype=np.float32)
-
-        return weights
+    features, node_mask = load_rois(data, 'data', n_obj)
+    features = dequantize(features)  # 50 x 20 x 4096
+    detections = load_detections(data, n_obj)  # 50 x 19 x 6
 
-    graph_edges, edge_weights = generate_st_graph(detections)
+    graph_edges, edge_weights = build_st_graph(detections, node_mask=node_mask)
     # transform to torch.Tensor
     features = torch.Tensor(np.expand_dims(features, axis=0)).to(device)         #  50 x 20 x 4096
-    labels = torch.Tensor(np.expand_dims(labels, axis=0)).to(device)
-    graph_edges = torch.Tensor(np.expand_dims(graph_edges, axis=0)).long().to(device)
+    graph_edges = torch.from_numpy(np.expand_dims(graph_edges, axis=0)).to(device)  # 1 x 2 x 171
     edge_weights = torch.Tensor(np.expand_dims(edge_weights, axis=0)).to(device)
-    toa = torch.Tensor(np.expand_dims(toa, axis=0)).to(device)
+    node_mask = torch.from_numpy(np.expand_dims(node_mask, axis=0)).to(device)  # 1 x 50 x 19
     detections = np.expand_dims(detections, axis=0)
     vid = feature_file.split('/')[-1].split('.')[0]
 
-    return features, labels, graph_edges, edge_weights, toa, detections, vid
+    return features, graph_edges, edge_weights, node_mask, detections, vid
 
 
-def load_checkpoint(model, optimizer=None, filename='checkpoint.pth.tar', isTraining=True):
+def load_checkpoint(model, optimizer=None, filename='checkpoint.pth.tar', isTraining=True, map_location=None):
     # Note: Input model & optimizer should be pre-defined.  This routine only updates their states.
     start_epoch = 0
     if os.path.isfile(filename):
-        checkpoint = torch.load(filename)
+        checkpoint = torch.load(filename, map_location=map_location)
         start_epoch = checkpoint['epoch']
         model.load_state_dict(checkpoint['model'])
         if isTraining:
@@ -229,27 +182,6 @@ def load_checkpoint(model, optimizer=None, filename='checkpoint.pth.tar', isTrai
     return model, optimizer, start_epoch
 
 
-def parse_results(all_outputs, batch_size=1, n_frames=50):
-    # parse inference results
-    pred_score = np.zeros((batch_size, n_frames), dtype=np.float32)
-    pred_au = np.zeros((batch_size, n_frames), dtype=np.float32)
-    pred_eu = np.zeros((batch_size, n_frames), dtype=np.float32)
-    # run inference
-    for t in range(n_frames):
-        # prediction
-        pred = all_outputs[t]['pred_mean']  # B x 2
-        pred = pred.cpu().numpy() if pred.is_cuda else pred.detach().numpy()
-        pred_score[:, t] = np.exp(pred[:, 1]) / np.sum(np.exp(pred), axis=1)
-        # uncertainties
-        aleatoric = all_outputs[t]['aleatoric']  # B x 2 x 2
-        aleatoric = aleatoric.cpu().numpy() if aleatoric.is_cuda else aleatoric.detach().numpy()
-        epistemic = all_outputs[t]['epistemic']  # B x 2 x 2
-        epistemic = epistemic.cpu().numpy() if epistemic.is_cuda else epistemic.detach().numpy()
-        pred_au[:, t] = aleatoric[:, 0, 0] + aleatoric[:, 1, 1]
-        pred_eu[:, t] = epistemic[:, 0, 0] + epistemic[:, 1, 1]
-    return pred_score, pred_au, pred_eu
-
-
 def get_video_frames(video_file, n_frames=50):
     # get the video data
     cap = cv2.VideoCapture(video_file)
@@ -305,23 +237,26 @@ def draw_curve(xvals, pred_score, std_alea, std_epis):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--task', type=str, default='visualize', choices=['extract_feature', 'inference', 'visualize'])
+    parser.add_argument('--task', type=str, default='visualize', choices=['extract_feature', 'inference', 'stream', 'visualize'])
     parser.add_argument('--gpu_id', help='GPU ID', type=int, default=0)
     parser.add_argument('--n_frames', type=int, help='The number of input video frames.', default=50)
     parser.add_argument('--fps', type=float, help='The fps of input video.', default=10.0)
     # feature extraction
     parser.add_argument('--video_file', type=str, default='demo/000821.mp4')
     parser.add_argument('--mmdetection', type=str, help="the path to the mmdetection.", default="lib/mmdetection")
+    parser.add_argument('--feature_dtype', type=str, help="the dtype of the saved features.", default='float32', choices=['float32', 'float16', 'int8'])
     # inference
     parser.add_argument('--feature_file', type=str, help="the path to the feature file.", default="demo/000821_feature.npz")
     parser.add_argument('--ckpt_file', type=str, help="the path to the model file.", default="demo/final_model_ccd.pth")
+    parser.add_argument('--npass', type=int, help="the (maximum) number of MC passes.", default=10)
+    parser.add_argument('--mc_tol', type=float, help="the tolerance of the adaptive MC passes, None for the fixed passes.", default=None)
     # visualize
     parser.add_argument('--result_file', type=str, help="the path to the result file.", default="demo/000821_result.npz")
     parser.add_argument('--vis_file', type=str, help="the path to the visualization file.", default="demo/000821_vis.avi")
     p = parser.parse_args()
 
     device = torch.device('cuda:'+str(p.gpu_id)) if torch.cuda.is_available() else torch.device('cpu')
-    if p.task == 'extract_feature':
+    if p.task in ['extract_feature', 'stream']:
         from mmdet.apis import init_detector, inference_detector, show_result
         import mmcv
         # init object detector
@@ -330,23 +265,51 @@ if __name__ == '__main__':
         detector = init_detector(cfg_file, model_file, device=device)
         # init feature extractor
         feat_extractor = init_feature_extractor(backbone='vgg16', device=device)
+    if p.task == 'extract_feature':
         # object detection & feature extraction
-        detections, features = extract_features(detector, feat_extractor, p.video_file, n_frames=p.n_frames)
+        detections, features, num_boxes = extract_features(detector, feat_extractor, p.video_file, n_frames=p.n_frames)
         feat_file = p.video_file[:-4] + '_feature.npz'
-        np.savez_compressed(feat_file, data=features, det=detections)
+        from src.quantize import quantize_features
+        from src.rois import pack_rois, pack_detections
+        # only the real boxes are stored
+        np.savez_compressed(feat_file, det=pack_detections(detections, num_boxes), num_boxes=num_boxes,
+                            **quantize_features(pack_rois(features, num_boxes), p.feature_dtype))
+    elif p.task == 'stream':
+        from src.Models import UString
+        from src.rois import node_mask
+        # each frame is scored as soon as it is featurized, without the feature file
+        model = init_accident_model(p.ckpt_file, dim_feature=feat_extractor.dim_feat, n_frames=p.n_frames, fps=p.fps, device=device)
+        detections = np.zeros((1, p.n_frames, 19, 6))  # (1 x 50 x 19 x 6)
+        masks = np.zeros((p.n_frames, 19), dtype=bool)
+        pred_score, pred_au, pred_eu = [np.zeros((1, p.n_frames), dtype=np.float32) for _ in range(3)]
+        state = model.init_state(1, device=device)
+        for t, (bboxes, feature) in enumerate(iter_frame_features(detector, feat_extractor, p.video_file, n_frames=p.n_frames)):
+            detections[0, t, :len(bboxes)] = bboxes
+            masks[t] = node_mask([len(bboxes)], 19)[0]
+            features = np.zeros((1, 20, feature.shape[-1]), dtype=np.float32)
+            features[0, :len(feature)] = feature
+            results, state = model.step(torch.from_numpy(features).to(device), detections[:, t], state, node_mask=masks[t:t+1],
+                                        npass=p.npass, mc_tol=p.mc_tol)
+            pred_score[:, t], pred_au[:, t], pred_eu[:, t] = [results[name].cpu().numpy() for name in ['score', 'aleatoric', 'epistemic']]
+            print("frame %d: score=%.4f, aleatoric=%.4f, epistemic=%.4f"%(t, pred_score[0, t], pred_au[0, t], pred_eu[0, t]) +
+                  (", passes=%d"%(results['npass'][0]) if 'npass' in results else ""))
+        result_file = p.video_file[:-4] + '_result.npz'
+        np.savez_compressed(result_file, score=pred_score[0], aleatoric=pred_au[0], epistemic=pred_eu[0], det=detections[0], mask=masks)
     elif p.task == 'inference':
         from src.Models import UString
         # load feature file
-        features, labels, graph_edges, edge_weights, toa, detections, vid = load_input_data(p.feature_file, device=device)
+        features, graph_edges, edge_weights, node_mask, detections, vid = load_input_data(p.feature_file, device=device)
         # prepare model
-        model = init_accident_model(p.ckpt_file, dim_feature=features.shape[-1], n_frames=p.n_frames, fps=p.fps)
-        with torch.no_grad():
-            # run inference
-            _, all_outputs, _ = model(features, labels, toa, graph_edges, hidden_in=None, edge_weights=edge_weights, npass=10, eval_uncertain=True)
-        # parse and save results
-        pred_score, pred_au, pred_eu = parse_results(all_outputs)
+        model = init_accident_model(p.ckpt_file, dim_feature=features.shape[-1], n_frames=p.n_frames, fps=p.fps, device=device)
+        # run inference, no labels are needed
+        results = model.predict(features, graph_edges, edge_weights=edge_weights, npass=p.npass, node_mask=node_mask, mc_tol=p.mc_tol)
+        pred_score, pred_au, pred_eu = [results[name].cpu().numpy() for name in ['score', 'aleatoric', 'epistemic']]
+        if 'npass' in results:
+            npass = results['npass'][0].cpu().numpy()
+            print("MC passes per frame: mean=%.2f, min=%d, max=%d"%(npass.mean(), npass.min(), npass.max()))
         result_file = osp.join(osp.dirname(p.feature_file), p.feature_file.split('/')[-1].split('_')[0] + '_result.npz')
-        np.savez_compressed(result_file, score=pred_score[0], aleatoric=pred_au[0], epistemic=pred_eu[0], det=detections[0])
+        np.savez_compressed(result_file, score=pred_score[0], aleatoric=pred_au[0], epistemic=pred_eu[0], det=detections[0],
+                            mask=node_mask[0].cpu().numpy())
     elif p.task == 'visualize':
         video_data = get_video_frames(p.video_file, n_frames=p.n_frames)
         all_results = np.load(p.result_file, allow_pickle=True)
@@ -373,7 +336,7 @@ if __name__ == '__main__':
         # create video writer
         video_writer = cv2.VideoWriter(p.vis_file, cv2.VideoWriter_fourcc(*'DIVX'), 2.0, (video_data[0].shape[1], video_data[0].shape[0]))
         for t, frame in enumerate(video_data):
-            det_boxes = detections[t]  # 19 x 6
+            det_boxes = detections[t][all_results['mask'][t]] if 'mask' in all_results else detections[t]  # 19 x 6
             for box in det_boxes:
                 if box[4] > 0:
                     print(box[4])
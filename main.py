@@ -10,9 +10,12 @@ import os, time
 import argparse
 import shutil
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
+from functools import partial
 from src.Models import UString
-from src.eval_tools import evaluation, print_results, vis_results
+from src.DataLoader import collate_batch, DataPrefetcher, BucketBatchSampler, get_lengths
+from src.DataLoader import WindowedDataset, WindowBatchSampler, WindowHiddenStates, collate_windows
+from src.eval_tools import evaluation, evaluation_alerts, print_results, vis_results
 import ipdb
 import matplotlib.pyplot as plt
 from tensorboardX import SummaryWriter
@@ -44,17 +47,77 @@ def average_losses(losses_all):
     return losses_mean
 
 
+def stack_frames(results):
+    # stack the per-batch results (B x T x ...) of videos padded to different lengths, with zeros
+    num_frames = max([res.shape[1] for res in results])
+    return np.concatenate([np.pad(res, [(0, 0), (0, num_frames - res.shape[1])] + [(0, 0)] * (res.ndim - 2), 'constant')
+                           for res in results], axis=0)
+
+
+def frame_mask(lengths, num_frames):
+    # B x T, True for the valid frames of each video
+    return np.arange(num_frames)[None, :] < lengths[:, None]
+
+
+def merge_windows(all_windows, all_lengths, frame_results, video_results):
+    """ Merge the results of the windows (sliding-window mode) into the results of the whole videos.
+    :param: all_windows: N x 3 (video index, start, is last window) of all windows
+    :param: all_lengths: (N,) the number of frames of each window
+    :param: frame_results: list of per-frame results of the windows, N x T x ...
+    :param: video_results: list of per-video results of the windows, N x ..., those of the first windows are kept
+    :return: the merged frame results, video results and the number of frames of each video
+    """
+    video_index, starts = all_windows[:, 0], all_windows[:, 1]
+    videos = np.unique(video_index)
+    pos = np.searchsorted(videos, video_index)
+    video_lengths = np.zeros(len(videos), dtype=np.int64)
+    np.maximum.at(video_lengths, pos, starts + all_lengths)
+    merged_frames = []
+    for res in frame_results:
+        merged = np.zeros((len(videos), np.max(video_lengths)) + res.shape[2:], dtype=res.dtype)
+        for n in range(len(all_windows)):
+            merged[pos[n], starts[n]: starts[n] + all_lengths[n]] = res[n, :all_lengths[n]]
+        merged_frames.append(merged)
+    first = np.where(starts == 0)[0]
+    first = first[np.argsort(pos[first])]
+    merged_videos = [res[first] for res in video_results]
+    return merged_frames, merged_videos, video_lengths
+
+
+def new_hidden_states(model):
+    net = model.module if isinstance(model, torch.nn.DataParallel) else model
+    return WindowHiddenStates(net.n_layers, net.n_obj, net.h_dim)
+
+
+def graph_neighbors(n_obj):
+    # the number of edges of each object in the sparse graphs of build_knn_graph(), None for the complete graphs
+    if p.graph_knn is None and p.graph_radius is None:
+        return None
+    return n_obj - 1 if p.graph_knn is None else min(p.graph_knn, n_obj - 1)
+
+
 def test_all(testdata_loader, model):
     
     all_pred = []
     all_labels = []
     all_toas = []
+    all_lengths = []
+    all_windows = []
     losses_all = []
+    hidden_states = new_hidden_states(model)
+    num_batches = len(testdata_loader)
     with torch.no_grad():
-        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas) in enumerate(testdata_loader):
+        for i, batch in enumerate(testdata_loader):
+            batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = batch[:7]
+            # in the sliding-window mode, the hidden states are carried over from the previous windows
+            hidden_in = hidden_states.gather(batch[-1], batch_xs.device) if p.window_size > 0 else None
             # run forward inference
-            losses, all_outputs, hiddens = model(batch_xs, batch_ys, batch_toas, graph_edges, 
-                    hidden_in=None, edge_weights=edge_weights, npass=10, nbatch=len(testdata_loader), testing=False)
+            losses, all_outputs, hiddens, hidden_out = model(batch_xs, batch_ys, batch_toas, graph_edges, 
+                    hidden_in=hidden_in, edge_weights=edge_weights, npass=p.mc_max_pass, nbatch=num_batches, testing=False, lengths=batch_lens, return_hidden=True, node_mask=node_masks,
+                    mc_tol=p.mc_tol, min_pass=p.mc_min_pass)
+            if p.window_size > 0:
+                hidden_states.update(batch[-1], hidden_out)
+                all_windows.append(batch[-1].cpu().numpy())
             # make total loss
             losses['total_loss'] = p.loss_alpha * (losses['log_posterior'] - losses['log_prior']) + losses['cross_entropy']
             losses['total_loss'] += p.loss_beta * losses['auxloss']
@@ -69,6 +132,8 @@ def test_all(testdata_loader, model):
                 pred = all_outputs[t]['pred_mean']
                 pred = pred.cpu().numpy() if pred.is_cuda else pred.detach().numpy()
                 pred_frames[:, t] = np.exp(pred[:, 1]) / np.sum(np.exp(pred), axis=1)
+            lengths = batch_lens.cpu().numpy()
+            pred_frames *= frame_mask(lengths, num_frames)
             # gather results and ground truth
             all_pred.append(pred_frames)
             label_onehot = batch_ys.cpu().numpy()
@@ -76,12 +141,16 @@ def test_all(testdata_loader, model):
             all_labels.append(label)
             toas = np.squeeze(batch_toas.cpu().numpy()).astype(np.int)
             all_toas.append(toas)
+            all_lengths.append(lengths)
 
-    all_pred = np.vstack((np.vstack(all_pred[:-1]), all_pred[-1]))
+    all_pred = stack_frames(all_pred)
     all_labels = np.hstack((np.hstack(all_labels[:-1]), all_labels[-1]))
     all_toas = np.hstack((np.hstack(all_toas[:-1]), all_toas[-1]))
+    all_lengths = np.hstack(all_lengths)
+    if p.window_size > 0:
+        (all_pred,), (all_labels, all_toas), all_lengths = merge_windows(np.vstack(all_windows), all_lengths, [all_pred], [all_labels, all_toas])
     
-    return all_pred, all_labels, all_toas, losses_all
+    return all_pred, all_labels, all_toas, all_lengths, losses_all
 
 
 def test_all_vis(testdata_loader, model, vis=True, multiGPU=False, device=torch.device('cuda')):
@@ -90,35 +159,46 @@ def test_all_vis(testdata_loader, model, vis=True, multiGPU=False, device=torch.
         model = torch.nn.DataParallel(model)
     model = model.to(device=device)
     model.eval()
+    # predict() is not the forward of DataParallel, it runs on the wrapped model
+    net = model.module if isinstance(model, torch.nn.DataParallel) else model
 
     all_pred = []
     all_labels = []
     all_toas = []
+    all_lengths = []
+    all_windows = []
     vis_data = []
     all_uncertains = []
+    frame_passes, clip_passes = [], []
+    # the real early exit of predict() is only run on whole videos
+    early_exit = {'alert': [], 'num_frames': [], 'encoded_frames': []} if p.alert_threshold is not None and p.window_size == 0 else None
+    hidden_states = new_hidden_states(model)
     with torch.no_grad():
-        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, detections, video_ids) in tqdm(enumerate(testdata_loader), desc="batch progress", total=len(testdata_loader)):
-            # run forward inference
-            losses, all_outputs, hiddens = model(batch_xs, batch_ys, batch_toas, graph_edges, 
-                    hidden_in=None, edge_weights=edge_weights, npass=10, nbatch=len(testdata_loader), testing=False, eval_uncertain=True)
+        for i, batch in tqdm(enumerate(testdata_loader), desc="batch progress", total=len(testdata_loader)):
+            batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks, detections, video_ids = batch[:9]
+            # in the sliding-window mode, the hidden states are carried over from the previous windows
+            hidden_in = hidden_states.gather(batch[-1], batch_xs.device) if p.window_size > 0 else None
+            # run inference only, without the losses, the labels are not used
+            results, hidden_out = net.predict(batch_xs, graph_edges, edge_weights=edge_weights, hidden_in=hidden_in, npass=p.mc_max_pass,
+                                              lengths=batch_lens, node_mask=node_masks, return_hidden=True, mc_tol=p.mc_tol, min_pass=p.mc_min_pass)
+            if p.window_size > 0:
+                hidden_states.update(batch[-1], hidden_out)
+                all_windows.append(batch[-1].cpu().numpy())
+            if early_exit is not None:
+                # the early exit is run next to the full processing, the frames after the alerts are not computed
+                alerts = net.predict(batch_xs, graph_edges, edge_weights=edge_weights, npass=p.mc_max_pass, lengths=batch_lens, node_mask=node_masks,
+                                     alert_threshold=p.alert_threshold, alert_epistemic=p.alert_epistemic, alert_frames=p.alert_frames,
+                                     mc_tol=p.mc_tol, min_pass=p.mc_min_pass)
+                for name in early_exit:
+                    early_exit[name].append(alerts[name].cpu().numpy())
 
             num_frames = batch_xs.size()[1]
             batch_size = batch_xs.size()[0]
-            pred_frames = np.zeros((batch_size, num_frames), dtype=np.float32)
-            pred_uncertains = np.zeros((batch_size, num_frames, 2), dtype=np.float32)
-            # run inference
-            for t in range(num_frames):
-                # prediction
-                pred = all_outputs[t]['pred_mean']  # B x 2
-                pred = pred.cpu().numpy() if pred.is_cuda else pred.detach().numpy()
-                pred_frames[:, t] = np.exp(pred[:, 1]) / np.sum(np.exp(pred), axis=1)
-                # uncertainties
-                aleatoric = all_outputs[t]['aleatoric']  # B x 2 x 2
-                aleatoric = aleatoric.cpu().numpy() if aleatoric.is_cuda else aleatoric.detach().numpy()
-                epistemic = all_outputs[t]['epistemic']  # B x 2 x 2
-                epistemic = epistemic.cpu().numpy() if epistemic.is_cuda else epistemic.detach().numpy()
-                pred_uncertains[:, t, 0] = aleatoric[:, 0, 0] + aleatoric[:, 1, 1]
-                pred_uncertains[:, t, 1] = epistemic[:, 0, 0] + epistemic[:, 1, 1]
+            pred_frames = results['score'].cpu().numpy()  # B x T
+            # the traces of the aleatoric and epistemic uncertainties
+            pred_uncertains = torch.stack([results['aleatoric'], results['epistemic']], dim=-1).cpu().numpy()  # B x T x 2
+            lengths = batch_lens.cpu().numpy()
+            pred_frames *= frame_mask(lengths, num_frames)
 
             # gather results and ground truth
             all_pred.append(pred_frames)
@@ -127,19 +207,36 @@ def test_all_vis(testdata_loader, model, vis=True, multiGPU=False, device=torch.
             all_labels.append(label)
             toas = np.squeeze(batch_toas.cpu().numpy()).astype(np.int)
             all_toas.append(toas)
+            all_lengths.append(lengths)
             all_uncertains.append(pred_uncertains)
+            if 'npass' in results:
+                # the MC passes used by the adaptive sampling, over the valid frames
+                npass = results['npass'].cpu().numpy()
+                for b in range(batch_size):
+                    frame_passes.append(npass[b, :lengths[b]])
+                    clip_passes.append(np.mean(npass[b, :lengths[b]]))
 
             if vis:
                 # gather data for visualization
                 vis_data.append({'pred_frames': pred_frames, 'label': label, 'pred_uncertain': pred_uncertains,
                                 'toa': toas, 'detections': detections, 'video_ids': video_ids})
 
-    all_pred = np.vstack((np.vstack(all_pred[:-1]), all_pred[-1]))
+    all_pred = stack_frames(all_pred)
     all_labels = np.hstack((np.hstack(all_labels[:-1]), all_labels[-1]))
     all_toas = np.hstack((np.hstack(all_toas[:-1]), all_toas[-1]))
-    all_uncertains = np.vstack((np.vstack(all_uncertains[:-1]), all_uncertains[-1]))
+    all_lengths = np.hstack(all_lengths)
+    all_uncertains = stack_frames(all_uncertains)
+    if len(frame_passes) > 0:
+        frame_passes, clip_passes = np.hstack(frame_passes), np.array(clip_passes)
+        print("MC passes per frame: mean=%.2f, min=%d, max=%d, per clip: mean=%.2f, min=%.2f, max=%.2f"%(
+            frame_passes.mean(), frame_passes.min(), frame_passes.max(), clip_passes.mean(), clip_passes.min(), clip_passes.max()))
+    if p.window_size > 0:
+        (all_pred, all_uncertains), (all_labels, all_toas), all_lengths = merge_windows(
+            np.vstack(all_windows), all_lengths, [all_pred, all_uncertains], [all_labels, all_toas])
+    if early_exit is not None:
+        early_exit = {name: np.hstack(values) for name, values in early_exit.items()}
 
-    return all_pred, all_labels, all_toas, all_uncertains, vis_data
+    return all_pred, all_labels, all_toas, all_lengths, all_uncertains, vis_data, early_exit
 
 
 def write_scalars(logger, cur_epoch, cur_iter, losses, lr):
@@ -212,6 +309,46 @@ def load_checkpoint(model, optimizer=None, filename='checkpoint.pth.tar', isTrai
     return model, optimizer, start_epoch
 
 
+def build_sample_cache():
+    if p.sample_cache <= 0:
+        return None
+    from src.sample_cache import SampleCache
+    return SampleCache(int(p.sample_cache * 1024**3), feature_dtype=p.cache_dtype)
+
+
+def write_cache_scalars(logger, cur_epoch, sample_cache):
+    stats = sample_cache.stats()
+    print('Sample cache (epoch %d): hits=%d, misses=%d, evictions=%d, size=%.2f GB, hit rate=%.3f' % (
+        cur_epoch, stats['hits'], stats['misses'], stats['evictions'], stats['bytes'] / 1024.0**3, stats['hit_rate']))
+    logger.add_scalars("cache/counts", {'hits': stats['hits'], 'misses': stats['misses'], 'evictions': stats['evictions']}, cur_epoch)
+    logger.add_scalars("cache/hit_rate", {'hit_rate': stats['hit_rate']}, cur_epoch)
+
+
+def build_loader(dataset, device, shuffle=False):
+    # samples are collated on host (in worker processes if any), and moved to the device by the prefetcher
+    pin_memory = device.type == 'cuda'
+    collate_fn = partial(collate_batch, pin_memory=pin_memory and p.num_workers == 0)
+    if isinstance(dataset, IterableDataset):
+        # the samples are shuffled by the dataset itself
+        loader = DataLoader(dataset=dataset, batch_size=p.batch_size, drop_last=True, num_workers=p.num_workers,
+                            collate_fn=collate_fn, pin_memory=pin_memory and p.num_workers > 0)
+    elif isinstance(dataset, WindowedDataset):
+        # the windows of each video are batched in order
+        batch_sampler = WindowBatchSampler(dataset.video_windows, p.batch_size, shuffle=shuffle)
+        loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, num_workers=p.num_workers,
+                            collate_fn=partial(collate_windows, pin_memory=pin_memory and p.num_workers == 0),
+                            pin_memory=pin_memory and p.num_workers > 0)
+    elif p.length_bucketing:
+        # videos of similar lengths are batched together
+        batch_sampler = BucketBatchSampler(get_lengths(dataset), p.batch_size, shuffle=shuffle, drop_last=True)
+        loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, num_workers=p.num_workers, collate_fn=collate_fn,
+                            pin_memory=pin_memory and p.num_workers > 0)
+    else:
+        loader = DataLoader(dataset=dataset, batch_size=p.batch_size, shuffle=shuffle, drop_last=True,
+                            num_workers=p.num_workers, collate_fn=collate_fn, pin_memory=pin_memory and p.num_workers > 0)
+    return DataPrefetcher(loader, device, prefetch=p.prefetch)
+
+
 def train_eval():
     ### --- CONFIG PATH ---
     data_path = os.path.join(ROOT_PATH, p.data_path, p.dataset)
@@ -232,27 +369,38 @@ def train_eval():
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
     # create data loader
-    if p.dataset == 'dad':
+    sample_cache = build_sample_cache()
+    if p.stream_shards is not None:
+        # stream the samples from the shards written by src/stream_dataset.py
+        from src.stream_dataset import StreamDataset
+        train_phase, test_phase = ('training', 'testing') if p.dataset == 'dad' else ('train', 'test')
+        train_data = StreamDataset(os.path.join(p.stream_shards, train_phase), shuffle=True, shuffle_buffer=p.shuffle_buffer, device=device)
+        test_data = StreamDataset(os.path.join(p.stream_shards, test_phase), shuffle=False, device=device)
+    elif p.dataset == 'dad':
         from src.DataLoader import DADDataset
-        train_data = DADDataset(data_path, p.feature_name, 'training', toTensor=True, device=device)
-        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=True, device=device)
+        train_data = DADDataset(data_path, p.feature_name, 'training', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
+        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     elif p.dataset == 'a3d':
         from src.DataLoader import A3DDataset
-        train_data = A3DDataset(data_path, p.feature_name, 'train', toTensor=True, device=device)
-        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=True, device=device)
+        train_data = A3DDataset(data_path, p.feature_name, 'train', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
+        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     elif p.dataset == 'crash':
         from src.DataLoader import CrashDataset
-        train_data = CrashDataset(data_path, p.feature_name, 'train', toTensor=True, device=device)
-        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=True, device=device)
+        train_data = CrashDataset(data_path, p.feature_name, 'train', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
+        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     else:
         raise NotImplementedError
-    traindata_loader = DataLoader(dataset=train_data, batch_size=p.batch_size, shuffle=True, drop_last=True)
-    testdata_loader = DataLoader(dataset=test_data, batch_size=p.batch_size, shuffle=False, drop_last=True)
+    if p.window_size > 0:
+        assert p.stream_shards is None, "The sliding-window mode does not support streaming datasets."
+        train_data = WindowedDataset(train_data, p.window_size)
+        test_data = WindowedDataset(test_data, p.window_size)
+    traindata_loader = build_loader(train_data, device, shuffle=True)
+    testdata_loader = build_loader(test_data, device, shuffle=False)
     
     # building model
     model = UString(train_data.dim_feature, p.hidden_dim, p.latent_dim, 
                        n_layers=p.num_rnn, n_obj=train_data.n_obj, n_frames=train_data.n_frames, fps=train_data.fps, 
-                       with_saa=True, uncertain_ranking=True)
+                       with_saa=True, uncertain_ranking=True, graph_knn=graph_neighbors(train_data.n_obj), local_reparam=p.local_reparam)
 
     # optimizer
     optimizer = torch.optim.Adam(model.parameters(), lr=p.base_lr)
@@ -272,23 +420,41 @@ def train_eval():
     write_weight_histograms(logger, model, 0)
     iter_cur = 0
     best_metric = 0
+    # in the sliding-window mode, gradients flow back through bptt_windows consecutive windows of the videos
+    hidden_states = new_hidden_states(model)
+    bptt_windows = p.bptt_windows if p.window_size > 0 else 1
     for k in range(p.epoch):
         if k <= start_epoch:
             iter_cur += len(traindata_loader)
             continue
-        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas) in enumerate(traindata_loader):
+        hidden_states.reset()
+        if hasattr(train_data, 'set_epoch'):
+            train_data.set_epoch(k)
+        # the number of batches of this epoch, computed once
+        num_batches = len(traindata_loader)
+        for i, batch in enumerate(traindata_loader):
+            batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = batch[:7]
+            hidden_in = hidden_states.gather(batch[-1], batch_xs.device) if p.window_size > 0 else None
             # ipdb.set_trace()
-            optimizer.zero_grad()
-            losses, all_outputs, hidden_st = model(batch_xs, batch_ys, batch_toas, graph_edges, edge_weights=edge_weights, npass=2, nbatch=len(traindata_loader), eval_uncertain=True)
+            if i % bptt_windows == 0:
+                optimizer.zero_grad()
+            losses, all_outputs, hidden_st, hidden_out = model(batch_xs, batch_ys, batch_toas, graph_edges, hidden_in=hidden_in, edge_weights=edge_weights, 
+                    npass=2, nbatch=num_batches, eval_uncertain=True, lengths=batch_lens, return_hidden=True, node_mask=node_masks)
             complexity_loss = losses['log_posterior'] - losses['log_prior']
             losses['total_loss'] = p.loss_alpha * complexity_loss + losses['cross_entropy']
             losses['total_loss'] += p.loss_beta * losses['auxloss']
             losses['total_loss'] += p.loss_yita * losses['ranking']
+            if p.window_size > 0:
+                hidden_states.update(batch[-1], hidden_out)
             # backward
-            losses['total_loss'].mean().backward()
-            # clip gradients
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 10)
-            optimizer.step()
+            bptt_loss = losses['total_loss'].mean() if i % bptt_windows == 0 else bptt_loss + losses['total_loss'].mean()
+            if (i + 1) % bptt_windows == 0 or i + 1 == num_batches:
+                bptt_loss.backward()
+                # clip gradients
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 10)
+                optimizer.step()
+                # truncate the back-propagation at the window boundaries
+                hidden_states.detach()
             # write the losses info
             lr = optimizer.param_groups[0]['lr']
             write_scalars(logger, k, iter_cur, losses, lr)
@@ -297,13 +463,13 @@ def train_eval():
             # test and evaluate the model
             if iter_cur % p.test_iter == 0:
                 model.eval()
-                all_pred, all_labels, all_toas, losses_all = test_all(testdata_loader, model)
+                all_pred, all_labels, all_toas, all_lengths, losses_all = test_all(testdata_loader, model)
                 model.train()
                 loss_val = average_losses(losses_all)
                 print('----------------------------------')
                 print("Starting evaluation...")
                 metrics = {}
-                metrics['AP'], metrics['mTTA'], metrics['TTA_R80'] = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps)
+                metrics['AP'], metrics['mTTA'], metrics['TTA_R80'] = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps, lengths=all_lengths)
                 print('----------------------------------')
                 # keep track of validation losses
                 write_test_scalars(logger, k, iter_cur, loss_val, metrics)
@@ -322,6 +488,8 @@ def train_eval():
         scheduler.step(losses['log_posterior'])
         # write histograms
         write_weight_histograms(logger, model, k+1)
+        if sample_cache is not None:
+            write_cache_scalars(logger, k, sample_cache)
     logger.close()
 
 
@@ -357,25 +525,28 @@ def test_eval():
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
     # create data loader
+    sample_cache = build_sample_cache()
     if p.dataset == 'dad':
         from src.DataLoader import DADDataset
-        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=True, device=device, vis=True)
+        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=False, device=device, vis=True, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     elif p.dataset == 'a3d':
         from src.DataLoader import A3DDataset
-        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=True, device=device, vis=True)
+        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, vis=True, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     elif p.dataset == 'crash':
         from src.DataLoader import CrashDataset
-        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=True, device=device, vis=True)
+        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, vis=True, graph_cache=p.graph_cache, feature_store=p.feature_store, sample_cache=sample_cache, anno_index=p.anno_index, manifest=p.manifest, graph_knn=p.graph_knn, graph_radius=p.graph_radius)
     else:
         raise NotImplementedError
-    testdata_loader = DataLoader(dataset=test_data, batch_size=p.batch_size, shuffle=False, drop_last=True)
+    if p.window_size > 0:
+        test_data = WindowedDataset(test_data, p.window_size)
+    testdata_loader = build_loader(test_data, device, shuffle=False)
     num_samples = len(test_data)
     print("Number of testing samples: %d"%(num_samples))
     
     # building model
     model = UString(test_data.dim_feature, p.hidden_dim, p.latent_dim, 
                        n_layers=p.num_rnn, n_obj=test_data.n_obj, n_frames=test_data.n_frames, fps=test_data.fps, 
-                       with_saa=True, uncertain_ranking=True)
+                       with_saa=True, uncertain_ranking=True, graph_knn=graph_neighbors(test_data.n_obj), local_reparam=p.local_reparam)
 
     # start to evaluate
     if p.evaluate_all:
@@ -389,10 +560,10 @@ def test_eval():
             model_file = os.path.join(model_dir, filename)
             model, _, _ = load_checkpoint(model, filename=model_file, isTraining=False)
             # run model inference
-            all_pred, all_labels, all_toas, all_uncertains, _ = test_all_vis(testdata_loader, model, vis=False, device=device)
+            all_pred, all_labels, all_toas, all_lengths, all_uncertains, _, _ = test_all_vis(testdata_loader, model, vis=False, device=device)
             # evaluate results
-            AP, mTTA, TTA_R80 = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps)
-            mUncertains = np.mean(all_uncertains, axis=(0, 1))
+            AP, mTTA, TTA_R80 = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps, lengths=all_lengths)
+            mUncertains = np.sum(all_uncertains, axis=(0, 1)) / np.sum(all_lengths)
             all_vid_scores = [max(pred[:int(toa)]) for toa, pred in zip(all_toas, all_pred)]
             AP_video = average_precision_score(all_labels, all_vid_scores)
             APvid_all.append(AP_video)
@@ -409,23 +580,43 @@ def test_eval():
         if not os.path.exists(result_file):
             model, _, _ = load_checkpoint(model, filename=p.model_file, isTraining=False)
             # run model inference
-            all_pred, all_labels, all_toas, all_uncertains, vis_data = test_all_vis(testdata_loader, model, vis=True, device=device)
+            all_pred, all_labels, all_toas, all_lengths, all_uncertains, vis_data, early_exit = test_all_vis(testdata_loader, model, vis=True, device=device)
             # save predictions
-            np.savez(result_file[:-4], pred=all_pred, label=all_labels, toas=all_toas, uncertainties=all_uncertains, vis_data=vis_data)
+            np.savez(result_file[:-4], pred=all_pred, label=all_labels, toas=all_toas, lengths=all_lengths, uncertainties=all_uncertains, vis_data=vis_data)
         else:
             print("Result file exists. Loaded from cache.")
+            early_exit = None
             all_results = np.load(result_file, allow_pickle=True)
             all_pred, all_labels, all_toas, all_uncertains, vis_data = \
                 all_results['pred'], all_results['label'], all_results['toas'], all_results['uncertainties'], all_results['vis_data']
+            # result files without lengths are of fixed-length videos
+            all_lengths = all_results['lengths'] if 'lengths' in all_results.files else np.full(len(all_pred), all_pred.shape[1])
         # evaluate results
         all_vid_scores = [max(pred[:int(toa)]) for toa, pred in zip(all_toas, all_pred)]
         AP_video = average_precision_score(all_labels, all_vid_scores)
         print("video-level AP=%.5f"%(AP_video))
-        AP, mTTA, TTA_R80 = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps)
+        AP, mTTA, TTA_R80 = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps, lengths=all_lengths)
         # evaluate uncertainties
-        mUncertains = np.mean(all_uncertains, axis=(0, 1))
+        mUncertains = np.sum(all_uncertains, axis=(0, 1)) / np.sum(all_lengths)
         print("Mean aleatoric uncertainty: %.6f"%(mUncertains[0]))
         print("Mean epistemic uncertainty: %.6f"%(mUncertains[1]))
+        if p.alert_threshold is not None:
+            # early-exit alerts applied to the full predictions, compared with the full processing
+            alerts = evaluation_alerts(all_pred, all_uncertains[:, :, 1], all_labels, all_toas, fps=test_data.fps, lengths=all_lengths,
+                                       threshold=p.alert_threshold, max_epistemic=p.alert_epistemic, num_frames=p.alert_frames)
+            print("Alerts: precision=%.4f, recall=%.4f, mTTA=%.4f, recurrent frames saved=%.2f%%"%(
+                alerts['precision'], alerts['recall'], alerts['mTTA'], alerts['frames_saved'] * 100))
+            print("Full processing: AP=%.4f, mTTA=%.4f, early exit: AP=%.4f, mTTA=%.4f"%(
+                alerts['full'][0], alerts['full'][1], alerts['stopped'][0], alerts['stopped'][1]))
+        if early_exit is not None:
+            # the early exit of UString.predict(), with the frames it actually computed
+            alerted = early_exit['alert'] >= 0
+            true_alerts = alerted & (np.asarray(all_labels) > 0) & (early_exit['alert'] < np.asarray(all_toas))
+            print("Early exit: alerts=%d, true alerts=%d, same alert frame as the full predictions: %d/%d videos"%(
+                np.sum(alerted), np.sum(true_alerts), np.sum(early_exit['alert'] == alerts['alerts']), len(alerted)))
+            print("Early exit: recurrent frames saved=%.2f%%, encoded frames saved=%.2f%%"%(
+                (1.0 - float(np.sum(early_exit['num_frames'])) / np.sum(all_lengths)) * 100,
+                (1.0 - float(np.sum(early_exit['encoded_frames'])) / np.sum(all_lengths)) * 100))
         # visualize
         vis_results(vis_data, p.batch_size, vis_dir)
 
@@ -458,6 +649,50 @@ if __name__ == '__main__':
                         help='The weighting factor of auxiliary loss. Default: 10')
     parser.add_argument('--loss_yita', type=float, default=10,
                         help='The weighting factor of uncertainty ranking loss. Default: 10')
+    parser.add_argument('--graph_cache', type=str, default=None,
+                        help='The directory to cache the precomputed graphs of each video. Default: None (disabled)')
+    parser.add_argument('--feature_store', type=str, default=None,
+                        help='The directory of the packed feature store (see src/feature_store.py). Default: None (use .npz files)')
+    parser.add_argument('--sample_cache', type=float, default=0,
+                        help='The memory budget (GB) of the in-memory cache of decoded samples shared by all workers. Default: 0 (disabled)')
+    parser.add_argument('--cache_dtype', type=str, default=None, choices=['float16', 'float32'],
+                        help='The dtype of the features in the sample cache. Default: None (keep the original dtype)')
+    parser.add_argument('--anno_index', type=str, default=None,
+                        help='The directory of the compiled annotation index of A3D and CCD datasets. Default: None (parse the annotation files)')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='The directory of the verified manifests written by src/verify.py, only the verified samples are used. Default: None')
+    parser.add_argument('--stream_shards', type=str, default=None,
+                        help='The directory (or http url) of the tar shards to stream the samples from (see src/stream_dataset.py). Default: None')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000,
+                        help='The number of samples in the shuffle buffer of each worker when streaming. Default: 1000')
+    parser.add_argument('--window_size', type=int, default=0,
+                        help='The number of frames of each window in the sliding-window mode for long videos. Default: 0 (disabled)')
+    parser.add_argument('--bptt_windows', type=int, default=1,
+                        help='The number of consecutive windows the gradients flow back through in the sliding-window mode. Default: 1')
+    parser.add_argument('--length_bucketing', action='store_true',
+                        help='Batch videos of similar lengths together to reduce padding. Default: False')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='The number of worker processes of the data loaders. Default: 0')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Copy the next batch to GPU asynchronously while the current one is processed. Default: False')
+    parser.add_argument('--graph_knn', type=int, default=None,
+                        help='The number of nearest neighbours of each object in the sparse object graphs. Default: None (complete graphs)')
+    parser.add_argument('--graph_radius', type=float, default=None,
+                        help='The maximum box-center distance of the edges in the sparse object graphs. Default: None')
+    parser.add_argument('--local_reparam', action='store_true',
+                        help='Sample the pre-activations of the BNN decoder instead of its weights (local reparameterization). Default: False')
+    parser.add_argument('--alert_threshold', type=float, default=None,
+                        help='The score threshold of the early-exit alerts evaluated in testing, None to skip them. Default: None')
+    parser.add_argument('--alert_epistemic', type=float, default=float('inf'),
+                        help='The maximum epistemic uncertainty of the alert frames. Default: inf')
+    parser.add_argument('--alert_frames', type=int, default=3,
+                        help='The number of consecutive frames above the threshold to alert. Default: 3')
+    parser.add_argument('--mc_tol', type=float, default=None,
+                        help='The tolerance of the adaptive MC passes in testing, None for the fixed --mc_max_pass passes. Default: None')
+    parser.add_argument('--mc_min_pass', type=int, default=4,
+                        help='The minimum number of the adaptive MC passes. Default: 4')
+    parser.add_argument('--mc_max_pass', type=int, default=10,
+                        help='The (maximum) number of MC passes in testing. Default: 10')
     parser.add_argument('--gpus', type=str, default="0", 
                         help="The delimited list of GPU IDs separated with comma. Default: '0'.")
     parser.add_argument('--phase', type=str, choices=['train', 'test'],
@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, time
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import UString
+from src.DataLoader import DADDataset, A3DDataset, CrashDataset, collate_batch
+from src.eval_tools import evaluation
+
+
+def build_model(local_reparam, dataset, device):
+    # the same initial weights for both modes, the parameters of the two modes are the same
+    torch.manual_seed(p.seed)
+    model = UString(dataset.dim_feature, p.hidden_dim, p.latent_dim, n_layers=p.num_rnn, n_obj=dataset.n_obj,
+                    n_frames=dataset.n_frames, fps=dataset.fps, with_saa=True, uncertain_ranking=True, local_reparam=local_reparam)
+    if p.model_file is not None:
+        model.load_state_dict(torch.load(p.model_file, map_location=device)['model'])
+    return model.to(device=device)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run_training(model, dataset, device):
+    # forward and backward passes of the training mode, without updating the weights
+    loader = DataLoader(dataset, batch_size=p.batch_size, shuffle=False, drop_last=True, num_workers=p.num_workers, collate_fn=collate_batch)
+    model.train()
+    torch.manual_seed(p.seed)
+    log_posterior, log_prior, elapsed, num_batches = 0, 0, 0, 0
+    for i, batch in enumerate(tqdm(loader, desc='train', total=min(p.num_train_batches, len(loader)))):
+        if i >= p.num_train_batches:
+            break
+        batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = [data.to(device) for data in batch[:7]]
+        synchronize(device)
+        start = time.time()
+        losses, _, _ = model(batch_xs, batch_ys, batch_toas, graph_edges, edge_weights=edge_weights, npass=2, nbatch=len(loader),
+                             eval_uncertain=True, lengths=batch_lens, node_mask=node_masks)
+        loss = losses['log_posterior'] - losses['log_prior'] + losses['cross_entropy'] + losses['auxloss'] + losses['ranking']
+        model.zero_grad()
+        loss.mean().backward()
+        synchronize(device)
+        elapsed += time.time() - start
+        log_posterior += losses['log_posterior'].item()
+        log_prior += losses['log_prior'].item()
+        num_batches += 1
+    return elapsed / num_batches, log_posterior / num_batches, log_prior / num_batches
+
+
+def run_testing(model, dataset, device):
+    loader = DataLoader(dataset, batch_size=p.batch_size, shuffle=False, drop_last=False, num_workers=p.num_workers, collate_fn=collate_batch)
+    model.eval()
+    torch.manual_seed(p.seed)
+    all_pred, all_labels, all_toas, all_lengths, all_uncertains = [], [], [], [], []
+    elapsed = 0
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='test'):
+            batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = [data.to(device) for data in batch[:7]]
+            synchronize(device)
+            start = time.time()
+            _, all_outputs, _ = model(batch_xs, batch_ys, batch_toas, graph_edges, edge_weights=edge_weights, npass=10,
+                                      eval_uncertain=True, lengths=batch_lens, node_mask=node_masks)
+            synchronize(device)
+            elapsed += time.time() - start
+            pred = torch.stack([output['pred_mean'] for output in all_outputs], dim=1)  # B x T x 2
+            pred = torch.softmax(pred, dim=-1)[:, :, 1].cpu().numpy()
+            all_pred.append(np.pad(pred, [(0, 0), (0, dataset.n_frames - pred.shape[1])], 'constant'))
+            all_labels.append(batch_ys[:, 1].cpu().numpy())
+            all_toas.append(batch_toas.view(-1).cpu().numpy().astype(np.int64))
+            all_lengths.append(batch_lens.cpu().numpy())
+            # the traces of the uncertainties of the valid frames
+            valid = (torch.arange(len(all_outputs), device=device).unsqueeze(0) < batch_lens.unsqueeze(1)).cpu().numpy()  # B x T
+            for key in ['aleatoric', 'epistemic']:
+                trace = torch.stack([torch.diagonal(output[key], dim1=-2, dim2=-1).sum(-1) for output in all_outputs], dim=1).cpu().numpy()
+                all_uncertains.append((key, trace[valid]))
+    all_lengths = np.hstack(all_lengths)
+    AP, mTTA, _ = evaluation(np.vstack(all_pred), np.hstack(all_labels), np.hstack(all_toas), fps=dataset.fps, lengths=all_lengths)
+    aleatoric = np.mean(np.hstack([trace for key, trace in all_uncertains if key == 'aleatoric']))
+    epistemic = np.mean(np.hstack([trace for key, trace in all_uncertains if key == 'epistemic']))
+    return elapsed / len(loader), AP, mTTA, aleatoric, epistemic
+
+
+def time_predictor(model, device):
+    # the BNN decoder alone, one timestep of 10 MC passes
+    embed = torch.randn(p.batch_size, model.n_obj * model.z_dim, device=device)
+    model.eval()
+    with torch.no_grad():
+        for i in range(p.num_warmup + p.num_iters):
+            if i == p.num_warmup:
+                synchronize(device)
+                start = time.time()
+            model.predictor.sample_elbo(embed, npass=10, eval_uncertain=True)
+        synchronize(device)
+    return (time.time() - start) / p.num_iters * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the weight sampling and the local reparameterization of the BNN decoder.')
+    parser.add_argument('--data_path', type=str, default='./data',
+                        help='The relative path of dataset.')
+    parser.add_argument('--dataset', type=str, default='dad', choices=['a3d', 'dad', 'crash'],
+                        help='The name of dataset. Default: dad')
+    parser.add_argument('--feature_name', type=str, default='vgg16', choices=['vgg16', 'res101'],
+                        help='The name of feature embedding methods. Default: vgg16')
+    parser.add_argument('--model_file', type=str, default=None,
+                        help='The trained UString model file, the model is initialized randomly if not given. Default: None')
+    parser.add_argument('--hidden_dim', type=int, default=256,
+                        help='The dimension of hidden states in RNN. Default: 256')
+    parser.add_argument('--latent_dim', type=int, default=256,
+                        help='The dimension of latent space. Default: 256')
+    parser.add_argument('--num_rnn', type=int, default=1,
+                        help='The number of RNN cells for each timestamp. Default: 1')
+    parser.add_argument('--batch_size', type=int, default=10,
+                        help='The batch size. Default: 10')
+    parser.add_argument('--num_train_batches', type=int, default=20,
+                        help='The number of training batches to time. Default: 20')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='The number of worker processes of the data loader. Default: 0')
+    parser.add_argument('--num_warmup', type=int, default=5,
+                        help='The number of warm-up iterations of the decoder timing. Default: 5')
+    parser.add_argument('--num_iters', type=int, default=100,
+                        help='The number of timed iterations of the decoder timing. Default: 100')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='The random seed of the initialization and the MC sampling. Default: 123')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    data_path = os.path.join(p.data_path, p.dataset)
+    if p.dataset == 'dad':
+        train_data = DADDataset(data_path, p.feature_name, 'training', toTensor=False, device=device)
+        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=False, device=device)
+    elif p.dataset == 'a3d':
+        train_data = A3DDataset(data_path, p.feature_name, 'train', toTensor=False, device=device)
+        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=False, device=device)
+    else:
+        train_data = CrashDataset(data_path, p.feature_name, 'train', toTensor=False, device=device)
+        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=False, device=device)
+
+    results = []
+    for mode in ['weights', 'local']:
+        model = build_model(mode == 'local', test_data, device)
+        decoder_time = time_predictor(model, device)
+        train_time, log_posterior, log_prior = run_training(model, train_data, device)
+        test_time, AP, mTTA, aleatoric, epistemic = run_testing(model, test_data, device)
+        results.append((mode, decoder_time, train_time, test_time, log_posterior, log_prior, AP, mTTA, aleatoric, epistemic))
+
+    print('%-8s %12s %10s %10s %14s %14s %8s %8s %10s %10s' % ('mode', 'BNN (ms)', 'train (s)', 'test (s)', 'log_posterior',
+                                                             'log_prior', 'AP', 'mTTA', 'aleatoric', 'epistemic'))
+    for mode, decoder_time, train_time, test_time, log_posterior, log_prior, AP, mTTA, aleatoric, epistemic in results:
+        print('%-8s %12.3f %10.3f %10.3f %14.4f %14.4f %8.4f %8.4f %10.6f %10.6f' % (mode, decoder_time, train_time, test_time,
+              log_posterior, log_prior, AP, mTTA, aleatoric, epistemic))
+    base = results[0]
+    print('speedup: BNN %.2fx, train %.2fx, test %.2fx' % (base[1] / results[1][1], base[2] / results[1][2], base[3] / results[1][3]))
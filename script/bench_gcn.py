@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, time
+import argparse
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import GCNConv
+from src.DataLoader import build_st_graph
+from torch_scatter import scatter_add
+
+
+def loop_forward(conv, x, edge_index, edge_weight):
+    # the former GCNConv.forward(), with the self loops, one scatter and message passing per sample of the batch
+    num_nodes = x.size(1)
+    loop_index = torch.arange(num_nodes, dtype=torch.long, device=x.device).unsqueeze(0).repeat(2, 1)  # 2 x 19
+    out_batch = []
+    for i in range(edge_index.size(0)):
+        row, col = torch.cat([edge_index[i], loop_index], dim=-1)
+        weight = torch.cat([edge_weight[i], edge_weight.new_ones(num_nodes)])
+        deg = scatter_add(weight, row, dim=0, dim_size=num_nodes)
+        deg_inv = deg.pow(-0.5)
+        deg_inv[deg_inv == float('inf')] = 0
+        norm = deg_inv[row] * weight * deg_inv[col]
+        x_w = torch.matmul(x[i], conv.weight)
+        out = scatter_add(norm.view(-1, 1) * x_w[col], row, dim=0, dim_size=num_nodes)
+        out_batch.append(conv.act(conv.update(out)))
+    return torch.stack(out_batch)
+
+
+def timeit(fn, device):
+    with torch.no_grad():
+        for i in range(p.num_warmup + p.num_iters):
+            if i == p.num_warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / p.num_iters * 1000, out
+
+
+def benchmark(batch_size, device):
+    conv = GCNConv(p.in_channels, p.out_channels).to(device)
+    graph_edges, edge_weights = build_st_graph(np.random.rand(batch_size, p.n_obj, 6) * 100)
+    # the complete graph shared by the batch, with the per-sample edge weights of a frame
+    edge_index = torch.from_numpy(graph_edges).long().unsqueeze(0).repeat(batch_size, 1, 1).to(device)  # B x 2 x 171
+    edge_weight = torch.from_numpy(edge_weights).float().to(device)  # B x 171
+    x = torch.randn(batch_size, p.n_obj, p.in_channels, device=device)
+    time_loop, out_loop = timeit(lambda: loop_forward(conv, x, edge_index, edge_weight), device)
+    time_batched, out_batched = timeit(lambda: conv(x, edge_index, edge_weight), device)
+    return time_loop, time_batched, (out_loop - out_batched).abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the batched GCNConv against the former per-sample loop.')
+    parser.add_argument('--batch_sizes', type=str, default='1,4,16,64',
+                        help='The delimited list of the batch sizes. Default: 1,4,16,64')
+    parser.add_argument('--n_obj', type=int, default=19,
+                        help='The number of objects per frame. Default: 19')
+    parser.add_argument('--in_channels', type=int, default=512,
+                        help='The dimension of the input node features. Default: 512')
+    parser.add_argument('--out_channels', type=int, default=256,
+                        help='The dimension of the output node features. Default: 256')
+    parser.add_argument('--num_warmup', type=int, default=5,
+                        help='The number of warm-up iterations. Default: 5')
+    parser.add_argument('--num_iters', type=int, default=50,
+                        help='The number of timed iterations. Default: 50')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    print('%-8s %12s %12s %10s %12s' % ('batch', 'loop (ms)', 'batched (ms)', 'speedup', 'max diff'))
+    for batch_size in [int(b) for b in p.batch_sizes.split(',')]:
+        time_loop, time_batched, diff = benchmark(batch_size, device)
+        print('%-8d %12.3f %12.3f %10.2f %12.2e' % (batch_size, time_loop, time_batched, time_loop / time_batched, diff))
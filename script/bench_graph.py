@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, time
+import argparse
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import UString
+from src.DataLoader import build_st_graph, collate_batch
+
+
+def random_batch(n_obj, knn):
+    # random boxes in a 1280 x 720 frame, the graph is built as by the datasets
+    samples = []
+    for _ in range(p.batch_size):
+        xy = np.random.rand(p.n_frames, n_obj, 2) * [1280, 720]
+        wh = np.random.rand(p.n_frames, n_obj, 2) * 100
+        detections = np.concatenate([xy, xy + wh, np.random.rand(p.n_frames, n_obj, 2)], axis=-1).astype(np.float32)
+        graph_edges, edge_weights = build_st_graph(detections, knn=knn)
+        features = np.random.rand(p.n_frames, n_obj + 1, p.dim_feature).astype(np.float32)
+        node_mask = np.ones((p.n_frames, n_obj), dtype=bool)
+        samples.append((features, np.array([0, 1]), graph_edges, edge_weights, np.array([p.n_frames / 2.0]), node_mask))
+    return collate_batch(samples), graph_edges.shape[-1]
+
+
+def benchmark(n_obj, knn, device):
+    model = UString(p.dim_feature, p.hidden_dim, p.latent_dim, n_layers=p.num_rnn, n_obj=n_obj, n_frames=p.n_frames,
+                    with_saa=True, uncertain_ranking=True, graph_knn=min(knn, n_obj - 1) if knn is not None else None)
+    model = model.to(device=device)
+    model.eval()
+    batch, num_edges = random_batch(n_obj, knn)
+    batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = [data.to(device) for data in batch[:7]]
+    with torch.no_grad():
+        for i in range(p.num_warmup + p.num_iters):
+            if i == p.num_warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            model(batch_xs, batch_ys, batch_toas.view(-1), graph_edges, edge_weights=edge_weights, npass=p.npass, node_mask=node_masks)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return num_edges, p.batch_size * p.num_iters / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of UString with complete and kNN object graphs.')
+    parser.add_argument('--n_objs', type=str, default='10,19,40,80,160',
+                        help='The delimited list of the numbers of objects per frame. Default: 10,19,40,80,160')
+    parser.add_argument('--knns', type=str, default='4,8',
+                        help='The delimited list of the numbers of neighbours of the kNN graphs. Default: 4,8')
+    parser.add_argument('--n_frames', type=int, default=100,
+                        help='The number of frames of each video. Default: 100')
+    parser.add_argument('--dim_feature', type=int, default=4096,
+                        help='The dimension of the features. Default: 4096')
+    parser.add_argument('--hidden_dim', type=int, default=256,
+                        help='The dimension of hidden states in RNN. Default: 256')
+    parser.add_argument('--latent_dim', type=int, default=256,
+                        help='The dimension of latent space. Default: 256')
+    parser.add_argument('--num_rnn', type=int, default=1,
+                        help='The number of RNN cells for each timestamp. Default: 1')
+    parser.add_argument('--batch_size', type=int, default=10,
+                        help='The batch size. Default: 10')
+    parser.add_argument('--npass', type=int, default=2,
+                        help='The number of MC passes of the Bayesian predictor. Default: 2')
+    parser.add_argument('--num_warmup', type=int, default=1,
+                        help='The number of warm-up iterations. Default: 1')
+    parser.add_argument('--num_iters', type=int, default=3,
+                        help='The number of timed iterations. Default: 3')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    modes = [None] + [int(knn) for knn in p.knns.split(',')]
+    print('%-8s %-10s %10s %14s' % ('n_obj', 'graph', 'edges', 'videos / s'))
+    for n_obj in [int(n) for n in p.n_objs.split(',')]:
+        for knn in modes:
+            num_edges, throughput = benchmark(n_obj, knn, device)
+            print('%-8d %-10s %10d %14.2f' % (n_obj, 'complete' if knn is None else 'knn-%d' % (knn), num_edges, throughput))
@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, io
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import UString
+from src.DataLoader import DADDataset, A3DDataset, CrashDataset, collate_batch
+from src.quantize import quantize_features, load_features, dequantize, FEATURE_DTYPES
+from src.eval_tools import evaluation
+
+
+class QuantizedDataset(Dataset):
+    """ Round trip the features of a dataset through the storage dtype, as if they were saved with it.
+    """
+    def __init__(self, dataset, dtype, key='data'):
+        self.dataset = dataset
+        self.dtype = dtype
+        self.key = key
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        arrays = quantize_features(dequantize(sample[0]), self.dtype, key=self.key)
+        return (load_features(arrays, self.key),) + tuple(sample[1:])
+
+    def get_file_size(self, index):
+        # the size of the compressed .npz file with the features of the storage dtype
+        f = io.BytesIO()
+        np.savez_compressed(f, **quantize_features(dequantize(self.dataset[index][0]), self.dtype, key=self.key))
+        return len(f.getvalue())
+
+
+def run_inference(model, dataset, device):
+    loader = DataLoader(dataset, batch_size=p.batch_size, shuffle=False, drop_last=False, num_workers=p.num_workers, collate_fn=collate_batch)
+    all_pred, all_labels, all_toas = [], [], []
+    # the same MC samples of the Bayesian predictor for all dtypes
+    torch.manual_seed(p.seed)
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=dataset.dtype):
+            batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks = [data.to(device) for data in batch[:7]]
+            _, all_outputs, _ = model(batch_xs, batch_ys, batch_toas, graph_edges, edge_weights=edge_weights, npass=10, lengths=batch_lens, node_mask=node_masks)
+            pred = torch.stack([output['pred_mean'] for output in all_outputs], dim=1)  # B x T x 2
+            all_pred.append(torch.softmax(pred, dim=-1)[:, :, 1].cpu().numpy())
+            all_labels.append(batch_ys[:, 1].cpu().numpy())
+            all_toas.append(batch_toas.view(-1).cpu().numpy().astype(np.int64))
+    return np.vstack(all_pred), np.hstack(all_labels), np.hstack(all_toas)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the accuracy and the size of reduced-precision features.')
+    parser.add_argument('--data_path', type=str, default='./data',
+                        help='The relative path of dataset.')
+    parser.add_argument('--dataset', type=str, default='dad', choices=['a3d', 'dad', 'crash'],
+                        help='The name of dataset. Default: dad')
+    parser.add_argument('--feature_name', type=str, default='vgg16', choices=['vgg16', 'res101'],
+                        help='The name of feature embedding methods. Default: vgg16')
+    parser.add_argument('--model_file', type=str, required=True,
+                        help='The trained UString model file.')
+    parser.add_argument('--dtypes', type=str, default='float32,float16,int8',
+                        help='The delimited list of feature dtypes to compare. Default: float32,float16,int8')
+    parser.add_argument('--hidden_dim', type=int, default=256,
+                        help='The dimension of hidden states in RNN. Default: 256')
+    parser.add_argument('--latent_dim', type=int, default=256,
+                        help='The dimension of latent space. Default: 256')
+    parser.add_argument('--num_rnn', type=int, default=1,
+                        help='The number of RNN cells for each timestamp. Default: 1')
+    parser.add_argument('--batch_size', type=int, default=10,
+                        help='The batch size in testing. Default: 10')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='The number of worker processes of the data loader. Default: 0')
+    parser.add_argument('--num_size_samples', type=int, default=20,
+                        help='The number of videos to measure the compressed file sizes. Default: 20')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='The random seed of the MC sampling. Default: 123')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    data_path = os.path.join(p.data_path, p.dataset)
+    if p.dataset == 'dad':
+        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=False, device=device)
+    elif p.dataset == 'a3d':
+        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=False, device=device)
+    else:
+        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=False, device=device)
+    key = 'features' if p.dataset == 'a3d' else 'data'
+
+    model = UString(test_data.dim_feature, p.hidden_dim, p.latent_dim, n_layers=p.num_rnn, n_obj=test_data.n_obj,
+                    n_frames=test_data.n_frames, fps=test_data.fps, with_saa=True, uncertain_ranking=True)
+    model.load_state_dict(torch.load(p.model_file, map_location=device)['model'])
+    model = model.to(device=device)
+    model.eval()
+
+    results = []
+    for dtype in p.dtypes.split(','):
+        dataset = QuantizedDataset(test_data, dtype, key=key)
+        all_pred, all_labels, all_toas = run_inference(model, dataset, device)
+        AP, mTTA, TTA_R80 = evaluation(all_pred, all_labels, all_toas, fps=test_data.fps)
+        file_size = np.mean([dataset.get_file_size(index) for index in range(min(p.num_size_samples, len(dataset)))])
+        results.append((dtype, file_size, AP, mTTA, TTA_R80))
+
+    print('%-8s %12s %8s %8s %8s %8s' % ('dtype', 'size (MB)', 'I/O', 'AP', 'mTTA', 'TTA_R80'))
+    base = results[0]
+    for dtype, file_size, AP, mTTA, TTA_R80 in results:
+        print('%-8s %12.3f %7.2fx %8.4f %8.4f %8.4f' % (dtype, file_size / 1024.0**2, base[1] / file_size, AP, mTTA, TTA_R80))
+        print('%-8s %12s %8s %+8.4f %+8.4f %+8.4f' % ('', '', '', AP - base[2], mTTA - base[3], TTA_R80 - base[4]))
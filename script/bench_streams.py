@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, time
+import argparse
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import UString
+from src.stream_runtime import StreamRuntime
+
+
+def random_frame(rng):
+    # random boxes in a 1280 x 720 frame with their features, as in bench_graph.py
+    xy = rng.rand(p.n_obj, 2) * [1280, 720]
+    detections = np.concatenate([xy, xy + rng.rand(p.n_obj, 2) * 100, rng.rand(p.n_obj, 2)], axis=-1).astype(np.float32)
+    features = rng.rand(p.n_obj + 1, p.dim_feature).astype(np.float32)
+    node_mask = np.arange(p.n_obj) < rng.randint(1, p.n_obj + 1)
+    return features, detections, node_mask
+
+
+def simulate(runtime, rng):
+    """ Streams of random rates join at random times, and leave after n_frames frames.
+    """
+    fps = rng.uniform(p.min_fps, p.max_fps, p.num_streams)
+    join_time = rng.uniform(0, p.duration / 2, p.num_streams)
+    next_time, joined, finished = join_time.copy(), set(), {}
+    num_scored, start = 0, time.time()
+    while len(finished) < p.num_streams and time.time() - start < p.duration:
+        now = time.time() - start
+        for s in range(p.num_streams):
+            if s in finished or now < next_time[s]:
+                continue
+            if s not in joined:
+                if len(runtime.free_slots) == 0:
+                    continue  # the stream waits for a free slot
+                runtime.join(s)
+                joined.add(s)
+            # the frames which have arrived since the last tick
+            while next_time[s] <= now and runtime.num_frames[s] + len(runtime.pending[s]) < p.n_frames:
+                runtime.push(s, *random_frame(rng))
+                next_time[s] += 1.0 / fps[s]
+        outputs = runtime.tick()
+        num_scored += len(outputs)
+        for s in list(outputs):
+            if runtime.num_frames[s] == p.n_frames:
+                finished[s] = dict(runtime.leave(s), fps=fps[s])
+        if len(outputs) == 0:
+            time.sleep(0.001)
+    return finished, num_scored / (time.time() - start), runtime.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate live streams of different rates on the continuous batching runtime.')
+    parser.add_argument('--num_streams', type=int, default=64,
+                        help='The number of streams. Default: 64')
+    parser.add_argument('--capacity', type=int, default=64,
+                        help='The number of slots of the hidden-state pool. Default: 64')
+    parser.add_argument('--max_batch_size', type=int, default=None,
+                        help='The maximum number of streams per tick, the capacity if not given. Default: None')
+    parser.add_argument('--min_fps', type=float, default=5.0,
+                        help='The minimum frame rate of the streams. Default: 5.0')
+    parser.add_argument('--max_fps', type=float, default=20.0,
+                        help='The maximum frame rate of the streams. Default: 20.0')
+    parser.add_argument('--n_frames', type=int, default=50,
+                        help='The number of frames of each stream. Default: 50')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='The maximum duration of the simulation in seconds. Default: 60.0')
+    parser.add_argument('--n_obj', type=int, default=19,
+                        help='The number of objects per frame. Default: 19')
+    parser.add_argument('--dim_feature', type=int, default=4096,
+                        help='The dimension of the features. Default: 4096')
+    parser.add_argument('--hidden_dim', type=int, default=256,
+                        help='The dimension of hidden states in RNN. Default: 256')
+    parser.add_argument('--latent_dim', type=int, default=256,
+                        help='The dimension of latent space. Default: 256')
+    parser.add_argument('--npass', type=int, default=10,
+                        help='The number of MC passes of the Bayesian predictor. Default: 10')
+    parser.add_argument('--model_file', type=str, default=None,
+                        help='The trained UString model file, the model is initialized randomly if not given. Default: None')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='The random seed. Default: 123')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    torch.manual_seed(p.seed)
+    model = UString(p.dim_feature, p.hidden_dim, p.latent_dim, n_obj=p.n_obj, n_frames=p.n_frames)
+    if p.model_file is not None:
+        model.load_state_dict(torch.load(p.model_file, map_location=device)['model'])
+    runtime = StreamRuntime(model, capacity=p.capacity, max_batch_size=p.max_batch_size, npass=p.npass, device=device)
+    finished, throughput, stats = simulate(runtime, np.random.RandomState(p.seed))
+
+    print('%-8s %8s %8s %12s %12s %12s' % ('stream', 'fps', 'frames', 'mean (ms)', 'p50 (ms)', 'p99 (ms)'))
+    for s in sorted(finished):
+        r = finished[s]
+        print('%-8d %8.2f %8d %12.2f %12.2f %12.2f' % (s, r['fps'], r['frames'], r['latency_mean'] * 1000, r['latency_p50'] * 1000, r['latency_p99'] * 1000))
+    print('finished streams: %d / %d, frames / s: %.2f, ticks: %d, mean batch size: %.2f, occupancy: %.2f' % (
+        len(finished), p.num_streams, throughput, stats['ticks'], stats['batch_size'], stats['occupancy']))
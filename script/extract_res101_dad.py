@@ -13,6 +13,9 @@ import torch.nn as nn
 from torchvision import models, transforms
 from torch.autograd import Variable
 from PIL import Image
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from src.quantize import quantize_features, FEATURE_DTYPES
+from src.rois import pack_rois, pack_detections
 
 CLASSES = ('__background__', 'Car', 'Pedestrian', 'Cyclist')
 
@@ -50,6 +53,7 @@ def parse_args():
     parser.add_argument('--n_frames', dest='n_frames', help='The number of frames sampled from each video', default=100)
     parser.add_argument('--n_boxes', dest='n_boxes', help='The number of bounding boxes for each frame', default=19)
     parser.add_argument('--dim_feat', dest='dim_feat', help='The dimension of extracted ResNet101 features', default=2048)
+    parser.add_argument('--feature_dtype', dest='feature_dtype', help='The dtype of the saved features', default='float32', choices=FEATURE_DTYPES)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -88,8 +92,9 @@ def bbox_to_imroi(bboxes, image):
 
 
 def get_boxes(dets_all, im_size):
-    bboxes = []
-    for bbox in dets_all:
+    # the non-empty boxes and their indices in dets_all
+    bboxes, keep = [], []
+    for k, bbox in enumerate(dets_all):
         x1, y1, x2, y2 = bbox[:4].astype(np.int32)
         x1 = min(max(0, x1), im_size[1]-1)  # 0<=x1<=W-1
         y1 = min(max(0, y1), im_size[0]-1)  # 0<=y1<=H-1
@@ -99,8 +104,9 @@ def get_boxes(dets_all, im_size):
         w = x2 - x1 + 1
         if h > 2 and w > 2:  # the area is at least 9
             bboxes.append([x1, y1, x2, y2])
+            keep.append(k)
     bboxes = np.array(bboxes, dtype=np.int32)
-    return bboxes
+    return bboxes, np.array(keep, dtype=np.int64)
 
 
 def extract_features(data_path, video_path, dest_path, phase):
@@ -131,9 +137,14 @@ def extract_features(data_path, video_path, dest_path, phase):
             video_frames = get_video_frames(video_file, n_frames=args.n_frames)
             # start to process each frame
             features_res101 = np.zeros((args.n_frames, args.n_boxes + 1, args.dim_feat), dtype=np.float32)  # (100 x 20 x 2048)
+            dets_res101 = np.zeros((args.n_frames, args.n_boxes, 6), dtype=detections.dtype)  # (100 x 19 x 6)
+            num_boxes = np.zeros((args.n_frames,), dtype=np.int32)
             for j, frame in tqdm(enumerate(video_frames), desc="The %d-th video"%(i+1), total=len(video_frames)):
                 # find the non-empty boxes
-                bboxes = get_boxes(detections[i, j], frame.shape)  # n x 4
+                bboxes, keep = get_boxes(detections[i, j], frame.shape)  # n x 4
+                # the empty boxes are dropped (and masked) rather than kept as zero features
+                num_boxes[j] = len(bboxes)
+                dets_res101[j, :len(bboxes)] = detections[i, j, keep]
                 frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
                 with torch.no_grad():
                     # extract image feature
@@ -148,8 +159,9 @@ def extract_features(data_path, video_path, dest_path, phase):
                         ims_roi = ims_roi.float().to(device=device)
                         feature_roi = torch.squeeze(torch.squeeze(feat_extractor(ims_roi), dim=-1), dim=-1)  # (2048,)
                         features_res101[j, 1:len(bboxes)+1,:] = feature_roi.cpu().numpy() if feature_roi.is_cuda else feature_roi.detach().numpy()
-            # we only update the features
-            np.savez_compressed(feat_file, data=features_res101, det=detections[i], labels=labels[i], ID=vidname)
+            # we only update the features, only the real boxes are stored
+            np.savez_compressed(feat_file, det=pack_detections(dets_res101, num_boxes), num_boxes=num_boxes, labels=labels[i], ID=vidname,
+                                **quantize_features(pack_rois(features_res101, num_boxes), args.feature_dtype))
             files_list.append(vidname)
         batch_id += 1
     return files_list
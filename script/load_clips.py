@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, sys, io, time, glob
+import json
+import asyncio
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def random_clip(rng):
+    # a feature file of random boxes in a 1280 x 720 frame, as written by demo.py without the quantization
+    num_boxes = rng.randint(1, p.n_obj + 1, size=p.n_frames)
+    xy = rng.rand(p.n_frames, p.n_obj, 2) * [1280, 720]
+    detections = np.concatenate([xy, xy + rng.rand(p.n_frames, p.n_obj, 2) * 100, rng.rand(p.n_frames, p.n_obj, 2)], axis=-1)
+    features = rng.rand(p.n_frames, p.n_obj + 1, p.dim_feature).astype(np.float32)
+    from src.rois import pack_rois, pack_detections
+    buf = io.BytesIO()
+    np.savez(buf, data=pack_rois(features, num_boxes), det=pack_detections(detections, num_boxes), num_boxes=num_boxes)
+    return buf.getvalue()
+
+
+async def request(reader, writer, method, path, body=b''):
+    writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n' % (method, path, p.host, len(body))).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b'\r\n', b'\n', b'']:
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    result = json.loads(await reader.readexactly(int(headers['content-length'])))
+    assert status == 200, result
+    return result
+
+
+async def client(clips, counter, latencies, batch_sizes):
+    # a closed-loop client on a keep-alive connection, the next request is sent once the previous one is answered
+    reader, writer = await asyncio.open_connection(p.host, p.port)
+    while counter[0] < p.num_requests:
+        clip = clips[counter[0] % len(clips)]
+        counter[0] += 1
+        start = time.time()
+        result = await request(reader, writer, 'POST', '/score', clip)
+        latencies.append(time.time() - start)
+        batch_sizes.append(result['batch_size'])
+    writer.close()
+
+
+async def run(clips):
+    counter, latencies, batch_sizes = [0], [], []
+    # warm up
+    reader, writer = await asyncio.open_connection(p.host, p.port)
+    await request(reader, writer, 'POST', '/score', clips[0])
+    writer.close()
+    start = time.time()
+    await asyncio.gather(*[client(clips, counter, latencies, batch_sizes) for _ in range(p.concurrency)])
+    return np.array(latencies), np.array(batch_sizes), time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the clip scoring service of src/serve.py.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The host of the service. Default: 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='The port of the service. Default: 8000')
+    parser.add_argument('--feature_files', type=str, default=None,
+                        help='The glob pattern of the feature files to send, random clips if not given. Default: None')
+    parser.add_argument('--num_requests', type=int, default=200,
+                        help='The total number of requests. Default: 200')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='The number of concurrent clients. Default: 16')
+    parser.add_argument('--num_clips', type=int, default=8,
+                        help='The number of distinct random clips. Default: 8')
+    parser.add_argument('--n_frames', type=int, default=50,
+                        help='The number of frames of the random clips. Default: 50')
+    parser.add_argument('--n_obj', type=int, default=19,
+                        help='The number of objects per frame of the random clips. Default: 19')
+    parser.add_argument('--dim_feature', type=int, default=4096,
+                        help='The dimension of the features of the random clips. Default: 4096')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='The random seed of the random clips. Default: 123')
+    p = parser.parse_args()
+
+    if p.feature_files is not None:
+        clips = []
+        for filename in sorted(glob.glob(p.feature_files)):
+            with open(filename, 'rb') as f:
+                clips.append(f.read())
+        assert len(clips) > 0, "No feature file matches: %s"%(p.feature_files)
+    else:
+        rng = np.random.RandomState(p.seed)
+        clips = [random_clip(rng) for _ in range(p.num_clips)]
+
+    latencies, batch_sizes, elapsed = asyncio.run(run(clips))
+    print('requests: %d, concurrency: %d' % (len(latencies), p.concurrency))
+    print('latency (ms): mean %.2f, p50 %.2f, p99 %.2f' % (np.mean(latencies) * 1000, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+    print('throughput: %.2f clips / s, mean batch size: %.2f' % (len(latencies) / elapsed, np.mean(batch_sizes)))
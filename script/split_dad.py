@@ -1,7 +1,9 @@
-import os
+import os, sys
 import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.quantize import quantize_features
 
-def process(data_path, dest_path, phase):
+def process(data_path, dest_path, phase, dtype='float32'):
     files_list = []
     batch_id = 1
     for filename in sorted(os.listdir(os.path.join(data_path, phase))):
@@ -20,13 +22,13 @@ def process(data_path, dest_path, phase):
             feat_file = os.path.join(dest_path, vidname + '.npz')
             if os.path.exists(feat_file):
                 continue
-            np.savez_compressed(feat_file, data=features[i], labels=labels[i], det=detections[i], ID=vidname)
+            np.savez_compressed(feat_file, labels=labels[i], det=detections[i], ID=vidname, **quantize_features(features[i], dtype))
             print('batch: %03d, %s file: %s' % (batch_id, phase, vidname))
             files_list.append(vidname)
         batch_id += 1
     return files_list
 
-def split_dad(data_path, dest_path):
+def split_dad(data_path, dest_path, dtype='float32'):
     # prepare the result paths
     train_path = os.path.join(dest_path, 'training')
     if not os.path.exists(train_path):
@@ -36,13 +38,14 @@ def split_dad(data_path, dest_path):
         os.makedirs(test_path)
 
     # process training set
-    train_list = process(data_path, train_path, 'training')
+    train_list = process(data_path, train_path, 'training', dtype)
     print('Training samples: %d'%(len(train_list)))
     # process testing set
-    test_list = process(data_path, test_path, 'testing')
+    test_list = process(data_path, test_path, 'testing', dtype)
     print('Testing samples: %d' % (len(test_list)))
 
 if __name__ == '__main__':
     DAD_PATH = '/data/DAD/features'
     DEST_PATH = '/data/DAD/features_split'
-    split_dad(DAD_PATH, DEST_PATH)
+    FEATURE_DTYPE = 'float32'  # or 'float16', 'int8' (with per-node scales)
+    split_dad(DAD_PATH, DEST_PATH, FEATURE_DTYPE)
@@ -14,8 +14,10 @@ class Gaussian(object):
     def sigma(self):
         return torch.log1p(torch.exp(self.rho))
     
-    def sample(self):
-        epsilon = self.normal.sample(self.rho.size()).to(self.mu.device)
+    def sample(self, npass=None):
+        # npass x (mu size) if npass is given, the samples of all passes at once
+        size = self.rho.size() if npass is None else (npass,) + self.rho.size()
+        epsilon = torch.randn(size, dtype=self.mu.dtype, device=self.mu.device)
         return self.mu + self.sigma * epsilon
     
     def log_prob(self, input):
@@ -40,10 +42,15 @@ class ScaleMixtureGaussian(object):
         
         
 class BayesianLinear(nn.Module):
-    def __init__(self, in_features, out_features, pi=0.5, sigma_1=None, sigma_2=None):
+    def __init__(self, in_features, out_features, pi=0.5, sigma_1=None, sigma_2=None, local_reparam=False):
+        """
+        :param local_reparam: if True, the pre-activations are sampled from their Gaussian instead of the weights
+                              (local reparameterization), so that only B x out noise values are drawn per pass
+        """
         super().__init__()
         self.in_features = in_features
         self.out_features = out_features
+        self.local_reparam = local_reparam
         if sigma_1 is None or sigma_2 is None:
             sigma_1 = torch.FloatTensor([math.exp(-0)])
             sigma_2 = torch.FloatTensor([math.exp(-6)])
@@ -62,18 +69,50 @@ class BayesianLinear(nn.Module):
         self.log_prior = 0
         self.log_variational_posterior = 0
 
-    def forward(self, input, sample=False, calculate_log_probs=False):
+    def forward(self, input, sample=False, calculate_log_probs=None, npass=None):
+        """
+        :param calculate_log_probs: whether the log prior and posterior are computed, by default only during training
+        :param npass: if given, the weights of npass Monte-Carlo passes are sampled at once and evaluated by a batched matmul,
+                      input is B x in (shared by the passes) or npass x B x in, the output is npass x B x out,
+                      and the log probabilities are the means over the passes
+        """
+        if self.local_reparam and (self.training or sample):
+            return self.forward_local(input, calculate_log_probs=calculate_log_probs, npass=npass)
         if self.training or sample:
-            weight = self.weight.sample()
-            bias = self.bias.sample()
+            weight = self.weight.sample(npass)
+            bias = self.bias.sample(npass)
         else:
             weight = self.weight.mu
             bias = self.bias.mu
-        if self.training or calculate_log_probs:
+        if calculate_log_probs is None:
+            calculate_log_probs = self.training
+        if calculate_log_probs:
+            # the log probabilities are sums over all entries, i.e., over the passes as well
+            num_samples = npass if npass is not None and weight.dim() == 3 else 1
+            self.log_prior = (self.weight_prior.log_prob(weight) + self.bias_prior.log_prob(bias)) / num_samples
+            self.log_variational_posterior = (self.weight.log_prob(weight) + self.bias.log_prob(bias)) / num_samples
+        else:
+            self.log_prior, self.log_variational_posterior = 0, 0
+
+        if npass is None:
+            return F.linear(input, weight, bias)
+        return torch.matmul(input, weight.transpose(-1, -2)) + bias.unsqueeze(-2)
+
+    def forward_local(self, input, calculate_log_probs=None, npass=None):
+        """ Local reparameterization, the pre-activations are Gaussian with the mean x.mu and the variance x^2.sigma^2.
+        The weights are not sampled for the outputs, the log probabilities (during training) are estimated
+        with a single weight sample, which is shared by all passes.
+        """
+        act_mu = F.linear(input, self.weight_mu, self.bias_mu)  # B x out
+        act_var = F.linear(input ** 2, self.weight.sigma ** 2, self.bias.sigma ** 2)  # B x out
+        size = act_mu.size() if npass is None or input.dim() == 3 else (npass,) + act_mu.size()
+        epsilon = torch.randn(size, dtype=act_mu.dtype, device=act_mu.device)
+        if calculate_log_probs is None:
+            calculate_log_probs = self.training
+        if calculate_log_probs:
+            weight, bias = self.weight.sample(), self.bias.sample()
             self.log_prior = self.weight_prior.log_prob(weight) + self.bias_prior.log_prob(bias)
             self.log_variational_posterior = self.weight.log_prob(weight) + self.bias.log_prob(bias)
         else:
             self.log_prior, self.log_variational_posterior = 0, 0
-
-        return F.linear(input, weight, bias)
-        
\ No newline at end of file
+        return act_mu + torch.sqrt(act_var) * epsilon
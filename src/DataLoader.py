@@ -5,27 +5,43 @@ from __future__ import print_function
 import os
 import numpy as np
 import pickle
+import zipfile
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import networkx
 import itertools
+from src.graph_cache import GraphCache, detection_hash
+from src.feature_store import FeatureStore
+from src.anno_index import load_anno_index, list_files
+from src.quantize import QuantizedArray, dequantize
+from src.verify import manifest_file, load_manifest, apply_manifest
+from src.rois import load_rois, load_detections, read_node_mask, slice_frames
 
 
 class DADDataset(Dataset):
-    def __init__(self, data_path, feature, phase='training', toTensor=False, device=torch.device('cuda'), vis=False):
+    def __init__(self, data_path, feature, phase='training', toTensor=False, device=torch.device('cuda'), vis=False, graph_cache=None, feature_store=None, sample_cache=None, manifest=None, graph_knn=None, graph_radius=None):
         self.data_path = os.path.join(data_path, feature + '_features')
         self.feature = feature
         self.phase = phase
         self.toTensor = toTensor
         self.device = device
         self.vis = vis
+        self.graph_cache = GraphCache(graph_cache) if graph_cache is not None else None
+        self.feature_store = FeatureStore(feature_store) if feature_store is not None else None
+        self.sample_cache = sample_cache
+        self.manifest = None
+        self.graph_knn = graph_knn
+        self.graph_radius = graph_radius
         self.n_frames = 100
         self.n_obj = 19
         self.fps = 20.0
         self.dim_feature = self.get_feature_dim(feature)
 
         filepath = os.path.join(self.data_path, phase)
-        self.files_list = self.get_filelist(filepath)
+        self.files_list = self.get_filelist(filepath) if self.feature_store is None else self.get_store_filelist(phase)
+        if manifest is not None:
+            # only the verified samples are used, and their files are trusted to exist
+            apply_manifest(self, load_manifest(manifest_file(manifest, 'dad', feature, phase)))
 
     def __len__(self):
         data_len = len(self.files_list)
@@ -46,51 +62,106 @@ class DADDataset(Dataset):
             file_list.append(filename)
         return file_list
 
+    def get_store_filelist(self, phase):
+        file_list = [key.split('/')[1] for key in self.feature_store.samples if key.split('/')[0] == phase]
+        assert len(file_list) > 0, "Phase does not exist in the feature store: %s"%(phase)
+        return sorted(file_list)
+
     def __getitem__(self, index):
+        return get_sample(self, index)
+
+    def load_sample(self, index, window=None):
+        """
+        :param: window: (start, end), only these frames are read and graphed, None for the whole video
+        """
         data_file = os.path.join(self.data_path, self.phase, self.files_list[index])
-        assert os.path.exists(data_file)
         try:
-            data = np.load(data_file)
-            features = data['data']  # 100 x 20 x 4096
+            data = self.load_data(index)
+            if window is not None:
+                data = slice_frames(data, window[0], window[1], 'data')
+            features, node_mask = load_rois(data, 'data', self.n_obj)  # 100 x 20 x 4096, 100 x 19
             labels = data['labels']  # 2
-            detections = data['det']  # 100 x 19 x 6
+            detections = load_detections(data, self.n_obj)  # 100 x 19 x 6
         except:
             raise IOError('Load data error! File: %s'%(data_file))
+        graph_edges, edge_weights, toa, labels = self.load_graph(index, inputs=(detections, self.get_toa(labels), labels, node_mask), window=window)
+
+        if self.vis:
+            video_id = str(data['ID'])[5:11]  # e.g.: b001_000490_*
+            return features, labels, graph_edges, edge_weights, toa, node_mask, detections, video_id
+        else:
+            return features, labels, graph_edges, edge_weights, toa, node_mask
+
+    def load_data(self, index):
+        if self.feature_store is not None:
+            return self.feature_store[os.path.join(self.phase, self.files_list[index])]
+        data_file = os.path.join(self.data_path, self.phase, self.files_list[index])
+        if self.manifest is None:
+            assert os.path.exists(data_file)
+        return np.load(data_file)
+
+    def get_data_file(self, index):
+        return os.path.join(self.data_path, self.phase, self.files_list[index])
+
+    def get_num_frames(self, index):
+        return read_num_frames(self, index, 'data')
+
+    def get_sample_files(self, index):
+        # all files a sample is read from
+        return [self.feature_store.index_file if self.feature_store is not None else self.get_data_file(index)]
+
+    def get_toa(self, labels):
         if labels[1] > 0:
             toa = [90.0]
         else:
             toa = [self.n_frames + 1]
-        
-        graph_edges, edge_weights = generate_st_graph(detections)
+        return toa
 
-        if self.toTensor:
-            features = torch.Tensor(features).to(self.device)         #  100 x 20 x 4096
-            labels = torch.Tensor(labels).to(self.device)
-            graph_edges = torch.Tensor(graph_edges).long().to(self.device)
-            edge_weights = torch.Tensor(edge_weights).to(self.device)
-            toa = torch.Tensor(toa).to(self.device)
+    def load_graph(self, index, inputs=None, window=None, verify=False):
+        data_file = os.path.join(self.data_path, self.phase, self.files_list[index])
 
-        if self.vis:
-            video_id = str(data['ID'])[5:11]  # e.g.: b001_000490_*
-            return features, labels, graph_edges, edge_weights, toa, detections, video_id
-        else:
-            return features, labels, graph_edges, edge_weights, toa
+        def load_inputs():
+            if inputs is not None:
+                return inputs
+            data = self.load_data(index)
+            if window is not None:
+                data = slice_frames(data, window[0], window[1], 'data')
+            return load_detections(data, self.n_obj), self.get_toa(data['labels']), data['labels'], read_node_mask(data, self.n_obj)
+        src_files = [self.feature_store.index_file if self.feature_store is not None else data_file]
+        return load_st_graph(self.graph_cache, data_file, src_files, load_inputs,
+                             knn=self.graph_knn, radius=self.graph_radius, window=window, verify=verify)
 
 
 class A3DDataset(Dataset):
-    def __init__(self, data_path, feature, phase='train', toTensor=False, device=torch.device('cuda'), vis=False):
+    def __init__(self, data_path, feature, phase='train', toTensor=False, device=torch.device('cuda'), vis=False, graph_cache=None, feature_store=None, sample_cache=None, anno_index=None, manifest=None, graph_knn=None, graph_radius=None):
         self.data_path = data_path
         self.feature = feature
         self.phase = phase
         self.toTensor = toTensor
         self.device = device
         self.vis = vis
+        self.graph_cache = GraphCache(graph_cache) if graph_cache is not None else None
+        self.feature_store = FeatureStore(feature_store) if feature_store is not None else None
+        self.sample_cache = sample_cache
+        self.manifest = None
+        self.graph_knn = graph_knn
+        self.graph_radius = graph_radius
         self.n_frames = 100
         self.n_obj = 19
         self.fps = 20.0
         self.dim_feature = self.get_feature_dim(feature)
 
-        self.files_list, self.labels_list = self.read_datalist(data_path, phase)
+        self.anno_file, self.anno = None, None
+        if anno_index is not None:
+            # labels, time-of-accidents and detections are read from the compiled index
+            self.anno_file = os.path.join(anno_index, 'a3d_%s_%s.npz' % (feature, phase))
+            self.anno = load_anno_index(self.anno_file, self.get_anno_sources(), self.compile_annotations)
+            self.files_list, self.labels_list = self.anno['files'].tolist(), self.anno['labels'].tolist()
+        else:
+            self.files_list, self.labels_list = self.read_datalist(data_path, phase)
+        if manifest is not None:
+            # only the verified samples are used, and their files are trusted to exist
+            apply_manifest(self, load_manifest(manifest_file(manifest, 'a3d', feature, phase)))
 
     def __len__(self):
         data_len = len(self.files_list)
@@ -118,11 +189,35 @@ class A3DDataset(Dataset):
 
         return data_files, data_labels
 
-    def get_toa(self, clip_id):
+    def get_anno_sources(self):
+        list_file = os.path.join(self.data_path, self.feature + '_features', '%s.txt' % (self.phase))
+        dirs = [os.path.join(self.data_path, 'frame_labels'),
+                os.path.join(self.data_path, 'detections', 'positive'),
+                os.path.join(self.data_path, 'detections', 'negative')]
+        return [list_file] + list_files(dirs)
+
+    def compile_annotations(self):
+        print("Compiling the annotations of A3D %s set..."%(self.phase))
+        self.files_list, self.labels_list = self.read_datalist(self.data_path, self.phase)
+        toas, detections = [], []
+        for index, (filename, label) in enumerate(zip(self.files_list, self.labels_list)):
+            file_id = filename.split('/')[1].split('.npz')[0]
+            toas.append(self.get_toa(file_id) if label > 0 else self.n_frames + 1)
+            detections.append(self.load_detections(index))
+        return {'files': np.array(self.files_list),
+                'labels': np.array(self.labels_list, dtype=np.int64),
+                'toas': np.array(toas, dtype=np.float32),
+                'detections': np.stack(detections)}  # N x 100 x 19 x 6
+
+    def get_label_file(self, clip_id):
         # handle clip id like "uXXC8uQHCoc_000011_0" which should be "uXXC8uQHCoc_000011"
         clip_id = clip_id if len(clip_id.split('_')[-1]) > 1 else clip_id[:-2]
-        label_file = os.path.join(self.data_path, 'frame_labels', clip_id + '.txt')
-        assert os.path.exists(label_file)
+        return os.path.join(self.data_path, 'frame_labels', clip_id + '.txt')
+
+    def get_toa(self, clip_id):
+        label_file = self.get_label_file(clip_id)
+        if self.manifest is None:
+            assert os.path.exists(label_file)
         f = open(label_file, 'r')
         label_all = []
         for line in f.readlines():
@@ -135,59 +230,128 @@ class A3DDataset(Dataset):
         return toa
 
     def __getitem__(self, index):
-        data_file = os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
-        assert os.path.exists(data_file), "file not exists: %s"%(data_file)
-        data = np.load(data_file)
-        features = data['features']
-        label = self.labels_list[index]
-        label_onehot = np.array([0, 1]) if label > 0 else np.array([1, 0])
-        # get time of accident
-        file_id = self.files_list[index].split('/')[1].split('.npz')[0]
-        if label > 0:
-            toa = [self.get_toa(file_id)]
-        else:
-            toa = [self.n_frames + 1]
-
-        # construct graph
-        attr = 'positive' if label > 0 else 'negative'
-        dets_file = os.path.join(self.data_path, 'detections', attr, file_id + '.pkl')
-        assert os.path.exists(dets_file), "file not exists: %s"%(dets_file)
-        with open(dets_file, 'rb') as f:
-            detections = pickle.load(f)
-            detections = np.array(detections)  # 100 x 19 x 6
-            graph_edges, edge_weights = generate_st_graph(detections)
-        f.close()
+        return get_sample(self, index)
 
-        if self.toTensor:
-            features = torch.Tensor(features).to(self.device)          #  100 x 20 x 4096
-            label_onehot = torch.Tensor(label_onehot).to(self.device)  #  2
-            graph_edges = torch.Tensor(graph_edges).long().to(self.device)
-            edge_weights = torch.Tensor(edge_weights).to(self.device)
-            toa = torch.Tensor(toa).to(self.device)
+    def load_sample(self, index, window=None):
+        """
+        :param: window: (start, end), only these frames are read and graphed, None for the whole video
+        """
+        data = self.load_data(index)
+        if window is not None:
+            data = slice_frames(data, window[0], window[1], 'features')
+        features, node_mask = load_rois(data, 'features', self.n_obj)
+        file_id = self.files_list[index].split('/')[1].split('.npz')[0]
+        # detections are only needed for visualization if the graph is cached
+        detections = self.load_detections(index, window=window) if self.vis else None
+        # construct graph and get time of accident
+        graph_edges, edge_weights, toa, label_onehot = self.load_graph(index, detections=detections, node_mask=node_mask, window=window)
 
         if self.vis:
             # file_id = file_id if len(file_id.split('_')[-1]) > 1 else file_id[:-2]
             # video_path = os.path.join(self.data_path, 'video_frames', file_id, 'images')
             # assert os.path.exists(video_path), video_path
-            return features, label_onehot, graph_edges, edge_weights, toa, detections, file_id
+            return features, label_onehot, graph_edges, edge_weights, toa, node_mask, detections, file_id
+        else:
+            return features, label_onehot, graph_edges, edge_weights, toa, node_mask
+
+    def load_data(self, index):
+        if self.feature_store is not None:
+            return self.feature_store[self.files_list[index]]
+        data_file = os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
+        if self.manifest is None:
+            assert os.path.exists(data_file), "file not exists: %s"%(data_file)
+        return np.load(data_file)
+
+    def get_data_file(self, index):
+        return os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
+
+    def get_num_frames(self, index):
+        return read_num_frames(self, index, 'features')
+
+    def get_sample_files(self, index):
+        # all files a sample is read from
+        files = [self.feature_store.index_file if self.feature_store is not None else self.get_data_file(index)]
+        if self.anno is not None:
+            return files + [self.anno_file]
+        files.append(self.get_dets_file(index))
+        if self.labels_list[index] > 0:
+            files.append(self.get_label_file(self.files_list[index].split('/')[1].split('.npz')[0]))
+        return files
+
+    def get_dets_file(self, index):
+        attr = 'positive' if self.labels_list[index] > 0 else 'negative'
+        file_id = self.files_list[index].split('/')[1].split('.npz')[0]
+        return os.path.join(self.data_path, 'detections', attr, file_id + '.pkl')
+
+    def load_detections(self, index, window=None):
+        if self.anno is not None:
+            detections = self.anno['detections'][index]
         else:
-            return features, label_onehot, graph_edges, edge_weights, toa
+            dets_file = self.get_dets_file(index)
+            if self.manifest is None:
+                assert os.path.exists(dets_file), "file not exists: %s"%(dets_file)
+            with open(dets_file, 'rb') as f:
+                detections = pickle.load(f)
+                detections = np.array(detections)  # 100 x 19 x 6
+            f.close()
+        return detections[window[0]:window[1]] if window is not None else detections
+
+    def load_graph(self, index, detections=None, node_mask=None, window=None, verify=False):
+        data_file = self.get_data_file(index)
+        label = self.labels_list[index]
+        file_id = self.files_list[index].split('/')[1].split('.npz')[0]
+        # the node mask is read from the features, which are a source of the graph as well
+        src_files = self.get_sample_files(index)
+
+        def load_inputs():
+            dets = detections if detections is not None else self.load_detections(index, window=window)
+            label_onehot = np.array([0, 1]) if label > 0 else np.array([1, 0])
+            if self.anno is not None:
+                toa = [self.anno['toas'][index]]
+            elif label > 0:
+                toa = [self.get_toa(file_id)]
+            else:
+                toa = [self.n_frames + 1]
+            if node_mask is not None:
+                mask = node_mask
+            else:
+                data = self.load_data(index)
+                mask = read_node_mask(slice_frames(data, window[0], window[1], 'features') if window is not None else data, self.n_obj)
+            return dets, toa, label_onehot, mask
+        return load_st_graph(self.graph_cache, data_file, src_files, load_inputs,
+                             knn=self.graph_knn, radius=self.graph_radius, window=window, verify=verify)
 
 
 class CrashDataset(Dataset):
-    def __init__(self, data_path, feature, phase='train', toTensor=False, device=torch.device('cuda'), vis=False):
+    def __init__(self, data_path, feature, phase='train', toTensor=False, device=torch.device('cuda'), vis=False, graph_cache=None, feature_store=None, sample_cache=None, anno_index=None, manifest=None, graph_knn=None, graph_radius=None):
         self.data_path = data_path
         self.feature = feature
         self.phase = phase
         self.toTensor = toTensor
         self.device = device
         self.vis = vis
+        self.graph_cache = GraphCache(graph_cache) if graph_cache is not None else None
+        self.feature_store = FeatureStore(feature_store) if feature_store is not None else None
+        self.sample_cache = sample_cache
+        self.manifest = None
+        self.graph_knn = graph_knn
+        self.graph_radius = graph_radius
         self.n_frames = 50
         self.n_obj = 19
         self.fps = 10.0
         self.dim_feature = self.get_feature_dim(feature)
-        self.files_list, self.labels_list = self.read_datalist(data_path, phase)
-        self.toa_dict = self.get_toa_all(data_path)
+        if anno_index is not None:
+            # the file list and time-of-accidents are read from the compiled index
+            anno_file = os.path.join(anno_index, 'crash_%s_%s.npz' % (feature, phase))
+            anno = load_anno_index(anno_file, self.get_anno_sources(), self.compile_annotations)
+            self.files_list, self.labels_list = anno['files'].tolist(), anno['labels'].tolist()
+            self.toa_dict = dict(zip(anno['toa_vids'].tolist(), anno['toa_values'].tolist()))
+        else:
+            self.files_list, self.labels_list = self.read_datalist(data_path, phase)
+            self.toa_dict = self.get_toa_all(data_path)
+        if manifest is not None:
+            # only the verified samples are used, and their files are trusted to exist
+            apply_manifest(self, load_manifest(manifest_file(manifest, 'crash', feature, phase)))
 
     def __len__(self):
         data_len = len(self.files_list)
@@ -214,6 +378,19 @@ class CrashDataset(Dataset):
         fid.close()
         return data_files, data_labels
 
+    def get_anno_sources(self):
+        list_file = os.path.join(self.data_path, self.feature + '_features', '%s.txt' % (self.phase))
+        return [list_file, os.path.join(self.data_path, 'videos', 'Crash-1500.txt')]
+
+    def compile_annotations(self):
+        print("Compiling the annotations of CCD %s set..."%(self.phase))
+        files_list, labels_list = self.read_datalist(self.data_path, self.phase)
+        toa_dict = self.get_toa_all(self.data_path)
+        return {'files': np.array(files_list),
+                'labels': np.array(labels_list, dtype=np.int64),
+                'toa_vids': np.array(list(toa_dict.keys())),
+                'toa_values': np.array(list(toa_dict.values()), dtype=np.int64)}
+
     def get_toa_all(self, data_path):
         toa_dict = {}
         annofile = os.path.join(data_path, 'videos', 'Crash-1500.txt')
@@ -242,37 +419,224 @@ class CrashDataset(Dataset):
         return result
 
     def __getitem__(self, index):
+        return get_sample(self, index)
+
+    def load_sample(self, index, window=None):
+        """
+        :param: window: (start, end), only these frames are read and graphed, None for the whole video
+        """
         data_file = os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
-        assert os.path.exists(data_file), "file not exists: %s"%(data_file)
         try:
-            data = np.load(data_file)
-            features = data['data']  # 50 x 20 x 4096
+            data = self.load_data(index)
+            if window is not None:
+                data = slice_frames(data, window[0], window[1], 'data')
+            features, node_mask = load_rois(data, 'data', self.n_obj)  # 50 x 20 x 4096, 50 x 19
             labels = data['labels']  # 2
-            detections = data['det']  # 50 x 19 x 6
+            detections = load_detections(data, self.n_obj)  # 50 x 19 x 6
             vid = str(data['ID'])
         except:
             raise IOError('Load data error! File: %s'%(data_file))
+        graph_edges, edge_weights, toa, labels = self.load_graph(index, inputs=(detections, self.get_toa(labels, vid), labels, node_mask), window=window)
+
+        if self.vis:
+            return features, labels, graph_edges, edge_weights, toa, node_mask, detections, vid
+        else:
+            return features, labels, graph_edges, edge_weights, toa, node_mask
+
+    def load_data(self, index):
+        if self.feature_store is not None:
+            return self.feature_store[self.files_list[index]]
+        data_file = os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
+        if self.manifest is None:
+            assert os.path.exists(data_file), "file not exists: %s"%(data_file)
+        return np.load(data_file)
+
+    def get_data_file(self, index):
+        return os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
+
+    def get_num_frames(self, index):
+        return read_num_frames(self, index, 'data')
+
+    def get_sample_files(self, index):
+        # all files a sample is read from, the time-of-accidents are loaded beforehand
+        return [self.feature_store.index_file if self.feature_store is not None else self.get_data_file(index)]
+
+    def get_toa(self, labels, vid):
         if labels[1] > 0:
             toa = [self.toa_dict[vid]]
         else:
             toa = [self.n_frames + 1]
+        return toa
 
-        graph_edges, edge_weights = generate_st_graph(detections)
+    def load_graph(self, index, inputs=None, window=None, verify=False):
+        data_file = os.path.join(self.data_path, self.feature + '_features', self.files_list[index])
 
-        if self.toTensor:
-            features = torch.Tensor(features).to(self.device)         #  50 x 20 x 4096
-            labels = torch.Tensor(labels).to(self.device)
-            graph_edges = torch.Tensor(graph_edges).long().to(self.device)
-            edge_weights = torch.Tensor(edge_weights).to(self.device)
-            toa = torch.Tensor(toa).to(self.device)
+        def load_inputs():
+            if inputs is not None:
+                return inputs
+            data = self.load_data(index)
+            if window is not None:
+                data = slice_frames(data, window[0], window[1], 'data')
+            return load_detections(data, self.n_obj), self.get_toa(data['labels'], str(data['ID'])), data['labels'], read_node_mask(data, self.n_obj)
+        src_files = [self.feature_store.index_file if self.feature_store is not None else data_file]
+        return load_st_graph(self.graph_cache, data_file, src_files, load_inputs,
+                             knn=self.graph_knn, radius=self.graph_radius, window=window, verify=verify)
 
-        if self.vis:
-            return features, labels, graph_edges, edge_weights, toa, detections, vid
-        else:
-            return features, labels, graph_edges, edge_weights, toa
+
+def get_sample(dataset, index, window=None):
+    """ __getitem__ of all datasets: the sample is loaded on host, or fetched from the sample cache,
+    and then moved to the device if toTensor is set.
+    :param: window: (start, end), the frames of a window only, see WindowedDataset
+    :return: features, labels, graph_edges, edge_weights, toa, node_mask[, detections, video_id]
+    """
+    sample = None
+    if dataset.sample_cache is not None:
+        key = '%s:%s:%s:%d' % (dataset.data_path, dataset.phase, dataset.files_list[index], dataset.vis)
+        if window is not None:
+            key += ':%d-%d' % window
+        sample = dataset.sample_cache.get(key)
+    if sample is None:
+        sample = dataset.load_sample(index, window=window)
+        if dataset.sample_cache is not None:
+            dataset.sample_cache.put(key, sample)
+
+    if dataset.toTensor:
+        sample = sample_to_tensor(sample, dataset.device)
+    return sample
+
+
+def sample_to_tensor(sample, device):
+    features, labels, graph_edges, edge_weights, toa = sample[:5]
+    features = torch.Tensor(dequantize(features)).to(device)  #  100 x 20 x 4096
+    labels = torch.Tensor(np.asarray(labels, dtype=np.float32)).to(device)  #  2
+    graph_edges = torch.from_numpy(graph_edges).to(device)  # 2 x 171 shared by all frames, or 100 x 2 x 76 for sparse graphs
+    edge_weights = torch.Tensor(edge_weights).to(device)
+    toa = torch.Tensor(np.asarray(toa, dtype=np.float32)).to(device)
+    node_mask = torch.from_numpy(np.asarray(sample[5])).to(device)  # 100 x 19, True for the real boxes
+    return (features, labels, graph_edges, edge_weights, toa, node_mask) + tuple(sample[6:])
+
+
+def load_st_graph(graph_cache, data_file, src_files, load_inputs, knn=None, radius=None, window=None, verify=False):
+    """ Spatio-temporal graph of one video, shared by all datasets.
+    The graph is read back from graph_cache if a valid entry exists, otherwise it is computed and stored.
+    :param: src_files: the files which the graph, toa and label are computed from
+    :param: load_inputs: callable returning the (detections, toa, label, node_mask) of the video, node_mask may be None.
+                         It is only called if the graph is computed, or if the cached entry has to be checked against the
+                         hash of the detections and node mask (see GraphCache.load)
+    :param: knn, radius: the sparse graph mode, see build_st_graph()
+    :param: window: (start, end) if load_inputs returns the inputs of these frames only, their graph is cached apart
+    :param: verify: if True, the cached entry is always checked against the hash of the detections and node mask
+    :return: graph_edges, edge_weights, toa, label
+    """
+    sparse = knn is not None or radius is not None
+    mode = ':knn%s:r%s' % (knn, radius) if sparse else ''
+    if window is not None:
+        mode += ':w%d-%d' % window
+    if graph_cache is not None:
+        def det_hash():
+            detections, _, _, node_mask = load_inputs()
+            return detection_hash(detections, node_mask)
+        entry = graph_cache.load(data_file, src_files, det_hash=det_hash, mode=mode, verify=verify)
+        if entry is not None:
+            graph_edges = entry['graph_edges'] if sparse else generate_graph_edges(entry['num_boxes'])
+            return graph_edges, entry['edge_weights'], entry['toa'], entry['label']
+
+    detections, toa, label, node_mask = load_inputs()
+    graph_edges, edge_weights = build_st_graph(detections, knn=knn, radius=radius, node_mask=node_mask)
+    if graph_cache is not None:
+        graph_cache.save(data_file, src_files, detection_hash(detections, node_mask), edge_weights,
+                         np.array(toa, dtype=np.float32), label, detections.shape[1],
+                         mode=mode, graph_edges=graph_edges if sparse else None)
+    return graph_edges, edge_weights, toa, label
+
+
+def build_st_graph(detections, knn=None, radius=None, node_mask=None):
+    """ Vectorized version of generate_st_graph(), all frames are processed at once.
+    :param: detections: (T, N, 4+) boxes of each frame
+    :param: knn, radius: if either is given, the sparse graph of build_knn_graph() is built instead of the complete graph
+    :param: node_mask: (T, N), True for the real boxes, the edges of the missing ones get zero weights. None if all are real.
+    :return: graph_edges: (2, N*(N-1)/2), the edge index shared by all frames
+             edge_weights: (T, N*(N-1)/2), the weights of generate_st_graph(), bit-identical for float64 detections.
+                           For float32 detections, the scalar float32 '**2' of the reference is not always correctly
+                           rounded and may differ from the array square in the last ulp of the distance, i.e., up to
+                           about 2e-9 of the normalized weights
+    """
+    if node_mask is not None and np.all(node_mask):
+        node_mask = None
+    if knn is not None or radius is not None:
+        return build_knn_graph(detections, knn=knn, radius=radius, node_mask=node_mask)
+    num_frames, num_boxes = detections.shape[:2]
+    graph_edges = generate_graph_edges(num_boxes)  # 2 x 171
+    rows, cols = graph_edges
+    boxes = detections[:, :, :4]
+    # box centers, T x N
+    cx = 0.5 * (boxes[:, :, 0] + boxes[:, :, 2])
+    cy = 0.5 * (boxes[:, :, 1] + boxes[:, :, 3])
+    dx = cx[:, rows] - cx[:, cols]  # T x 171
+    dy = cy[:, rows] - cy[:, cols]
+    d = dx * dx + dy * dy
+    # C order keeps the per-frame summation order of np.sum() in generate_st_graph()
+    weights = np.exp(-d).astype(np.float32, order='C')
+    fallback = np.float32(1)
+    if node_mask is not None:
+        real = node_mask[:, rows] & node_mask[:, cols]  # T x 171
+        weights = np.where(real, weights, np.float32(0))
+        fallback = real.astype(np.float32)
+    # normalize weights of each frame, frames without any positive weight get all-ones (on the real edges)
+    weights_sum = np.sum(weights, axis=1, keepdims=True)  # T x 1
+    valid = weights_sum > 0
+    edge_weights = np.where(valid, weights / np.where(valid, weights_sum, 1), fallback).astype(np.float32)
+
+    return graph_edges, edge_weights
+
+
+def build_knn_graph(detections, knn=None, radius=None, node_mask=None):
+    """ Sparse graph of each frame: every box receives messages from its k nearest boxes by box-center distance,
+    so that the number of edges grows linearly with the number of boxes. The edges are node-major
+    (k edges per box, see GCNConv(num_neighbors=k)), and the weights are normalized as in build_st_graph().
+    :param: knn: the number of neighbours of each box, N-1 if not given
+    :param: radius: if given, neighbours farther than radius (in box coordinates) get zero weights
+    :param: node_mask: (T, N), the missing boxes are not taken as neighbours, and their edges get zero weights
+    :return: graph_edges: (T, 2, N*k), the edge index of each frame
+             edge_weights: (T, N*k)
+    """
+    num_frames, num_boxes = detections.shape[:2]
+    k = num_boxes - 1 if knn is None else min(knn, num_boxes - 1)
+    boxes = detections[:, :, :4]
+    cx = 0.5 * (boxes[:, :, 0] + boxes[:, :, 2])  # T x N
+    cy = 0.5 * (boxes[:, :, 1] + boxes[:, :, 3])
+    dx = cx[:, :, None] - cx[:, None, :]  # T x N x N
+    dy = cy[:, :, None] - cy[:, None, :]
+    d = dx * dx + dy * dy
+    d[:, np.arange(num_boxes), np.arange(num_boxes)] = np.inf  # no self edges, GCNConv adds the self loops
+    if node_mask is not None:
+        d = np.where(node_mask[:, None, :], d, np.inf)
+    neighbors = np.argsort(d, axis=-1, kind='stable')[:, :, :k]  # T x N x k
+    d = np.take_along_axis(d, neighbors, axis=-1).reshape(num_frames, -1)  # T x N*k
+    valid = d <= radius * radius if radius is not None else np.ones(d.shape, dtype=bool)
+    if node_mask is not None:
+        valid &= np.repeat(node_mask, k, axis=1) & np.take_along_axis(node_mask, neighbors.reshape(num_frames, -1), axis=1)
+    weights = np.where(valid, np.exp(-d), 0).astype(np.float32)
+    # normalize weights of each frame, frames without any positive weight get all-ones (within the radius)
+    weights_sum = np.sum(weights, axis=1, keepdims=True)  # T x 1
+    edge_weights = np.where(weights_sum > 0, weights / np.where(weights_sum > 0, weights_sum, 1), valid).astype(np.float32)
+
+    rows = np.broadcast_to(np.repeat(np.arange(num_boxes), k), (num_frames, num_boxes * k))
+    graph_edges = np.stack([rows, neighbors.reshape(num_frames, -1)], axis=1).astype(np.int64)  # T x 2 x N*k
+    return graph_edges, edge_weights
+
+
+def generate_graph_edges(num_boxes):
+    """ Edge index of the fully-connected graph, in the same order as generate_graph_from_list().
+    :return: (2, N*(N-1)/2)
+    """
+    rows, cols = np.triu_indices(num_boxes, k=1)
+    return np.stack([rows, cols]).astype(np.int64)
 
 
 def generate_st_graph(detections):
+    """ Reference implementation of build_st_graph(), one networkx graph per frame.
+    """
     # create graph edges
     num_frames, num_boxes = detections.shape[:2]
     num_edges = int(num_boxes * (num_boxes - 1) / 2)
@@ -326,6 +690,280 @@ def compute_graph_edge_weights(boxes, edges):
     return weights
 
 
+def collate_batch(batch, pin_memory=False):
+    """ Collate the CPU samples (toTensor=False) of a batch into tensors.
+    Videos of different lengths are padded with zeros to the longest one in the batch.
+    In worker processes the batch is allocated in shared memory, otherwise optionally in pinned memory,
+    so that the host-to-device copy of DataPrefetcher can be asynchronous.
+    :param: batch: list of (features, labels, graph_edges, edge_weights, toa, node_mask[, detections, video_id])
+    :return: features, labels, graph_edges, edge_weights, toa, lengths, node_masks[, detections, video_ids]
+    """
+    dtypes = [torch.float32, torch.float32, torch.long, torch.float32, torch.float32]
+    lengths = [len(sample[0]) for sample in batch]
+    batch_data = []
+    for i, dtype in enumerate(dtypes):
+        samples = [sample[i] if isinstance(sample[i], QuantizedArray) else torch.as_tensor(np.asarray(sample[i])) for sample in batch]
+        size = tuple(samples[0].shape)
+        if i in [0, 3] or (i == 2 and len(size) == 3):
+            size = (max(lengths),) + size[1:]  # features, edge weights (and the edges of sparse graphs) are per-frame
+        out = _new_batch_tensor((len(samples),) + size, dtype, pin_memory)
+        for b, sample in enumerate(samples):
+            if isinstance(sample, QuantizedArray):
+                sample.dequantize(out=out[b, :len(sample)].numpy())  # int8 features are dequantized in place
+            else:
+                out[b, :len(sample)].copy_(sample)
+            if len(sample) < size[0]:
+                out[b, len(sample):].zero_()
+        batch_data.append(out)
+    batch_data.append(torch.tensor(lengths, dtype=torch.long))
+    # node masks of the padded frames are all False
+    node_masks = _new_batch_tensor((len(batch), max(lengths)) + np.shape(batch[0][5])[1:], torch.bool, pin_memory)
+    node_masks.zero_()
+    for b, sample in enumerate(batch):
+        node_masks[b, :len(sample[5])].copy_(torch.as_tensor(np.asarray(sample[5])))
+    batch_data.append(node_masks)
+    if len(batch[0]) > 6:
+        # detections and video ids are only used for visualization, they stay on host
+        detections = np.zeros((len(batch), max(lengths)) + batch[0][6].shape[1:], dtype=batch[0][6].dtype)
+        for b, sample in enumerate(batch):
+            detections[b, :len(sample[6])] = sample[6]
+        batch_data.append(detections)
+        batch_data.append([sample[7] for sample in batch])
+    return batch_data
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler grouping videos of similar lengths, so that little compute is spent on padded frames.
+    Each pool of bucket_size batches of shuffled videos is sorted by length and split into batches,
+    the order of all batches is then shuffled.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=True, bucket_size=50):
+        """
+        :param: lengths: the number of frames of each video, see get_lengths()
+        """
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start: start + pool_size], key=lambda i: self.lengths[i])
+            for b in range(0, len(pool), self.batch_size):
+                if len(pool[b: b + self.batch_size]) == self.batch_size or not self.drop_last:
+                    batches.append([int(i) for i in pool[b: b + self.batch_size]])
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        pool_size = self.batch_size * self.bucket_size
+        num_batches = 0
+        for start in range(0, len(self.lengths), pool_size):
+            num_videos = min(pool_size, len(self.lengths) - start)
+            num_batches += num_videos // self.batch_size if self.drop_last else (num_videos + self.batch_size - 1) // self.batch_size
+        return num_batches
+
+
+class WindowedDataset(Dataset):
+    """ Sliding-window mode of a dataset for long videos: each video is split into windows of window_size frames
+    (the last one may be shorter), so that the memory is bounded by the window size rather than the video length.
+    Only the frames of a window are read from the feature store and graphed. The members of .npz files can only be
+    read whole, so that a feature store is needed.
+    The windows of a video are batched in order by WindowBatchSampler, and the hidden states are carried over
+    from one window to the next one by WindowHiddenStates.
+    """
+    def __init__(self, dataset, window_size, lengths=None):
+        """
+        :param: dataset: DADDataset, A3DDataset or CrashDataset
+        :param: lengths: the number of frames of each video, read by get_lengths() if not given
+        """
+        assert dataset.feature_store is not None, "The sliding-window mode needs a feature store (--feature_store)."
+        self.dataset = dataset
+        self.window_size = window_size
+        self.n_frames = window_size
+        self.n_obj = dataset.n_obj
+        self.fps = dataset.fps
+        self.dim_feature = dataset.dim_feature
+        lengths = get_lengths(dataset) if lengths is None else lengths
+        self.windows, self.video_windows = [], []
+        for index, length in enumerate(lengths):
+            starts = list(range(0, length, window_size))
+            self.video_windows.append(list(range(len(self.windows), len(self.windows) + len(starts))))
+            self.windows.extend([(index, start, start == starts[-1]) for start in starts])
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, i):
+        """
+        :return: the sample of the window, with the toa relative to the window start, and (video index, start, is last window)
+        """
+        index, start, last = self.windows[i]
+        sample = get_sample(self.dataset, index, window=(start, start + self.window_size))
+        toa = sample[4]
+        toa = toa - start if torch.is_tensor(toa) else np.asarray(toa, dtype=np.float32) - start
+        return tuple(sample[:4]) + (toa,) + tuple(sample[5:]), (index, start, int(last))
+
+
+def collate_windows(batch, pin_memory=False):
+    """ collate_batch for WindowedDataset, the window info (video index, start, is last window) is appended as a B x 3 tensor.
+    """
+    batch_data = collate_batch([window for window, _ in batch], pin_memory=pin_memory)
+    batch_data.append(torch.tensor([info for _, info in batch], dtype=torch.long))
+    return batch_data
+
+
+class WindowBatchSampler(Sampler):
+    """ Batch sampler of WindowedDataset: videos are distributed over batch_size streams,
+    and each batch takes the next window of every stream, so that the windows of a video are in order.
+    The last batches are smaller when some streams run out of windows.
+    The streams of an epoch are drawn once, by __len__() or __iter__() whichever comes first, so that the length
+    matches the batches of the epoch.
+    """
+    def __init__(self, video_windows, batch_size, shuffle=True):
+        """
+        :param: video_windows: the window indices of each video, see WindowedDataset
+        """
+        self.video_windows = video_windows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.streams = None  # the streams of the current (or next) epoch
+
+    def get_streams(self):
+        order = np.random.permutation(len(self.video_windows)) if self.shuffle else np.arange(len(self.video_windows))
+        streams = [[] for _ in range(self.batch_size)]
+        for index in order:
+            # the next video goes to the shortest stream
+            stream = min(streams, key=len)
+            stream.extend(self.video_windows[index])
+        return streams
+
+    def __iter__(self):
+        if self.streams is None:
+            self.streams = self.get_streams()
+        streams = self.streams
+        try:
+            for step in range(max([len(stream) for stream in streams])):
+                yield [stream[step] for stream in streams if step < len(stream)]
+        finally:
+            # the next epoch draws new streams
+            if self.streams is streams:
+                self.streams = None
+
+    def __len__(self):
+        if self.streams is None:
+            self.streams = self.get_streams()
+        return max([len(stream) for stream in self.streams])
+
+
+class WindowHiddenStates(object):
+    """ The hidden states of UString carried over from the previous window of each video in the sliding-window mode.
+    """
+    def __init__(self, n_layers, n_obj, h_dim):
+        self.size = (n_layers, n_obj, h_dim)
+        self.states = {}
+
+    def gather(self, window_info, device):
+        """
+        :param: window_info: B x 3 (video index, start, is last window)
+        :return: hidden_in of the batch, n_layers x B x n_obj x h_dim, zeros for the first window of a video
+        """
+        zeros = torch.zeros(self.size, device=device)
+        hidden_in = []
+        for index, start, _ in window_info.tolist():
+            state = self.states.pop(index, None) if start > 0 else None
+            hidden_in.append(state if state is not None else zeros)
+        return torch.stack(hidden_in, dim=1)
+
+    def update(self, window_info, hidden_out):
+        for b, (index, _, last) in enumerate(window_info.tolist()):
+            if not last:
+                self.states[index] = hidden_out[:, b]
+
+    def detach(self):
+        # truncate the back-propagation through time at the current windows
+        self.states = {index: state.detach() for index, state in self.states.items()}
+
+    def reset(self):
+        self.states = {}
+
+
+def get_lengths(dataset):
+    """ The number of frames of all videos of a dataset, read without decoding the features.
+    """
+    return [dataset.get_num_frames(index) for index in range(len(dataset))]
+
+
+def read_num_frames(dataset, index, key):
+    if dataset.manifest is not None:
+        return dataset.manifest['samples'][dataset.files_list[index]]['num_frames']
+    if dataset.feature_store is not None:
+        data = dataset.load_data(index)  # views on the memory-mapped store, nothing is read
+        return data['num_boxes' if 'num_boxes' in data else key].shape[0]
+    # only the header of the array in the .npz file is parsed, the number of boxes of each frame if the ROIs are packed
+    with zipfile.ZipFile(dataset.get_data_file(index)) as zf:
+        name = 'num_boxes.npy' if 'num_boxes.npy' in zf.namelist() else key + '.npy'
+        with zf.open(name) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape = np.lib.format.read_array_header_1_0(f)[0]
+            else:
+                shape = np.lib.format.read_array_header_2_0(f)[0]
+    return shape[0]
+
+
+def _new_batch_tensor(size, dtype, pin_memory=False):
+    if torch.utils.data.get_worker_info() is not None:
+        # avoid another copy when the batch is sent back to the main process
+        return torch.empty(size, dtype=dtype).share_memory_()
+    return torch.empty(size, dtype=dtype, pin_memory=pin_memory)
+
+
+class DataPrefetcher(object):
+    """ Wrap a DataLoader to move each batch to the device.
+    With prefetch on a CUDA device, the copy of batch k+1 runs on a side stream while batch k is processed.
+    """
+    def __init__(self, loader, device, prefetch=False):
+        self.loader = loader
+        self.device = device
+        self.prefetch = prefetch and device.type == 'cuda'
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if not self.prefetch:
+            for batch in self.loader:
+                yield [data.to(self.device) if torch.is_tensor(data) else data for data in batch]
+            return
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+        next_batch = self.preload(loader_iter, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            for data in batch:
+                if torch.is_tensor(data):
+                    # the memory was allocated on the side stream
+                    data.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(loader_iter, stream)
+            yield batch
+
+    def preload(self, loader_iter, stream):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            batch = [data.to(self.device, non_blocking=True) if torch.is_tensor(data) else data for data in batch]
+        return batch
+
+
 if __name__ == '__main__':
     from torch.utils.data import DataLoader
     import argparse
@@ -349,34 +987,36 @@ if __name__ == '__main__':
     data_path = os.path.join(ROOT_PATH, p.data_path, p.dataset)
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-    # create data loader
+    # create data loader, the samples are collated on host as in main.py
     if p.dataset == 'dad':
-        train_data = DADDataset(data_path, p.feature_name, 'training', toTensor=True, device=device)
-        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=True, device=device, vis=True)
+        train_data = DADDataset(data_path, p.feature_name, 'training', toTensor=False, device=device)
+        test_data = DADDataset(data_path, p.feature_name, 'testing', toTensor=False, device=device, vis=True)
     elif p.dataset == 'a3d':
-        train_data = A3DDataset(data_path, p.feature_name, 'train', toTensor=True, device=device)
-        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=True, device=device, vis=True)
+        train_data = A3DDataset(data_path, p.feature_name, 'train', toTensor=False, device=device)
+        test_data = A3DDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, vis=True)
     elif p.dataset == 'crash':
-        train_data = CrashDataset(data_path, p.feature_name, 'train', toTensor=True, device=device)
-        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=True, device=device, vis=True)
+        train_data = CrashDataset(data_path, p.feature_name, 'train', toTensor=False, device=device)
+        test_data = CrashDataset(data_path, p.feature_name, 'test', toTensor=False, device=device, vis=True)
     else:
         raise NotImplementedError
-    traindata_loader = DataLoader(dataset=train_data, batch_size=p.batch_size, shuffle=True, drop_last=True)
-    testdata_loader = DataLoader(dataset=test_data, batch_size=p.batch_size, shuffle=False, drop_last=True)
+    traindata_loader = DataPrefetcher(DataLoader(dataset=train_data, batch_size=p.batch_size, shuffle=True, drop_last=True, collate_fn=collate_batch), device)
+    testdata_loader = DataPrefetcher(DataLoader(dataset=test_data, batch_size=p.batch_size, shuffle=False, drop_last=True, collate_fn=collate_batch), device)
 
     for e in range(2):
         print('Epoch: %d'%(e))
-        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas) in tqdm(enumerate(traindata_loader), total=len(traindata_loader)):
+        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks) in tqdm(enumerate(traindata_loader), total=len(traindata_loader)):
             if i == 0:
                 print('feature dim:', batch_xs.size())
                 print('label dim:', batch_ys.size())
                 print('graph edges dim:', graph_edges.size())
                 print('edge weights dim:', edge_weights.size())
                 print('time of accidents dim:', batch_toas.size())
+                print('lengths dim:', batch_lens.size())
+                print('node masks dim:', node_masks.size())
 
     for e in range(2):
         print('Epoch: %d'%(e))
-        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, detections, video_ids) in \
+        for i, (batch_xs, batch_ys, graph_edges, edge_weights, batch_toas, batch_lens, node_masks, detections, video_ids) in \
             tqdm(enumerate(testdata_loader), desc="batch progress", total=len(testdata_loader)):
             if i == 0:
                 print('feature dim:', batch_xs.size())
@@ -384,4 +1024,6 @@ if __name__ == '__main__':
                 print('graph edges dim:', graph_edges.size())
                 print('edge weights dim:', edge_weights.size())
                 print('time of accidents dim:', batch_toas.size())
-
+                print('lengths dim:', batch_lens.size())
+                print('node masks dim:', node_masks.size())
+                print('detections dim:', detections.shape)
@@ -2,133 +2,126 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import inspect
+import copy
 from torch.nn.parameter import Parameter
 import torch
 import torch.nn as nn
 from src.utils import glorot, zeros, uniform, reset
-from torch_geometric.utils import remove_self_loops, add_self_loops
-import torch_scatter
-from torch_scatter import scatter_mean, scatter_max, scatter_add
 from torch.autograd import Variable
 import torch.nn.functional as F
 from src.BayesModels import BayesianLinear
+from src.DataLoader import build_st_graph
 
 
-class MessagePassing(torch.nn.Module):
-    r"""Base class for creating message passing layers
-    .. math::
-        \mathbf{x}_i^{\prime} = \gamma_{\mathbf{\Theta}} \left( \mathbf{x}_i,
-        \square_{j \in \mathcal{N}(i)} \, \phi_{\mathbf{\Theta}}
-        \left(\mathbf{x}_i, \mathbf{x}_j,\mathbf{e}_{i,j}\right) \right),
-    where :math:`\square` denotes a differentiable, permutation invariant
-    function, *e.g.*, sum, mean or max, and :math:`\gamma_{\mathbf{\Theta}}`
-    and :math:`\phi_{\mathbf{\Theta}}` denote differentiable functions such as
-    MLPs.
-    See `here <https://rusty1s.github.io/pytorch_geometric/build/html/notes/
-    create_gnn.html>`__ for the accompanying tutorial.
-    """
-
-    def __init__(self, aggr='add'):
-        super(MessagePassing, self).__init__()
-
-        self.message_args = inspect.getargspec(self.message)[0][1:]
-        self.update_args = inspect.getargspec(self.update)[0][2:]
-
-    def propagate(self, aggr, edge_index, **kwargs):
-        r"""The initial call to start propagating messages.
-        Takes in an aggregation scheme (:obj:`"add"`, :obj:`"mean"` or
-        :obj:`"max"`), the edge indices, and all additional data which is
-        needed to construct messages and to update node embeddings."""
-
-        assert aggr in ['add', 'mean', 'max']
-        kwargs['edge_index'] = edge_index
-
-        size = None
-        message_args = []
-        for arg in self.message_args:
-            if arg[-2:] == '_i':
-                tmp = kwargs[arg[:-2]]
-                size = tmp.size(0)
-                message_args.append(tmp[edge_index[0]])
-            elif arg[-2:] == '_j':
-                tmp = kwargs[arg[:-2]]
-                size = tmp.size(0)
-                message_args.append(tmp[edge_index[1]])
-            else:
-                message_args.append(kwargs[arg])
-
-        update_args = [kwargs[arg] for arg in self.update_args]
-
-        out = self.message(*message_args)
-        out = scatter_(aggr, out, edge_index[0], dim_size=size)
-        out = self.update(out, *update_args)
-
-        return out
-
-    def message(self, x_j):  # pragma: no cover
-        r"""Constructs messages in analogy to :math:`\phi_{\mathbf{\Theta}}`
-        for each edge in :math:`(i,j) \in \mathcal{E}`.
-        Can take any argument which was initially passed to :meth:`propagate`.
-        In addition, features can be lifted to the source node :math:`i` and
-        target node :math:`j` by appending :obj:`_i` or :obj:`_j` to the
-        variable name, *.e.g.* :obj:`x_i` and :obj:`x_j`."""
-
-        return x_j
-
-    def update(self, aggr_out):  # pragma: no cover
-        r"""Updates node embeddings in analogy to
-        :math:`\gamma_{\mathbf{\Theta}}` for each node
-        :math:`i \in \mathcal{V}`.
-        Takes in the output of aggregation as first argument and any argument
-        which was initially passed to :meth:`propagate`."""
-
-        return aggr_out
-
-
+# layers
 
-def scatter_(name, src, index, dim_size=None):
-    r"""Aggregates all values from the :attr:`src` tensor at the indices
-    specified in the :attr:`index` tensor along the first dimension.
-    If multiple indices reference the same location, their contributions
-    are aggregated according to :attr:`name` (either :obj:`"add"`,
-    :obj:`"mean"` or :obj:`"max"`).
-    Args:
-        name (string): The aggregation to use (:obj:`"add"`, :obj:`"mean"`,
-            :obj:`"max"`).
-        src (Tensor): The source tensor.
-        index (LongTensor): The indices of elements to scatter.
-        dim_size (int, optional): Automatically create output tensor with size
-            :attr:`dim_size` in the first dimension. If set to :attr:`None`, a
-            minimal sized output tensor is returned. (default: :obj:`None`)
-    :rtype: :class:`Tensor`
+class NormalizedGraph(object):
+    """ The normalized propagation operator D^-1/2 (A + I) D^-1/2 of a batch of graphs. The graph convolutions of a
+    timestep only differ by their weights, so that it is computed once (e.g., for all frames of a clip) and shared.
+    Graphs are stored as a dense adjacency, or for the node-major kNN graphs (see build_knn_graph) as the k neighbours
+    of each node, which are aggregated by gathering them.
     """
+    def __init__(self, edge_index, edge_weight, num_nodes, node_mask=None, num_neighbors=None):
+        """
+        :param edge_index: (...) x 2 x 171, e.g., 10 x 100 x 2 x 171 for all frames of a batch
+        :param edge_weight: (...) x 171, None for unit weights
+        :param node_mask: (...) x 19, True for the real nodes, None if all are real
+        :param num_neighbors: k of the kNN graphs, None for any graph
+        """
+        if edge_weight is None:
+            edge_weight = torch.ones(edge_index.shape[:-2] + edge_index.shape[-1:], device=edge_index.device)
+        assert edge_weight.size(-1) == edge_index.size(-1)
+        self.shape = edge_weight.shape[:-1]
+        self.num_neighbors = num_neighbors
+        edge_index = edge_index.expand(self.shape + edge_index.shape[-2:]).reshape(-1, 2, edge_index.size(-1))
+        edge_weight = edge_weight.reshape(-1, edge_weight.size(-1))
+        row, col = edge_index[:, 0], edge_index[:, 1]  # 10 x 171
+        # the self loops of the masked nodes are dropped as well
+        loop_weight = torch.ones((edge_weight.size(0), num_nodes), dtype=edge_weight.dtype, device=edge_weight.device)
+        if node_mask is not None:
+            loop_weight = node_mask.reshape(-1, num_nodes).to(edge_weight.dtype)
+            edge_weight = edge_weight * torch.gather(loop_weight, 1, row) * torch.gather(loop_weight, 1, col)
+        deg = loop_weight.scatter_add(1, row, edge_weight)  # 10 x 19
+        deg_inv = deg.pow(-0.5)
+        deg_inv[deg_inv == float('inf')] = 0
+        norm = torch.gather(deg_inv, 1, row) * edge_weight * torch.gather(deg_inv, 1, col)  # 10 x 171
+        loop_norm = deg_inv * loop_weight * deg_inv  # 10 x 19
+        self.node_mask = node_mask.reshape(-1, num_nodes) if node_mask is not None else None
+        if num_neighbors is not None:
+            assert edge_index.size(-1) == num_nodes * num_neighbors, "Not a kNN graph of %d neighbours"%(num_neighbors)
+            self.adj, self.col, self.norm, self.loop_norm = None, col, norm, loop_norm
+        else:
+            # 10 x 19 x 19, the rows are the receiving nodes
+            adj = torch.diag_embed(loop_norm).view(-1, num_nodes * num_nodes).scatter_add(1, row * num_nodes + col, norm)
+            self.adj, self.col, self.norm, self.loop_norm = adj.view(-1, num_nodes, num_nodes), None, None, None
+        self._apply(lambda tensor: tensor.view(self.shape + tensor.shape[1:]))
+
+    def _apply(self, fn):
+        for name in ['adj', 'col', 'norm', 'loop_norm', 'node_mask']:
+            if getattr(self, name) is not None:
+                setattr(self, name, fn(getattr(self, name)))
+        return self
+
+    def select(self, t):
+        """ The graphs of the frame t of a batch built for all frames, e.g., 10 x 100 --> 10
+        """
+        graph = copy.copy(self)
+        graph.shape = self.shape[:1] + self.shape[2:]
+        return graph._apply(lambda tensor: tensor[:, t])
 
-    assert name in ['add', 'mean', 'max']
-
-    op = getattr(torch_scatter, 'scatter_{}'.format(name))
-    fill_value = -1e38 if name is 'max' else 0
-
-    out = op(src, index, 0, None, dim_size, fill_value)
-    if isinstance(out, tuple):
-        out = out[0]
-
-    if name is 'max':
-        out[out == fill_value] = 0
-
-    return out
-
-
-# layers
+    def frames(self, start, end):
+        """ The graphs of the frames [start, end) of a batch built for all frames, e.g., 10 x 100 --> 10 x (end - start)
+        """
+        graph = copy.copy(self)
+        graph.shape = self.shape[:1] + (len(range(*slice(start, end).indices(self.shape[1]))),) + self.shape[2:]
+        return graph._apply(lambda tensor: tensor[:, start:end])
+
+    def __getitem__(self, idx):
+        # the graphs of a subset of the batch
+        graph = copy.copy(self)
+        graph.shape = (len(idx),) + self.shape[1:]
+        return graph._apply(lambda tensor: tensor[idx])
+
+    def masked(self, valid):
+        """ The graphs of the frames where valid is True, e.g., 10 x 100 --> M for a 10 x 100 mask of M valid frames
+        """
+        graph = copy.copy(self)
+        graph.shape = (int(valid.sum()),) + self.shape[valid.dim():]
+        return graph._apply(lambda tensor: tensor[valid])
 
-class GCNConv(MessagePassing):
-    def __init__(self, in_channels, out_channels, act=F.relu, improved=True, bias=False):
+    def propagate(self, x_w):
+        """
+        :param x_w: 10 x 19 x C, the transformed node features, with the same leading dims as the graphs (e.g., 10 x 100)
+        :return: 10 x 19 x C, the normalized sums over the neighbours and the self loop of each node
+        """
+        if self.adj is not None:
+            return torch.matmul(self.adj, x_w)
+        num_nodes, num_channels = x_w.size(-2), x_w.size(-1)
+        col = self.col.reshape(-1, self.col.size(-1))
+        x_j = torch.gather(x_w.reshape(-1, num_nodes, num_channels), 1, col.unsqueeze(-1).expand(-1, -1, num_channels))  # 10 x (19 x k) x C
+        out = (self.norm.unsqueeze(-1) * x_j.view(self.norm.shape + (num_channels,))).view(x_w.shape[:-1] + (self.num_neighbors, -1)).sum(-2)
+        return out + self.loop_norm.unsqueeze(-1) * x_w  # self loops
+
+    def mask_nodes(self, out):
+        # zeros for the masked nodes
+        if self.node_mask is None:
+            return out
+        return out * self.node_mask.unsqueeze(-1).to(out.dtype)
+
+
+class GCNConv(nn.Module):
+    def __init__(self, in_channels, out_channels, act=F.relu, improved=True, bias=False, num_neighbors=None):
+        """
+        :param num_neighbors: k of the node-major kNN graphs (see build_knn_graph), which are aggregated by gathering
+                              the k neighbours of each node instead of scattering over the edges. None for any graph.
+        """
         super(GCNConv, self).__init__()
 
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.improved = improved
         self.act = act
+        self.num_neighbors = num_neighbors
 
         self.weight = Parameter(torch.Tensor(in_channels, out_channels))
 
@@ -143,67 +136,33 @@ class GCNConv(MessagePassing):
         glorot(self.weight)
         zeros(self.bias)
 
-    def add_self_loops(self, edge_index, edge_weight=None, fill_value=1, num_nodes=None):
+    def forward(self, x, edge_index, edge_weight=None, node_mask=None):
         """
-
-        :param edge_index: 10 x 2 x 171
-        :param edge_weight: 10 x 171
-        :param fill_value: 1
-        :param num_nodes: 20
-        :return:
+        :param edge_index: 10 x 2 x 171, or a NormalizedGraph shared by several convolutions, then edge_weight and
+                           node_mask are those it was built with
+        :param node_mask: 10 x 19, True for the real nodes. The edges (and self loops) of the other nodes are dropped,
+                          so that the degrees are normalized on the real nodes only, and their outputs are zeros.
         """
-        batch_size = edge_index.size(0)
-        num_nodes = edge_index.max().item() + 1 if num_nodes is None else num_nodes
-        loop_index = torch.arange(0, num_nodes, dtype=torch.long,
-                                  device=edge_index.device)
-        loop_index = loop_index.unsqueeze(0).repeat(2, 1)
-        loop_index = loop_index.unsqueeze(0).repeat(batch_size, 1, 1)  # 10 x 2 x 20
-
-        if edge_weight is not None:
-            assert edge_weight.size(-1) == edge_index.size(-1)
-            loop_weight = edge_weight.new_full((num_nodes,), fill_value)
-            loop_weight = loop_weight.unsqueeze(0).repeat(batch_size, 1)
-            edge_weight = torch.cat([edge_weight, loop_weight], dim=-1)
-
-        edge_index = torch.cat([edge_index, loop_index], dim=-1)
-
-        return edge_index, edge_weight
-
-
-    def forward(self, x, edge_index, edge_weight=None):
-        if edge_weight is None:
-            edge_weight = torch.ones(
-                (edge_index.size(0), edge_index.size(-1), ), dtype=x.dtype, device=x.device)
-        # edge_weight = edge_weight.view(-1)
-        assert edge_weight.size(-1) == edge_index.size(-1)
-
-        # for pytorch 1.4, there are two outputs
-        edge_index, edge_weight = self.add_self_loops(edge_index, edge_weight=edge_weight, num_nodes=x.size(1))
-
-        out_batch = []
-        for i in range(edge_index.size(0)):
-            row, col = edge_index[i]
-            deg = scatter_add(edge_weight[i], row, dim=0, dim_size=x.size(1))
-            deg_inv = deg.pow(-0.5)
-            deg_inv[deg_inv == float('inf')] = 0
+        x_w = torch.matmul(x, self.weight)  # 10 x 19 x C
+        return self.aggregate(x_w, edge_index, edge_weight, node_mask)
 
-            norm = deg_inv[row] * edge_weight[i] * deg_inv[col]
-            
-            weight = self.weight.to(x.device)
-            x_w = torch.matmul(x[i], weight)
-            out = self.propagate('add', edge_index[i], x=x_w, norm=norm)
-            out_batch.append(self.act(out))
-        out_batch = torch.stack(out_batch)
-
-        return out_batch
-
-    def message(self, x_j, norm):
-        return norm.view(-1, 1) * x_j
+    def aggregate(self, x_w, edge_index, edge_weight=None, node_mask=None):
+        """ forward() of node features already multiplied by the weight, e.g., by parts of it.
+        :param x_w: 10 x 19 x C
+        """
+        if isinstance(edge_index, NormalizedGraph):
+            graph = edge_index
+        else:
+            if edge_weight is None:
+                # unit weights of the dtype of the features
+                edge_weight = x_w.new_ones(edge_index.shape[:-2] + edge_index.shape[-1:])
+            graph = NormalizedGraph(edge_index, edge_weight, x_w.size(-2), node_mask=node_mask, num_neighbors=self.num_neighbors)
+        out = self.act(self.update(graph.propagate(x_w)))
+        return graph.mask_nodes(out)
 
     def update(self, aggr_out):
         if self.bias is not None:
-            bias = self.bias.to(aggr_out.device)
-            aggr_out = aggr_out + bias
+            aggr_out = aggr_out + self.bias
         return aggr_out
 
     def __repr__(self):
@@ -213,51 +172,53 @@ class GCNConv(MessagePassing):
 
 
 class Graph_GRU_GCN(nn.Module):
-    def __init__(self, input_size, hidden_size, n_layer, bias=True):
+    def __init__(self, input_size, hidden_size, n_layer, bias=True, num_neighbors=None):
         super(Graph_GRU_GCN, self).__init__()
 
         self.hidden_size = hidden_size
         self.n_layer = n_layer
 
-        # gru weights
-        self.weight_xz = []
-        self.weight_hz = []
-        self.weight_xr = []
-        self.weight_hr = []
-        self.weight_xh = []
-        self.weight_hh = []
+        # gru weights, the graph convolutions of the gates are fused: x --> [z, r, h~] and h --> [z, r]
+        self.weight_x = nn.ModuleList()
+        self.weight_h = nn.ModuleList()
+        self.weight_hh = nn.ModuleList()
 
         for i in range(self.n_layer):
-            if i == 0:
-                self.weight_xz.append(GCNConv(input_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hz.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_xr.append(GCNConv(input_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hr.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_xh.append(GCNConv(input_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hh.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-            else:
-                self.weight_xz.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hz.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_xr.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hr.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_xh.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-                self.weight_hh.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias))
-
-    def forward(self, inp, edgidx, h, edge_weight=None):
-        h_out = torch.zeros(h.size())
-        h_out = h_out.to(inp.device)
+            in_size = input_size if i == 0 else hidden_size
+            self.weight_x.append(GCNConv(in_size, 3 * hidden_size, act=lambda x: x, bias=bias, num_neighbors=num_neighbors))
+            self.weight_h.append(GCNConv(hidden_size, 2 * hidden_size, act=lambda x: x, bias=bias, num_neighbors=num_neighbors))
+            self.weight_hh.append(GCNConv(hidden_size, hidden_size, act=lambda x: x, bias=bias, num_neighbors=num_neighbors))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # each gate is initialized as a separate convolution
+        for conv in list(self.weight_x) + list(self.weight_h):
+            for weight in conv.weight.data.split(self.hidden_size, dim=1):
+                glorot(weight)
+
+    def forward(self, inp, edgidx, h, edge_weight=None, node_mask=None, inp_w=None):
+        """
+        :param edgidx: 10 x 2 x 171, or the NormalizedGraph of the timestep
+        :param node_mask: 10 x 19, True for the real nodes, the hidden states of the other nodes are zeros
+        :param inp_w: 10 x 19 x (3 x 256), the input already multiplied by the weight of weight_x[0], inp is not used then
+        """
+        h_out = []
+        m = node_mask
         for i in range(self.n_layer):
-            if i == 0:
-                z_g = torch.sigmoid(self.weight_xz[i](inp, edgidx, edge_weight) + self.weight_hz[i](h[i], edgidx, edge_weight))
-                r_g = torch.sigmoid(self.weight_xr[i](inp, edgidx, edge_weight) + self.weight_hr[i](h[i], edgidx, edge_weight))
-                h_tilde_g = torch.tanh(self.weight_xh[i](inp, edgidx, edge_weight) + self.weight_hh[i](r_g * h[i], edgidx, edge_weight))
-                h_out[i] = z_g * h[i] + (1 - z_g) * h_tilde_g
+            if i == 0 and inp_w is not None:
+                x_g = self.weight_x[i].aggregate(inp_w, edgidx, edge_weight, m)
             else:
-                z_g = torch.sigmoid(self.weight_xz[i](h_out[i - 1], edgidx, edge_weight) + self.weight_hz[i](h[i], edgidx, edge_weight))
-                r_g = torch.sigmoid(self.weight_xr[i](h_out[i - 1], edgidx, edge_weight) + self.weight_hr[i](h[i], edgidx, edge_weight))
-                h_tilde_g = torch.tanh(self.weight_xh[i](h_out[i - 1], edgidx, edge_weight) + self.weight_hh[i](r_g * h[i], edgidx, edge_weight))
-                h_out[i] = z_g * h[i] + (1 - z_g) * h_tilde_g
-        return h_out
+                x_g = self.weight_x[i](inp if i == 0 else h_out[i - 1], edgidx, edge_weight, m)
+            x_z, x_r, x_h = x_g.chunk(3, dim=-1)
+            h_z, h_r = self.weight_h[i](h[i], edgidx, edge_weight, m).chunk(2, dim=-1)
+            z_g = torch.sigmoid(x_z + h_z)
+            r_g = torch.sigmoid(x_r + h_r)
+            h_tilde_g = torch.tanh(x_h + self.weight_hh[i](r_g * h[i], edgidx, edge_weight, m))
+            h_new = z_g * h[i] + (1 - z_g) * h_tilde_g
+            if node_mask is not None:
+                h_new = h_new * node_mask.unsqueeze(-1).to(h_new.dtype)
+            h_out.append(h_new)
+        return torch.stack(h_out)
 
 
 class AccidentPredictor(nn.Module):
@@ -286,10 +247,13 @@ class SelfAttAggregate(torch.nn.Module):
         import math
         torch.nn.init.kaiming_normal_(self.weight, a=math.sqrt(5))
 
-    def forward(self, hiddens, avgsum='sum'):
+    def forward(self, hiddens, avgsum='sum', mask=None):
         """
         hiddens: (10, 19, 256, 100)
+        mask: (10, 100), True for the valid frames of each video, None if all frames are valid
         """
+        num_frames = hiddens.size(-1)
+        assert num_frames <= self.agg_dim, "Videos are longer than the maximum number of frames: %d"%(self.agg_dim)
         maxpool = torch.max(hiddens, dim=1)[0]  # (10, 256, 100)
         if avgsum=='sum':
             avgpool = torch.sum(hiddens, dim=1)
@@ -299,24 +263,29 @@ class SelfAttAggregate(torch.nn.Module):
 
         # soft-attention
         energy = torch.bmm(agg_spatial.permute([0, 2, 1]), agg_spatial)  # (10, 100, 100)
+        if mask is not None:
+            # padded frames are not attended to
+            energy = energy.masked_fill(~mask.unsqueeze(1), float('-inf'))
         attention = self.softmax(energy)
         weighted_feat = torch.bmm(attention, agg_spatial.permute([0, 2, 1]))  # (10, 100, 512)
-        weight = self.weight.unsqueeze(0).repeat([hiddens.size(0), 1, 1])
+        if mask is not None:
+            weighted_feat = weighted_feat * mask.unsqueeze(-1).to(weighted_feat.dtype)
+        weight = self.weight[:num_frames].unsqueeze(0).repeat([hiddens.size(0), 1, 1])
         agg_feature = torch.bmm(weighted_feat.permute([0, 2, 1]), weight)  # (10, 512, 1)
 
         return agg_feature.squeeze(dim=-1)  # (10, 512)
 
 
 class BayesianPredictor(nn.Module):
-    def __init__(self, input_dim, output_dim=2, act=torch.relu, pi=0.5, sigma_1=None, sigma_2=None):
+    def __init__(self, input_dim, output_dim=2, act=torch.relu, pi=0.5, sigma_1=None, sigma_2=None, local_reparam=False):
         super(BayesianPredictor, self).__init__()
         self.act = act
-        self.l1 = BayesianLinear(input_dim, 64, pi=pi, sigma_1=sigma_1, sigma_2=sigma_2)
-        self.l2 = BayesianLinear(64, output_dim, pi=pi, sigma_1=sigma_1, sigma_2=sigma_2)
+        self.l1 = BayesianLinear(input_dim, 64, pi=pi, sigma_1=sigma_1, sigma_2=sigma_2, local_reparam=local_reparam)
+        self.l2 = BayesianLinear(64, output_dim, pi=pi, sigma_1=sigma_1, sigma_2=sigma_2, local_reparam=local_reparam)
 
-    def forward(self, x, sample=False):
-        x = self.act(self.l1(x, sample))
-        x = self.l2(x, sample)
+    def forward(self, x, sample=False, npass=None, calculate_log_probs=None):
+        x = self.act(self.l1(x, sample, calculate_log_probs=calculate_log_probs, npass=npass))
+        x = self.l2(x, sample, calculate_log_probs=calculate_log_probs, npass=npass)
         return x
 
     def log_prior(self):
@@ -325,34 +294,29 @@ class BayesianPredictor(nn.Module):
     def log_variational_posterior(self):
         return self.l1.log_variational_posterior + self.l2.log_variational_posterior
 
-    def sample_elbo(self, input, out_dim=2, npass=2, testing=False, eval_uncertain=False):
-        npass = npass + 1 if testing else npass
-        outputs = torch.zeros(npass, input.size(0), out_dim).to(input.device)
-        log_priors = torch.zeros(npass).to(input.device)
-        log_variational_posteriors = torch.zeros(npass).to(input.device)
-        for i in range(npass):
-            outputs[i] = self(input, sample=True)
-            log_priors[i] = self.log_prior()
-            log_variational_posteriors[i] = self.log_variational_posterior()
+    def sample_elbo(self, input, out_dim=2, npass=2, testing=False, eval_uncertain=False, mc_tol=None, min_pass=4):
+        """
+        :param mc_tol: if given, the passes are drawn adaptively (see sample_adaptive) with at most npass passes, during
+                       inference only (not in training mode, nor with testing). The output has the passes used ('npass') then.
+        """
+        if mc_tol is not None and not self.training and not testing:
+            output_dict = self.sample_adaptive(input, tol=mc_tol, min_pass=min_pass, max_pass=npass)
+            output_dict.update(log_prior=torch.zeros((), device=input.device), log_posterior=torch.zeros((), device=input.device))
+            return output_dict
+        # all passes are sampled at once, N x B x C
+        outputs = self(input, sample=True, npass=npass)
+        log_prior = torch.as_tensor(self.log_prior(), dtype=input.dtype, device=input.device)
+        log_variational_posterior = torch.as_tensor(self.log_variational_posterior(), dtype=input.dtype, device=input.device)
         if testing:
-            outputs[npass] = self(input, sample=False)
+            # one more pass with the mean weights
+            outputs = torch.cat([outputs, self(input, sample=False).unsqueeze(0)], dim=0)
         output = outputs.mean(0)
-        log_prior = log_priors.mean()
-        log_variational_posterior = log_variational_posteriors.mean()
         # predict the aleatoric and epistemic uncertainties
         uncertain_alea = torch.zeros(input.size(0), out_dim, out_dim).to(input.device)
         uncertain_epis = torch.zeros(input.size(0), out_dim, out_dim).to(input.device)
         if eval_uncertain:
-            p = F.softmax(outputs, dim=-1) # N x B x C
-            # compute aleatoric uncertainty
-            p_diag = torch.diag_embed(p, offset=0, dim1=-2, dim2=-1) # N x B x C x C
-            p_cov = torch.matmul(p.unsqueeze(-1), p.unsqueeze(-1).permute(0, 1, 3, 2))  # N x B x C x C
-            uncertain_alea = torch.mean(p_diag - p_cov, dim=0)  # B x C x C
-            # compute epistemic uncertainty 
-            p_bar= torch.mean(p, dim=0)  # B x C
-            p_diff_var = torch.matmul((p-p_bar).unsqueeze(-1), (p-p_bar).unsqueeze(-1).permute(0, 1, 3, 2))  # N x B x C x C
-            uncertain_epis = torch.mean(p_diff_var, dim=0)  # B x C x C
-        
+            uncertain_alea, uncertain_epis = self.uncertainties(F.softmax(outputs, dim=-1))
+
         output_dict = {'pred_mean': output,
                        'log_prior': log_prior,
                        'log_posterior': log_variational_posterior,
@@ -360,9 +324,90 @@ class BayesianPredictor(nn.Module):
                        'epistemic': uncertain_epis}
         return output_dict
 
+    def predict(self, input, npass=10, mc_tol=None, min_pass=4):
+        """ The MC predictions only, without the log prior and posterior, in training mode as well.
+        :param mc_tol: if given, the passes are drawn adaptively (see sample_adaptive) with at most npass passes
+        :return: dict of 'score' (the probability of the class 1), 'aleatoric' and 'epistemic' (the traces), each of B,
+                 and 'npass' (B) the passes used with mc_tol
+        """
+        if mc_tol is not None:
+            output_dict = self.sample_adaptive(input, tol=mc_tol, min_pass=min_pass, max_pass=npass)
+            return {'score': F.softmax(output_dict['pred_mean'], dim=-1)[:, 1],
+                    'aleatoric': torch.diagonal(output_dict['aleatoric'], dim1=-2, dim2=-1).sum(-1),
+                    'epistemic': torch.diagonal(output_dict['epistemic'], dim1=-2, dim2=-1).sum(-1),
+                    'npass': output_dict['npass']}
+        outputs = self(input, sample=True, npass=npass, calculate_log_probs=False)  # N x B x C
+        uncertain_alea, uncertain_epis = self.uncertainties(F.softmax(outputs, dim=-1))
+        # the same score as the softmax of pred_mean of sample_elbo()
+        return {'score': F.softmax(outputs.mean(0), dim=-1)[:, 1],
+                'aleatoric': torch.diagonal(uncertain_alea, dim1=-2, dim2=-1).sum(-1),
+                'epistemic': torch.diagonal(uncertain_epis, dim1=-2, dim2=-1).sum(-1)}
+
+    def sample_adaptive(self, input, tol=1e-3, min_pass=4, max_pass=10, block=2):
+        """ Draw the MC passes in blocks of block passes, until the mean probabilities and the trace of the epistemic
+        uncertainty of each sample change by less than tol from one block to the next, with min_pass to max_pass passes.
+        The samples which have converged are not computed further. No log prior or posterior is computed.
+        :return: dict of 'pred_mean' (B x C), 'aleatoric', 'epistemic' (B x C x C) as of sample_elbo(), and 'npass' (B)
+        """
+        batch_size, out_dim = input.size(0), self.l2.out_features
+        # running sums of the outputs, the probabilities and their outer products of each sample
+        sum_out = input.new_zeros(batch_size, out_dim)
+        sum_p = input.new_zeros(batch_size, out_dim)
+        sum_pp = input.new_zeros(batch_size, out_dim, out_dim)
+        npass = torch.zeros(batch_size, dtype=torch.long, device=input.device)
+        active = torch.arange(batch_size, device=input.device)
+        num_done, prev = 0, None
+        while num_done < max_pass and active.numel() > 0:
+            num = min(block, max_pass - num_done)
+            outputs = self(input[active], sample=True, npass=num, calculate_log_probs=False)  # n x A x C
+            p = F.softmax(outputs, dim=-1)
+            sum_out.index_add_(0, active, outputs.sum(0))
+            sum_p.index_add_(0, active, p.sum(0))
+            sum_pp.index_add_(0, active, torch.einsum('nbi,nbj->bij', p, p))
+            num_done += num
+            npass[active] = num_done
+            # the current estimates of the active samples
+            prob = F.softmax(sum_out[active] / num_done, dim=-1)  # A x C
+            p_bar = sum_p[active] / num_done
+            epis = torch.diagonal(sum_pp[active], dim1=-2, dim2=-1).sum(-1) / num_done - (p_bar ** 2).sum(-1)  # A
+            if prev is not None and num_done >= min_pass:
+                changed = ((prob - prev[0]).abs().max(-1)[0] >= tol) | ((epis - prev[1]).abs() >= tol)
+                active, prob, epis = active[changed], prob[changed], epis[changed]
+            prev = (prob, epis)
+        n = npass.to(input.dtype).unsqueeze(-1)  # B x 1
+        p_bar = sum_p / n
+        mean_pp = sum_pp / n.unsqueeze(-1)
+        return {'pred_mean': sum_out / n,
+                'aleatoric': torch.diag_embed(p_bar) - mean_pp,  # mean of diag(p) - p p^T
+                'epistemic': mean_pp - p_bar.unsqueeze(-1) * p_bar.unsqueeze(-2),  # covariance of p
+                'npass': npass}
+
+    def uncertainties(self, p):
+        """
+        :param p: N x B x C, the softmax outputs of the MC passes
+        :return: the aleatoric and epistemic uncertainties, each of B x C x C
+        """
+        p_bar = torch.mean(p, dim=0)  # B x C
+        if p.size(-1) == 2:
+            # closed form, both matrices are s x [[1, -1], [-1, 1]], with s = mean(p0 * p1) and var(p1) respectively
+            sign = torch.tensor([[1, -1], [-1, 1]], dtype=p.dtype, device=p.device)
+            uncertain_alea = torch.mean(p[..., 0] * p[..., 1], dim=0)[:, None, None] * sign  # B x C x C
+            uncertain_epis = torch.mean((p[..., 1] - p_bar[:, 1]) ** 2, dim=0)[:, None, None] * sign  # B x C x C
+        else:
+            # compute aleatoric uncertainty, mean of diag(p) - p p^T
+            uncertain_alea = torch.diag_embed(p_bar) - torch.einsum('nbi,nbj->bij', p, p) / p.size(0)  # B x C x C
+            # compute epistemic uncertainty
+            p_diff = p - p_bar
+            uncertain_epis = torch.einsum('nbi,nbj->bij', p_diff, p_diff) / p.size(0)  # B x C x C
+        return uncertain_alea, uncertain_epis
+
 
 class UString(nn.Module):
-    def __init__(self, x_dim, h_dim, z_dim, n_layers=1, n_obj=19, n_frames=100, fps=20.0, with_saa=True, uncertain_ranking=False):
+    def __init__(self, x_dim, h_dim, z_dim, n_layers=1, n_obj=19, n_frames=100, fps=20.0, with_saa=True, uncertain_ranking=False, graph_knn=None, local_reparam=False):
+        """
+        :param graph_knn, the number of neighbours of the kNN graphs of the dataset (see build_knn_graph), None for other graphs
+        :param local_reparam, if True, the BNN decoder samples its pre-activations instead of its weights (see BayesianLinear)
+        """
         super(UString, self).__init__()
 
         self.x_dim = x_dim
@@ -374,16 +419,17 @@ class UString(nn.Module):
         self.fps = fps
         self.with_saa = with_saa
         self.uncertain_ranking = uncertain_ranking
+        self.graph_knn = graph_knn
 
         self.phi_x = nn.Sequential(nn.Linear(x_dim, h_dim), nn.ReLU())
 
         # GCN encoder
-        self.enc_gcn1 = GCNConv(h_dim + h_dim, h_dim)
-        self.enc_gcn2 = GCNConv(h_dim + h_dim, z_dim, act=lambda x: x)
+        self.enc_gcn1 = GCNConv(h_dim + h_dim, h_dim, num_neighbors=graph_knn)
+        self.enc_gcn2 = GCNConv(h_dim + h_dim, z_dim, act=lambda x: x, num_neighbors=graph_knn)
         # rnn layer
-        self.rnn = Graph_GRU_GCN(h_dim + h_dim + z_dim, h_dim, n_layers, bias=True)
+        self.rnn = Graph_GRU_GCN(h_dim + h_dim + z_dim, h_dim, n_layers, bias=True, num_neighbors=graph_knn)
         # BNN decoder
-        self.predictor = BayesianPredictor(n_obj * z_dim, 2)
+        self.predictor = BayesianPredictor(n_obj * z_dim, 2, local_reparam=local_reparam)
         if self.with_saa:
             # auxiliary branch
             self.predictor_aux = AccidentPredictor(h_dim + h_dim, 2, dropout=[0.5, 0.0])
@@ -393,11 +439,21 @@ class UString(nn.Module):
         self.ce_loss = torch.nn.CrossEntropyLoss(reduction='none')
 
 
-    def forward(self, x, y, toa, graph, hidden_in=None, edge_weights=None, npass=2, nbatch=80, testing=False, eval_uncertain=False):
+    def forward(self, x, y, toa, graph, hidden_in=None, edge_weights=None, npass=2, nbatch=80, testing=False, eval_uncertain=False, lengths=None, return_hidden=False, node_mask=None, mc_tol=None, min_pass=4):
         """
         :param x, (batchsize, nFrames, nBoxes, Xdim) = (10 x 100 x 20 x 4096)
         :param y, (10 x 2)
         :param toa, (10,)
+        :param graph, (10 x 100 x 2 x 171), or (10 x 2 x 171) if the edge index is shared by all frames,
+                      (10 x 100 x 2 x 19k) for the kNN graphs
+        :param lengths, (10,) the number of valid frames of each video, None if no video is padded.
+                        Padded frames are skipped, their outputs are zeros and the hidden states are carried over.
+        :param hidden_in, (n_layers x 10 x 19 x 256) the initial hidden states, e.g., of the previous window of the videos
+        :param return_hidden, if True, the last hidden states (n_layers x 10 x 19 x 256) are returned as well
+        :param node_mask, (10 x 100 x 19) True for the real objects, None if all are real. The missing objects are masked
+                          out of the GCNs, the GRU and the BNN input, and those missing in all frames of the batch are not computed.
+        :param mc_tol, min_pass: the adaptive MC passes of the BNN decoder in inference, with at most npass passes
+                                 (see BayesianPredictor.sample_adaptive), the outputs have the passes used ('npass') then
         """
         losses = {'cross_entropy': 0,
                   'log_posterior': 0,
@@ -410,56 +466,284 @@ class UString(nn.Module):
             Ut = torch.zeros(x.size(0)).to(x.device)  # B
         all_outputs, all_hidden = [], []
 
-        # import ipdb; ipdb.set_trace()
-        if hidden_in is None:
-            h = Variable(torch.zeros(self.n_layers, x.size(0), self.n_obj, self.h_dim))  # 1 x 10 x 19 x 256
-        else:
-            h = Variable(hidden_in)
-        h = h.to(x.device)
-
-        for t in range(x.size(1)):
-            # reduce the dim of node feature (FC layer)
-            x_t = self.phi_x(x[:, t])  # 10 x 20 x 256
-            img_embed = x_t[:, 0, :].unsqueeze(1).repeat(1, self.n_obj, 1).contiguous()  # 10 x 1 x 256
-            obj_embed = x_t[:, 1:, :]  # 10 x 19 x 256
-            x_t = torch.cat([obj_embed, img_embed], dim=-1)  # 10 x 19 x 512
-
-            # GCN encoder
-            enc = self.enc_gcn1(x_t, graph[:, t], edge_weight=edge_weights[:, t])  # 10 x 19 x 256 (512-->256)
-            z_t = self.enc_gcn2(torch.cat([enc, h[-1]], -1), graph[:, t], edge_weight=edge_weights[:, t])  # 10 x 19 x 128 (512-->128)
-
+        batch_size = x.size(0)
+        lengths_list = lengths.tolist() if lengths is not None else [x.size(1)] * batch_size
+        for t, idx, embed, h in self._recurrence(x, graph, edge_weights, hidden_in, lengths_list, node_mask):
+            y_t, toa_t = (y, toa) if idx is None else (y[idx], toa[idx])
             # BNN decoder
-            embed = z_t.view(z_t.size(0), -1)  # 10 x (19 x 128)
-            output_dict = self.predictor.sample_elbo(embed, npass=npass, testing=testing, eval_uncertain=eval_uncertain)  # B x 2
+            output_dict = self.predictor.sample_elbo(embed, npass=npass, testing=testing, eval_uncertain=eval_uncertain,
+                                                      mc_tol=mc_tol, min_pass=min_pass)  # B x 2
             dec_t = output_dict['pred_mean']
 
-            # recurrence
-            h = self.rnn(torch.cat([x_t, z_t], -1), graph[:, t], h, edge_weight=edge_weights[:, t])  # rnn latent (640)-->256
-
-            # computing losses
+            # computing losses, the per-video losses of padded frames are zeros
             L1 = output_dict['log_posterior'] / nbatch
             L2 = output_dict['log_prior'] / nbatch
-            L3 = self._exp_loss(dec_t, y, t, toa=toa, fps=self.fps)
+            L3 = self._exp_loss(dec_t, y_t, t, toa=toa_t, fps=self.fps)
             losses['log_posterior'] += L1
             losses['log_prior'] += L2
-            losses['cross_entropy'] += L3
+            losses['cross_entropy'] += L3 if idx is None else L3 * idx.size(0) / batch_size
             # uncertainty ranking loss
             if self.uncertain_ranking:
-                L5, Ut = self._uncertainty_ranking(output_dict, Ut)
-                losses['ranking'] += L5
+                L5, U_t = self._uncertainty_ranking(output_dict, Ut if idx is None else Ut[idx])
+                losses['ranking'] += L5 if idx is None else L5 * idx.size(0) / batch_size
+                Ut = U_t if idx is None else Ut.index_copy(0, idx, U_t)
+
+            if idx is not None:
+                output_dict = self._pad_outputs(output_dict, idx, batch_size)
 
             all_outputs.append(output_dict)
-            all_hidden.append(h[-1])
+            all_hidden.append(self._pad_nodes(h[-1]))
 
         if self.with_saa:
             # soft attention to aggregate hidden states of all frames
-            embed_video = self.self_aggregation(torch.stack(all_hidden, dim=-1), 'avg')
+            mask = None
+            if lengths is not None:
+                mask = torch.arange(x.size(1), device=x.device).unsqueeze(0) < lengths.to(x.device).unsqueeze(1)  # 10 x 100
+            embed_video = self.self_aggregation(torch.stack(all_hidden, dim=-1), 'avg', mask=mask)
             dec = self.predictor_aux(embed_video)
             L4 = torch.mean(self.ce_loss(dec, y[:, 1].to(torch.long)))
             losses['auxloss'] = L4
 
+        if return_hidden:
+            return losses, all_outputs, all_hidden, self._pad_nodes(h)
         return losses, all_outputs, all_hidden
 
+    @torch.no_grad()
+    def predict(self, x, graph, edge_weights=None, hidden_in=None, lengths=None, node_mask=None, npass=10, return_hidden=False,
+                alert_threshold=None, alert_epistemic=float('inf'), alert_frames=3, encode_chunk=10, mc_tol=None, min_pass=4):
+        """ Inference only, the per-frame scores and uncertainties without any loss, log prior or posterior, nor the
+        auxiliary branch. The arguments are those of forward(), no labels or times of accidents are needed.
+        :param alert_threshold: if given, early exit: a video alerts once its score has been at least alert_threshold with
+                                an epistemic uncertainty of at most alert_epistemic for alert_frames consecutive frames,
+                                and its further frames are not computed (see eval_tools.early_exit_alerts)
+        :param encode_chunk: with alert_threshold, the frames are encoded by chunks of encode_chunk frames, so that the
+                             chunks after the alerts are not encoded either
+        :param mc_tol, min_pass: the adaptive MC passes, with at most npass passes (see BayesianPredictor.sample_adaptive)
+        :return: dict of 'score' (the accident probability), 'aleatoric' and 'epistemic' (the traces of the uncertainties),
+                 each of 10 x 100, zeros for the padded frames (and those after an alert). With alert_threshold, 'alert'
+                 (10,) the alert frame of each video, -1 if it does not alert, 'num_frames' (10,) the number of frames
+                 computed by the recurrence, and 'encoded_frames' (10,) the number of frames encoded. With mc_tol, 'npass' (10 x 100) the MC passes used for each frame. If return_hidden, the last
+                 hidden states as well.
+        """
+        batch_size, num_frames = x.size(0), x.size(1)
+        # shortened at the alerts, so that _recurrence() stops the videos
+        lengths_list = lengths.tolist() if lengths is not None else [num_frames] * batch_size
+        full_lengths = list(lengths_list)
+        encode_chunk = encode_chunk if alert_threshold is not None else None
+        results = {name: torch.zeros(batch_size, num_frames, device=x.device) for name in ['score', 'aleatoric', 'epistemic']}
+        if mc_tol is not None:
+            results['npass'] = torch.zeros(batch_size, num_frames, dtype=torch.long, device=x.device)
+        alert = torch.full((batch_size,), -1, dtype=torch.long, device=x.device)
+        streak = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        for t, idx, embed, h in self._recurrence(x, graph, edge_weights, hidden_in, lengths_list, node_mask, encode_chunk=encode_chunk):
+            output_dict = self.predictor.predict(embed, npass=npass, mc_tol=mc_tol, min_pass=min_pass)
+            for name in results:
+                if idx is None:
+                    results[name][:, t] = output_dict[name]
+                else:
+                    results[name][idx, t] = output_dict[name]
+            if alert_threshold is not None:
+                rows = idx if idx is not None else torch.arange(batch_size, device=x.device)
+                hit = (output_dict['score'] >= alert_threshold) & (output_dict['epistemic'] <= alert_epistemic)
+                streak[rows] = torch.where(hit, streak[rows] + 1, torch.zeros_like(streak[rows]))
+                for b in rows[streak[rows] >= alert_frames].tolist():
+                    alert[b] = t
+                    lengths_list[b] = t + 1
+                if max(lengths_list) <= t + 1:
+                    break  # all videos have alerted or ended
+        if alert_threshold is not None:
+            results['alert'] = alert
+            results['num_frames'] = torch.tensor(lengths_list, device=x.device)
+            # the chunks which start before the last frame computed of each video
+            results['encoded_frames'] = torch.tensor([min(length, -(-n // encode_chunk) * encode_chunk) for n, length in zip(lengths_list, full_lengths)],
+                                                     device=x.device)
+        if return_hidden:
+            return results, self._pad_nodes(h)
+        return results
+
+    def init_state(self, batch_size=1, device=torch.device('cpu'), with_saa=False):
+        """ The state of step() before the first frame of batch_size streams. It is a dict of tensors, which can be saved
+        by torch.save() (or pickled), e.g., to resume a stream or move it to another process:
+        'hidden': the hidden states (n_layers x 10 x 19 x 256), 'num_frames': the number of frames seen, and
+        'history': the last-layer hidden states of all frames seen, only if with_saa for clip_score(), None otherwise.
+        """
+        return {'hidden': torch.zeros(self.n_layers, batch_size, self.n_obj, self.h_dim, device=device),
+                'num_frames': 0,
+                'history': [] if with_saa else None}
+
+    @torch.no_grad()
+    def step(self, frame_features, detections, state=None, node_mask=None, npass=10, graph_radius=None, mc_tol=None, min_pass=4):
+        """ Streaming inference, one frame of a batch of streams at a time: the graph of the frame is built, the hidden
+        states are updated and the frame is scored, with a constant cost per frame.
+        :param frame_features: (10 x 20 x 4096) the features of the current frame of each stream
+        :param detections: (10 x 19 x 6) the boxes of the frame (numpy array or tensor), the graphs are built as by the datasets
+        :param state: the state returned by the previous step() of the streams, None for their first frame (see init_state)
+        :param node_mask: (10 x 19) True for the real objects, None if all are real
+        :param graph_radius: the radius of the sparse graphs (see build_knn_graph), which needs graph_knn
+        :param mc_tol, min_pass: the adaptive MC passes, with at most npass passes (see BayesianPredictor.sample_adaptive)
+        :return: dict of 'score', 'aleatoric' and 'epistemic' (and 'npass' with mc_tol) as of predict() (each of 10),
+                 and the new state
+        """
+        device = frame_features.device
+        if state is None:
+            state = self.init_state(frame_features.size(0), device=device)
+        detections = detections.cpu().numpy() if torch.is_tensor(detections) else detections
+        if node_mask is not None:
+            node_mask = node_mask if torch.is_tensor(node_mask) else torch.from_numpy(node_mask)
+        # the streams are the frames of build_st_graph()
+        graph_edges, edge_weights = build_st_graph(detections, knn=self.graph_knn, radius=graph_radius,
+                                                   node_mask=node_mask.cpu().numpy() if node_mask is not None else None)
+        node_mask = node_mask.to(device) if node_mask is not None else None
+        graph = NormalizedGraph(torch.from_numpy(graph_edges).to(device), torch.from_numpy(edge_weights).to(device),
+                                self.n_obj, node_mask=node_mask, num_neighbors=self.graph_knn)
+        enc, rnn_x = self._encode(frame_features, graph)
+        embed, h = self._cell(enc, rnn_x, state['hidden'].to(device), graph, node_mask=node_mask)
+        results = self.predictor.predict(embed, npass=npass, mc_tol=mc_tol, min_pass=min_pass)
+        history = state['history'] + [h[-1]] if state['history'] is not None else None
+        return results, {'hidden': h, 'num_frames': state['num_frames'] + 1, 'history': history}
+
+    @torch.no_grad()
+    def clip_score(self, state):
+        """ The accident probability of the auxiliary SAA branch over all frames seen by step(), which needs the
+        history of init_state(with_saa=True). Its cost grows with the number of frames, it is computed on demand only.
+        :return: (10,)
+        """
+        assert self.with_saa and state['history'] is not None, "The state has no history of the hidden states."
+        embed_video = self.self_aggregation(torch.stack(state['history'], dim=-1), 'avg')
+        return F.softmax(self.predictor_aux(embed_video), dim=-1)[:, 1]
+
+    def _recurrence(self, x, graph, edge_weights, hidden_in, lengths_list, node_mask, encode_chunk=None):
+        """ Run the encoder and the recurrence, and yield for each frame t:
+        the indices idx of the videos not ended yet (None for all), the BNN inputs of those videos (10 x (19 x 128)),
+        and the hidden states of all videos after the frame (n_layers x 10 x 19 x 256).
+        lengths_list may be shortened during the iteration, the videos are not computed beyond their new lengths.
+        :param encode_chunk: if given, the frames are encoded by chunks of encode_chunk frames instead of all frames at
+                             once. Only the frames within the lengths (at the start of each chunk) are encoded.
+        """
+        if hidden_in is None:
+            h = torch.zeros(self.n_layers, x.size(0), self.n_obj, self.h_dim, device=x.device)  # 1 x 10 x 19 x 256
+        else:
+            h = Variable(hidden_in)
+        h = h.to(x.device)
+
+        batch_size = x.size(0)
+        if node_mask is not None:
+            node_mask = node_mask.to(x.device)
+            valid = torch.arange(x.size(1), device=x.device).unsqueeze(0) < torch.tensor(lengths_list, device=x.device).unsqueeze(1)
+            if bool((node_mask | ~valid.unsqueeze(-1)).all()):
+                node_mask = None  # all objects of the valid frames are real
+            else:
+                x, h, node_mask, graph, edge_weights = self._trim_nodes(x, h, node_mask, graph, edge_weights)
+        # the normalized graphs of all frames, shared by all graph convolutions of each timestep
+        graph_edges = graph if graph.dim() == 4 else graph.unsqueeze(1)  # 10 x 100 x 2 x 171
+        graphs = NormalizedGraph(graph_edges, edge_weights, x.size(2) - 1, node_mask=node_mask, num_neighbors=self.graph_knn)
+
+        # the frame encoder does not depend on the hidden states, it runs on all frames at once (or by chunks)
+        chunk = x.size(1) if encode_chunk is None else encode_chunk
+        for t in range(x.size(1)):
+            if t % chunk == 0:
+                if max(lengths_list) <= t:
+                    return
+                end = min(t + chunk, x.size(1))
+                valid = torch.arange(t, end, device=x.device).unsqueeze(0) < torch.tensor(lengths_list, device=x.device).unsqueeze(1)  # 10 x 100
+                if bool(valid.all()):
+                    enc_all, rnn_all = self._encode(x[:, t:end], graphs.frames(t, end))  # 10 x 100 x 19 x 256, 10 x 100 x 19 x 768
+                else:
+                    # the padded frames are not encoded, their outputs are zeros
+                    enc, rnn_x = self._encode(x[:, t:end][valid], graphs.frames(t, end).masked(valid))  # M x 19 x 256, M x 19 x 768
+                    enc_all, rnn_all = enc.new_zeros(valid.shape + enc.shape[1:]), rnn_x.new_zeros(valid.shape + rnn_x.shape[1:])
+                    enc_all[valid], rnn_all[valid] = enc, rnn_x
+            graph_t = graphs.select(t)  # 10 graphs
+            enc, rnn_x, h_t = enc_all[:, t % chunk], rnn_all[:, t % chunk], h
+            mask_t = node_mask[:, t] if node_mask is not None else None  # 10 x 19
+            # only the videos not ended yet are computed
+            active = [b for b in range(batch_size) if lengths_list[b] > t]
+            idx = torch.tensor(active, dtype=torch.long, device=x.device) if len(active) < batch_size else None
+            if idx is not None:
+                graph_t, enc, rnn_x, h_t = graph_t[idx], enc[idx], rnn_x[idx], h[:, idx]
+                mask_t = mask_t[idx] if mask_t is not None else None
+            embed, h_t = self._cell(enc, rnn_x, h_t, graph_t, node_mask=mask_t)
+            h = h_t if idx is None else h.index_copy(1, idx, h_t)
+            yield t, idx, embed, h
+
+    def _encode(self, x, graphs):
+        """ The frame encoder, which does not depend on the hidden states.
+        :param x: (...) x 20 x 4096, e.g., 10 x 100 x 20 x 4096 for all frames of a batch
+        :return: the outputs of the first GCN encoder ((...) x 19 x 256), and the GRU input of [obj_embed, img_embed]
+                 of each object ((...) x 19 x 768)
+        """
+        x = self.phi_x(x)  # 10 x 100 x 20 x 256
+        img_embed, obj_embed = x[..., :1, :], x[..., 1:, :]  # 10 x 100 x 1 x 256, 10 x 100 x 19 x 256
+        # both through the split weights
+        enc = self.enc_gcn1.aggregate(self._embed_linear(obj_embed, img_embed, self.enc_gcn1.weight), graphs)  # (512-->256)
+        rnn_x = self._embed_linear(obj_embed, img_embed, self.rnn.weight_x[0].weight)  # (512 + 128) x (3 x 256)
+        return enc, rnn_x
+
+    def _cell(self, enc, rnn_x, h, graph, node_mask=None):
+        """ The second GCN encoder and the recurrence of a frame.
+        :param enc, rnn_x: 10 x 19 x 256 and 10 x 19 x 768, the outputs of _encode() for the frame
+        :param h: n_layers x 10 x 19 x 256
+        :return: the BNN input (10 x (19 x 128)) and the new hidden states (n_layers x 10 x 19 x 256)
+        """
+        # GCN encoder
+        z_t = self.enc_gcn2(torch.cat([enc, h[-1]], -1), graph)  # 10 x 19 x 128 (512-->128)
+
+        # the BNN input, the missing objects are zeros
+        embed = self._pad_nodes(z_t).view(z_t.size(0), -1)  # 10 x (19 x 128)
+
+        # recurrence
+        rnn_x = rnn_x + torch.matmul(z_t, self.rnn.weight_x[0].weight[2 * self.h_dim:])  # [obj_embed, img_embed, z_t] (640)
+        h = self.rnn(None, graph, h, node_mask=node_mask, inp_w=rnn_x)  # rnn latent (640)-->256
+        return embed, h
+
+    def load_state_dict(self, state_dict, strict=True):
+        # the GRU weights were not registered in former checkpoints, they keep their initialization then
+        if strict and not any(key.startswith('rnn.') for key in state_dict):
+            print("Warning: the checkpoint has no GRU weights, they are initialized randomly.")
+            state_dict = dict(state_dict, **{'rnn.' + key: value for key, value in self.rnn.state_dict().items()})
+        return super(UString, self).load_state_dict(state_dict, strict=strict)
+
+    def _embed_linear(self, obj_embed, img_embed, weight):
+        # [obj_embed, img_embed] x weight[:512], without repeating the image embedding for each object
+        return torch.matmul(obj_embed, weight[:self.h_dim]) + torch.matmul(img_embed, weight[self.h_dim: 2 * self.h_dim])
+
+    def _trim_nodes(self, x, h, node_mask, graph, edge_weights):
+        """ Drop the trailing objects which are missing in all frames of the batch, their outputs would be zeros anyway.
+        """
+        real = node_mask.flatten(0, 1).any(0).nonzero()
+        num_nodes = int(real.max()) + 1 if real.numel() > 0 else 1
+        if num_nodes == self.n_obj or (self.graph_knn is None and graph.dim() == 4):
+            return x, h, node_mask, graph, edge_weights
+        x, h, node_mask = x[:, :, :num_nodes + 1], h[:, :, :num_nodes], node_mask[:, :, :num_nodes]
+        if self.graph_knn is not None:
+            # node-major edges, the neighbours among the dropped objects get zero weights
+            num_edges = num_nodes * self.graph_knn
+            rows, cols = graph[..., 0, :num_edges], graph[..., 1, :num_edges]
+            edge_weights = edge_weights[..., :num_edges] * (cols < num_nodes).to(edge_weights.dtype)
+            graph = torch.stack([rows, cols.clamp(max=num_nodes - 1)], dim=-2)
+        else:
+            # the complete graph shared by all videos and frames
+            rows, cols = graph.view(-1, 2, graph.size(-1))[0]
+            keep = ((rows < num_nodes) & (cols < num_nodes)).nonzero().view(-1)
+            graph, edge_weights = graph.index_select(-1, keep), edge_weights.index_select(-1, keep)
+        return x, h, node_mask, graph, edge_weights
+
+    def _pad_nodes(self, h):
+        # zeros for the objects dropped by _trim_nodes(), e.g., 10 x 12 x 256 --> 10 x 19 x 256
+        if h.size(-2) == self.n_obj:
+            return h
+        return F.pad(h, (0, 0, 0, self.n_obj - h.size(-2)))
+
+
+    def _pad_outputs(self, output_dict, idx, batch_size):
+        """ Scatter the outputs of the active videos idx into the full batch, with zeros for the others.
+        """
+        for key in ['pred_mean', 'aleatoric', 'epistemic', 'npass']:
+            if key not in output_dict:
+                continue
+            out = output_dict[key]
+            output_dict[key] = out.new_zeros((batch_size,) + out.size()[1:]).index_copy(0, idx, out)
+        return output_dict
 
     def _exp_loss(self, pred, target, time, toa, fps=20.0):
         '''
@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import numpy as np
+
+
+def load_anno_index(index_file, src_files, compile_fn):
+    """ Load a compiled annotation index, it is (re)compiled if it is missing or any source file changed.
+    :param: index_file: the .npz file of the compiled index
+    :param: src_files: all annotation files the index is compiled from
+    :param: compile_fn: callable returning a dict of arrays, e.g., the file list, labels and time-of-accidents
+    :return: dict of arrays
+    """
+    fingerprint = source_fingerprint(src_files)
+    if os.path.exists(index_file):
+        data = np.load(index_file)
+        if str(data['fingerprint']) == fingerprint:
+            return {name: data[name] for name in data.files if name != 'fingerprint'}
+        print("Annotations changed, re-compiling: %s"%(index_file))
+    index = compile_fn()
+    if not os.path.exists(os.path.dirname(index_file)):
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    tmp_file = index_file[:-4] + '.%d.tmp.npz' % (os.getpid())
+    np.savez(tmp_file, fingerprint=fingerprint, **index)
+    os.replace(tmp_file, index_file)
+    return index
+
+
+def list_files(dirs):
+    # all files under the given directories, without parsing any of them
+    all_files = []
+    for dirname in dirs:
+        if os.path.isdir(dirname):
+            all_files.extend(entry.path for entry in os.scandir(dirname) if entry.is_file())
+    return sorted(all_files)
+
+
+def source_fingerprint(src_files):
+    h = hashlib.sha1()
+    for filename in src_files:
+        stat = os.stat(filename)
+        h.update(('%s:%d:%d\n' % (filename, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+    return h.hexdigest()
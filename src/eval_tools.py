@@ -3,11 +3,12 @@ import matplotlib.pyplot as plt
 import os
 from scipy.interpolate import make_interp_spline
 
-def evaluation(all_pred, all_labels, time_of_accidents, fps=20.0):
+def evaluation(all_pred, all_labels, time_of_accidents, fps=20.0, lengths=None):
     """
     :param: all_pred (N x T), where N is number of videos, T is the number of frames for each video
     :param: all_labels (N,)
     :param: time_of_accidents (N,) int element
+    :param: lengths (N,) the number of valid frames of each video if padded, None if all videos have T frames
     :output: AP (average precision, AUC), mTTA (mean Time-to-Accident), TTA@R80 (TTA at Recall=80%)
     """
 
@@ -18,12 +19,12 @@ def evaluation(all_pred, all_labels, time_of_accidents, fps=20.0):
         if all_labels[idx] > 0:
             pred = all_pred[idx, :int(toa)]  # positive video
         else:
-            pred = all_pred[idx, :]  # negative video
+            pred = all_pred[idx, :] if lengths is None else all_pred[idx, :int(lengths[idx])]  # negative video
         # find the minimum prediction
         min_pred = np.min(pred) if min_pred > np.min(pred) else min_pred
         preds_eval.append(pred)
         n_frames += len(pred)
-    total_seconds = all_pred.shape[1] / fps
+    total_seconds = all_pred.shape[1] / fps if lengths is None else np.mean(lengths) / fps
 
     # iterate a set of thresholds from the minimum predictions
     # temp_shape = int((1.0 - max(min_pred, 0)) / 0.001 + 0.5) 
@@ -96,6 +97,49 @@ def evaluation(all_pred, all_labels, time_of_accidents, fps=20.0):
     return AP, mTTA, TTA_R80
 
 
+def early_exit_alerts(all_pred, all_epistemic, threshold=0.5, max_epistemic=np.inf, num_frames=3, lengths=None):
+    """ The alert rule of UString.predict(alert_threshold=...): a video alerts at the first frame at which its score has
+    been at least threshold, with an epistemic uncertainty of at most max_epistemic, for num_frames consecutive frames.
+    :param: all_pred, all_epistemic (N x T)
+    :output: (N,) the alert frame of each video, -1 if it does not alert
+    """
+    hit = (all_pred >= threshold) & (all_epistemic <= max_epistemic)  # N x T
+    if lengths is not None:
+        hit &= np.arange(all_pred.shape[1])[None, :] < np.asarray(lengths)[:, None]
+    alerts = np.full(len(all_pred), -1, dtype=np.int64)
+    streak = np.zeros(len(all_pred), dtype=np.int64)
+    for t in range(all_pred.shape[1]):
+        streak = np.where(hit[:, t], streak + 1, 0)
+        alerts[(alerts < 0) & (streak >= num_frames)] = t
+    return alerts
+
+
+def evaluation_alerts(all_pred, all_epistemic, all_labels, time_of_accidents, fps=20.0, lengths=None, threshold=0.5,
+                      max_epistemic=np.inf, num_frames=3):
+    """ Compare the early-exit alerts with the full processing of the videos. The frames after an alert are not processed,
+    the score of the alert frame is held instead, so that evaluation() applies to the full and the stopped predictions.
+    An alert is true if the video is positive and the alert is before its time of accident.
+    :output: dict of the alert frames, the precision and recall of the alerts, their mTTA (in seconds, over the true
+             alerts), the fraction of frames saved, and (AP, mTTA, TTA_R80) of evaluation() for 'full' and 'stopped'
+    """
+    lengths = np.full(len(all_pred), all_pred.shape[1]) if lengths is None else np.asarray(lengths)
+    alerts = early_exit_alerts(all_pred, all_epistemic, threshold, max_epistemic, num_frames, lengths=lengths)
+    alerted = alerts >= 0
+    positives = np.asarray(all_labels) > 0
+    true_alerts = alerted & positives & (alerts < np.asarray(time_of_accidents))
+    stopped = all_pred.copy()
+    for i in np.nonzero(alerted)[0]:
+        stopped[i, alerts[i] + 1:lengths[i]] = all_pred[i, alerts[i]]
+    processed = np.where(alerted, alerts + 1, lengths)
+    return {'alerts': alerts,
+            'precision': float(np.sum(true_alerts)) / max(np.sum(alerted), 1),
+            'recall': float(np.sum(true_alerts)) / max(np.sum(positives), 1),
+            'mTTA': float(np.mean(np.asarray(time_of_accidents)[true_alerts] - alerts[true_alerts])) / fps if np.any(true_alerts) else 0.0,
+            'frames_saved': 1.0 - float(np.sum(processed)) / np.sum(lengths),
+            'full': evaluation(all_pred, all_labels, time_of_accidents, fps=fps, lengths=lengths),
+            'stopped': evaluation(stopped, all_labels, time_of_accidents, fps=fps, lengths=lengths)}
+
+
 def print_results(Epochs, APvid_all, AP_all, mTTA_all, TTA_R80_all, Unc_all, result_dir):
     result_file = os.path.join(result_dir, 'eval_all.txt')
     with open(result_file, 'w') as f:
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import numpy as np
+
+INDEX_FILE = 'index.json'
+ALIGNMENT = 4096  # every array starts on a page boundary
+
+
+class FeatureStore(object):
+    """ Packed feature store: a few large uncompressed shard files plus an offset index.
+    Samples are read through np.memmap, so each field is a zero-copy view on the page cache
+    which is shared by all the processes reading the same store.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_file = os.path.join(store_dir, INDEX_FILE)
+        assert os.path.exists(self.index_file), "Feature store does not exist: %s"%(store_dir)
+        with open(self.index_file, 'r') as f:
+            index = json.load(f)
+        self.shard_files = index['shards']
+        self.samples = index['samples']
+        self._shards = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, key):
+        return key in self.samples
+
+    def __getitem__(self, key):
+        """
+        :param: key: path of the original .npz file, relative to the packed directory
+        :return: dict of arrays, with the same fields as the original .npz file
+        """
+        record = {}
+        for name, (shard_id, offset, shape, dtype) in self.samples[key].items():
+            count = int(np.prod(shape))
+            shard = self.get_shard(shard_id)
+            record[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shard, offset=offset) if count > 0 \
+                else np.zeros(shape, dtype=np.dtype(dtype))
+        return record
+
+    def get_shard(self, shard_id):
+        # shards are opened lazily, so that each worker process maps them by itself.
+        # copy-on-write mapping: views are writable (torch expects that), pages stay shared until written.
+        if self._shards is None:
+            self._shards = [None] * len(self.shard_files)
+        if self._shards[shard_id] is None:
+            self._shards[shard_id] = np.memmap(os.path.join(self.store_dir, self.shard_files[shard_id]), dtype=np.uint8, mode='c')
+        return self._shards[shard_id]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+
+def pack_features(src_dir, store_dir, shard_size=4 * 1024**3):
+    """ Convert a directory of (compressed) .npz files into a packed feature store.
+    :param: src_dir: e.g., data/dad/vgg16_features, which is searched recursively
+    :param: store_dir: the output directory
+    :param: shard_size: the maximum size in bytes of each shard file
+    """
+    from tqdm import tqdm
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    all_files = []
+    for root, _, filenames in os.walk(src_dir):
+        for filename in filenames:
+            if filename.endswith('.npz'):
+                all_files.append(os.path.relpath(os.path.join(root, filename), src_dir).replace(os.sep, '/'))
+    all_files = sorted(all_files)
+
+    shards, samples = [], {}
+    fid, offset = None, 0
+    for key in tqdm(all_files, desc='Packing'):
+        data = np.load(os.path.join(src_dir, key))
+        arrays = [(name, np.asarray(data[name], order='C')) for name in data.files]
+        nbytes = sum(_aligned(arr.nbytes) for _, arr in arrays)
+        # start a new shard if the current one is full
+        if fid is None or (offset > 0 and offset + nbytes > shard_size):
+            if fid is not None:
+                fid.close()
+            shards.append('shard_%05d.bin' % (len(shards)))
+            fid = open(os.path.join(store_dir, shards[-1]), 'wb')
+            offset = 0
+        record = {}
+        for name, arr in arrays:
+            fid.write(arr.tobytes())
+            fid.write(b'\0' * (_aligned(arr.nbytes) - arr.nbytes))
+            record[name] = [len(shards) - 1, offset, list(arr.shape), arr.dtype.str]
+            offset += _aligned(arr.nbytes)
+        samples[key] = record
+    if fid is not None:
+        fid.close()
+    # the index is written last, an interrupted conversion leaves no valid store behind
+    with open(os.path.join(store_dir, INDEX_FILE), 'w') as f:
+        json.dump({'shards': shards, 'samples': samples}, f)
+    return len(samples)
+
+
+def _aligned(nbytes):
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack the .npz feature files of a dataset into a feature store.')
+    parser.add_argument('--src_dir', type=str, required=True,
+                        help='The feature directory, e.g., ./data/dad/vgg16_features')
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='The directory of the packed feature store.')
+    parser.add_argument('--shard_size', type=int, default=4,
+                        help='The maximum size of each shard file in GB. Default: 4')
+    p = parser.parse_args()
+
+    num_samples = pack_features(p.src_dir, p.out_dir, shard_size=p.shard_size * 1024**3)
+    print('Packed samples: %d' % (num_samples))
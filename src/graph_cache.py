@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import zipfile
+import numpy as np
+
+
+class GraphCache(object):
+    """ Sidecar store of the precomputed (edge_weights, toa, label) of each video.
+    One small .npz entry per video is kept under cache_dir. An entry is valid as long as the
+    modification times of its source files are unchanged, so that a cache hit reads nothing else. If they have changed,
+    or to verify the entries, the entry is still valid as long as the hash of the detections is unchanged.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        # known modification times of the source files (e.g., from a verified manifest), which are not stat'ed again
+        self.mtimes = {}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_file(self, data_file, mode=''):
+        key = hashlib.sha1((os.path.abspath(data_file) + mode).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def load(self, data_file, src_files, det_hash=None, mode='', verify=False):
+        """
+        :param: data_file: the feature file of the video, used as the cache key
+        :param: src_files: all files the graph is computed from (features, detections, labels)
+        :param: det_hash: callable returning the hash of the detections and node mask (see detection_hash), only called if the
+                          modification times have changed or with verify. The entry is then valid if the hashes match,
+                          and its modification times are updated. None to only check the modification times.
+        :param: mode: the graph mode, e.g., ':knn4', entries of different modes are kept apart
+        :param: verify: if True, the hash of the detections is always checked
+        :return: dict of edge_weights, toa, label, num_boxes (and the per-frame graph_edges of sparse graphs),
+                 or None if no valid entry exists
+        """
+        entry_file = self.entry_file(data_file, mode)
+        try:
+            entry = np.load(entry_file)
+            mtimes = self.source_mtimes(src_files)
+            unchanged = np.array_equal(entry['mtimes'], mtimes)
+            if not unchanged or verify:
+                if det_hash is None or str(entry['det_hash']) != det_hash():
+                    return None
+            result = {'edge_weights': entry['edge_weights'],
+                      'toa': entry['toa'],
+                      'label': entry['label'],
+                      'num_boxes': int(entry['num_boxes'])}
+            if 'graph_edges' in entry.files:
+                result['graph_edges'] = entry['graph_edges']
+            if not unchanged:
+                # the sources were touched but the detections are the same
+                self.save(data_file, src_files, str(entry['det_hash']), result['edge_weights'], result['toa'], result['label'],
+                          result['num_boxes'], mode=mode, graph_edges=result.get('graph_edges'))
+            return result
+        except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+            # missing or broken entry, e.g. from an interrupted run, it will be overwritten
+            return None
+
+    def save(self, data_file, src_files, det_hash, edge_weights, toa, label, num_boxes, mode='', graph_edges=None):
+        entry_file = self.entry_file(data_file, mode)
+        if not os.path.exists(os.path.dirname(entry_file)):
+            os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        # write to a temporary file first, so that concurrent readers never see a partial entry
+        tmp_file = entry_file[:-4] + '.%d.tmp.npz' % (os.getpid())
+        # the edge index of the complete graph is regenerated from num_boxes, only sparse graphs store theirs
+        extra = {'graph_edges': graph_edges} if graph_edges is not None else {}
+        np.savez(tmp_file, edge_weights=edge_weights, toa=toa, label=label, num_boxes=num_boxes,
+                 mtimes=self.source_mtimes(src_files), det_hash=det_hash, data_file=os.path.abspath(data_file), **extra)
+        os.replace(tmp_file, entry_file)
+
+    def source_mtimes(self, src_files):
+        if all(filename in self.mtimes for filename in src_files):
+            return np.array([self.mtimes[filename] for filename in src_files], dtype=np.int64)
+        return source_mtimes(src_files)
+
+
+def source_mtimes(src_files):
+    return np.array([os.stat(filename).st_mtime_ns for filename in src_files], dtype=np.int64)
+
+
+def detection_hash(detections, node_mask=None):
+    """ The hash of the inputs of a graph, the detections and the node mask (None if all boxes are real).
+    """
+    detections = np.ascontiguousarray(detections)
+    h = hashlib.sha1(str((detections.shape, detections.dtype.str)).encode('utf-8'))
+    h.update(detections.tobytes())
+    if node_mask is not None and not np.all(node_mask):
+        h.update(np.ascontiguousarray(node_mask, dtype=bool).tobytes())
+    return h.hexdigest()
+
+
+def _prewarm_init(dataset):
+    global _prewarm_dataset
+    _prewarm_dataset = dataset
+
+
+def _prewarm_one(index):
+    # the existing entries are verified against the detections
+    _prewarm_dataset.load_graph(index, verify=True)
+    return index
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from multiprocessing import Pool
+    from tqdm import tqdm
+    ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT_PATH)
+    from src.DataLoader import DADDataset, A3DDataset, CrashDataset
+
+    parser = argparse.ArgumentParser(description='Pre-warm the graph cache of a dataset.')
+    parser.add_argument('--data_path', type=str, default='./data',
+                        help='The relative path of dataset.')
+    parser.add_argument('--dataset', type=str, default='dad', choices=['a3d', 'dad', 'crash'],
+                        help='The name of dataset. Default: dad')
+    parser.add_argument('--feature_name', type=str, default='vgg16', choices=['vgg16', 'res101'],
+                        help='The name of feature embedding methods. Default: vgg16')
+    parser.add_argument('--graph_cache', type=str, required=True,
+                        help='The directory of the graph cache.')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='The number of worker processes. Default: 8')
+    p = parser.parse_args()
+
+    data_path = os.path.join(ROOT_PATH, p.data_path, p.dataset)
+    if p.dataset == 'dad':
+        all_data = [DADDataset(data_path, p.feature_name, phase, graph_cache=p.graph_cache) for phase in ['training', 'testing']]
+    elif p.dataset == 'a3d':
+        all_data = [A3DDataset(data_path, p.feature_name, phase, graph_cache=p.graph_cache) for phase in ['train', 'test']]
+    elif p.dataset == 'crash':
+        all_data = [CrashDataset(data_path, p.feature_name, phase, graph_cache=p.graph_cache) for phase in ['train', 'test']]
+    else:
+        raise NotImplementedError
+
+    for dataset in all_data:
+        pool = Pool(p.num_workers, initializer=_prewarm_init, initargs=(dataset,))
+        for _ in tqdm(pool.imap_unordered(_prewarm_one, range(len(dataset)), chunksize=16),
+                      desc='Phase: %s' % (dataset.phase), total=len(dataset)):
+            pass
+        pool.close()
+        pool.join()
+    print("Done!")
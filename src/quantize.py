@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+
+FEATURE_DTYPES = ['float32', 'float16', 'int8']
+
+
+class QuantizedArray(object):
+    """ int8 features with a scale and an offset per row (i.e., per node of each frame), dequantized lazily:
+    collate_batch() writes them straight into the float32 batch tensor, without an intermediate copy.
+    """
+    def __init__(self, data, scale, offset):
+        """
+        :param: data: int8, e.g., 100 x 20 x 4096
+        :param: scale, offset: float32, e.g., 100 x 20
+        """
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        # slicing frames, e.g., for the sliding-window mode
+        return QuantizedArray(self.data[index], self.scale[index], self.offset[index])
+
+    def dequantize(self, out=None, dtype=np.float32):
+        """
+        :param: out: optional output array (or the numpy view of a tensor) of the same shape
+        """
+        if out is None:
+            out = np.empty(self.data.shape, dtype=dtype)
+        np.add(self.data, out.dtype.type(128), out=out)
+        out *= self.scale[..., None]
+        out += self.offset[..., None]
+        return out
+
+
+def quantize_features(features, dtype='float32', key='data'):
+    """ Convert the features to the storage dtype.
+    :param: features: float32, e.g., 100 x 20 x 4096
+    :param: dtype: 'float32', 'float16' or 'int8' (with a scale and an offset per row)
+    :return: dict of the arrays to save, i.e., {key: ...} and {key_scale: ..., key_offset: ...} for int8
+    """
+    assert dtype in FEATURE_DTYPES, "Unsupported feature dtype: %s"%(dtype)
+    features = np.asarray(features, dtype=np.float32)
+    if dtype != 'int8':
+        return {key: features.astype(dtype)}
+    low = features.min(axis=-1)
+    high = features.max(axis=-1)
+    scale = (high - low) / 255.0
+    scale[scale == 0] = 1.0  # constant rows, e.g., zero-padded boxes
+    quantized = np.rint((features - low[..., None]) / scale[..., None]) - 128
+    return {key: np.clip(quantized, -128, 127).astype(np.int8),
+            key + '_scale': scale.astype(np.float32),
+            key + '_offset': low.astype(np.float32)}
+
+
+def load_features(data, key='data'):
+    """ Read the features from a loaded .npz file or feature store sample.
+    :return: np.ndarray (float32 or float16), or QuantizedArray for int8 features
+    """
+    if key + '_scale' in data:
+        return QuantizedArray(data[key], data[key + '_scale'], data[key + '_offset'])
+    return data[key]
+
+
+def dequantize(features, dtype=np.float32):
+    if isinstance(features, QuantizedArray):
+        return features.dequantize(dtype=dtype)
+    return np.asarray(features, dtype=dtype)
+
+
+def convert_features(src_dir, dest_dir, dtype, key='data'):
+    """ Convert a directory of .npz feature files to another feature dtype, other arrays and files (e.g., file lists) are copied.
+    :param: src_dir: e.g., data/dad/vgg16_features, which is searched recursively
+    """
+    import shutil
+    from tqdm import tqdm
+    all_files = []
+    for root, _, filenames in os.walk(src_dir):
+        for filename in filenames:
+            rel_file = os.path.relpath(os.path.join(root, filename), src_dir)
+            if filename.endswith('.npz'):
+                all_files.append(rel_file)
+                continue
+            if not os.path.exists(os.path.join(dest_dir, os.path.dirname(rel_file))):
+                os.makedirs(os.path.join(dest_dir, os.path.dirname(rel_file)))
+            shutil.copyfile(os.path.join(src_dir, rel_file), os.path.join(dest_dir, rel_file))
+    src_bytes, dest_bytes = 0, 0
+    for filename in tqdm(sorted(all_files), desc='Converting'):
+        data = np.load(os.path.join(src_dir, filename))
+        arrays = {name: data[name] for name in data.files if name not in [key, key + '_scale', key + '_offset']}
+        arrays.update(quantize_features(dequantize(load_features(data, key)), dtype, key=key))
+        dest_file = os.path.join(dest_dir, filename)
+        if not os.path.exists(os.path.dirname(dest_file)):
+            os.makedirs(os.path.dirname(dest_file))
+        np.savez_compressed(dest_file, **arrays)
+        src_bytes += os.path.getsize(os.path.join(src_dir, filename))
+        dest_bytes += os.path.getsize(dest_file)
+    return src_bytes, dest_bytes
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert the .npz feature files of a dataset to a reduced-precision dtype.')
+    parser.add_argument('--src_dir', type=str, required=True,
+                        help='The feature directory, e.g., ./data/dad/vgg16_features')
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='The directory of the converted feature files.')
+    parser.add_argument('--dtype', type=str, default='float16', choices=FEATURE_DTYPES,
+                        help='The dtype of the features. Default: float16')
+    parser.add_argument('--key', type=str, default='data',
+                        help='The name of the features in the .npz files, e.g., features for A3D. Default: data')
+    p = parser.parse_args()
+
+    src_bytes, dest_bytes = convert_features(p.src_dir, p.out_dir, p.dtype, key=p.key)
+    print('Size: %.2f GB --> %.2f GB (%.2fx)' % (src_bytes / 1024.0**3, dest_bytes / 1024.0**3, src_bytes / float(max(dest_bytes, 1))))
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from src.quantize import QuantizedArray, load_features
+
+
+def node_mask(num_boxes, n_obj):
+    """
+    :param: num_boxes: T, the number of real boxes of each frame, which come first
+    :return: T x n_obj, True for the real boxes
+    """
+    return np.arange(n_obj)[None, :] < np.asarray(num_boxes)[:, None]
+
+
+def pack_rois(features, num_boxes):
+    """ Keep only the frame feature and the real ROI features of each frame.
+    :param: features: T x (1 + n_obj) x D, e.g., 100 x 20 x 4096
+    :return: (T + sum(num_boxes)) x D
+    """
+    return features[node_mask(np.asarray(num_boxes) + 1, features.shape[1])]
+
+
+def pack_detections(detections, num_boxes):
+    """
+    :param: detections: T x n_obj x 6
+    :return: sum(num_boxes) x 6
+    """
+    return detections[node_mask(num_boxes, detections.shape[1])]
+
+
+def unpack_rois(rows, num_boxes, n_obj):
+    """ Inverse of pack_rois(), the missing ROIs are zeros.
+    :param: rows: np.ndarray or QuantizedArray of the packed features
+    :return: T x (1 + n_obj) x D
+    """
+    valid = node_mask(np.asarray(num_boxes) + 1, n_obj + 1)
+    if isinstance(rows, QuantizedArray):
+        # int8 zeros are -128 with a unit scale and a zero offset
+        return QuantizedArray(_unpack(rows.data, valid, -128), _unpack(rows.scale, valid, 1), _unpack(rows.offset, valid, 0))
+    return _unpack(rows, valid, 0)
+
+
+def unpack_detections(rows, num_boxes, n_obj):
+    return _unpack(rows, node_mask(num_boxes, n_obj), 0)
+
+
+def _unpack(rows, valid, fill_value):
+    # the rows are in the C order of the valid entries
+    out = np.full(valid.shape + rows.shape[1:], fill_value, dtype=rows.dtype)
+    out[valid] = rows
+    return out
+
+
+def load_rois(data, key, n_obj):
+    """ Read the features and the node mask from a loaded .npz file or feature store sample.
+    Files without 'num_boxes' are padded to n_obj boxes, all of them are taken as real.
+    :return: features (T x (1 + n_obj) x D), node_mask (T x n_obj)
+    """
+    features = load_features(data, key)
+    if 'num_boxes' not in data:
+        return features, np.ones((len(features), n_obj), dtype=bool)
+    num_boxes = data['num_boxes']
+    return unpack_rois(features, num_boxes, n_obj), node_mask(num_boxes, n_obj)
+
+
+def read_node_mask(data, n_obj):
+    # without reading the features, None if all boxes are real
+    return node_mask(data['num_boxes'], n_obj) if 'num_boxes' in data else None
+
+
+def load_detections(data, n_obj, key='det'):
+    # T x n_obj x 6, zeros for the missing boxes
+    if 'num_boxes' not in data:
+        return data[key]
+    return unpack_detections(data[key], data['num_boxes'], n_obj)
+
+
+def slice_frames(data, start, end, key):
+    """ The frames [start, end) of a loaded .npz file or feature store sample, e.g., a window of a long video.
+    The per-frame arrays (the features of key, the detections and the number of boxes) are sliced before being read,
+    so that only the rows of these frames are read from a feature store.
+    :return: dict with the same fields as data
+    """
+    frame_keys = [key, key + '_scale', key + '_offset', 'det', 'num_boxes']
+    names = data.files if hasattr(data, 'files') else list(data.keys())
+    record = {name: data[name] for name in names if name not in frame_keys}
+    if 'num_boxes' in names:
+        # packed rows, 1 + num_boxes feature rows and num_boxes detection rows per frame
+        num_boxes = data['num_boxes']
+        end = min(end, len(num_boxes))
+        roi_offsets = np.concatenate([[0], np.cumsum(np.asarray(num_boxes) + 1)])
+        det_offsets = np.concatenate([[0], np.cumsum(num_boxes)])
+        rows = {key: roi_offsets, key + '_scale': roi_offsets, key + '_offset': roi_offsets, 'det': det_offsets}
+        record['num_boxes'] = num_boxes[start:end]
+        for name, offsets in rows.items():
+            if name in names:
+                record[name] = data[name][offsets[start]:offsets[end]]
+    else:
+        for name in frame_keys:
+            if name in names:
+                record[name] = data[name][start:end]
+    return record
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import atexit
+import shutil
+import hashlib
+import pickle
+import tempfile
+import multiprocessing
+import numpy as np
+from src.quantize import QuantizedArray
+
+HITS, MISSES, EVICTIONS, BYTES = 0, 1, 2, 3
+
+
+class SampleCache(object):
+    """ Byte-budgeted LRU cache of decoded samples, shared by the DataLoader worker processes.
+    Entries are files on a memory-backed file system (/dev/shm), the LRU order is their modification time.
+    The lock and the counters are created by the main process and inherited by the workers.
+    """
+    def __init__(self, max_bytes, feature_dtype=None, root='/dev/shm'):
+        """
+        :param: max_bytes: the budget of all cached entries in bytes
+        :param: feature_dtype: if given, e.g., 'float16', features are down-cast to it before caching
+        """
+        self.max_bytes = max_bytes
+        self.feature_dtype = np.dtype(feature_dtype) if feature_dtype is not None else None
+        self.cache_dir = tempfile.mkdtemp(prefix='ustring_cache_', dir=root if os.path.isdir(root) else None)
+        self.lock = multiprocessing.Lock()
+        self.counters = multiprocessing.Array('q', 4)  # hits, misses, evictions, bytes
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+
+    def entry_file(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, key):
+        entry_file = self.entry_file(key)
+        try:
+            with open(entry_file, 'rb') as f:
+                sample = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self._count(MISSES)
+            return None
+        try:
+            os.utime(entry_file, None)  # mark as recently used
+        except OSError:
+            pass  # evicted by another process in the meantime
+        self._count(HITS)
+        return sample
+
+    def put(self, key, sample):
+        """
+        :param: sample: tuple of the dataset outputs, the features come first
+        """
+        sample = tuple(sample)
+        features = sample[0]
+        if isinstance(features, QuantizedArray):
+            sample = (QuantizedArray(np.array(features.data), np.array(features.scale), np.array(features.offset)),) + sample[1:]
+        elif self.feature_dtype is not None and np.issubdtype(features.dtype, np.floating):
+            sample = (features.astype(self.feature_dtype),) + sample[1:]
+        else:
+            sample = (np.array(features),) + sample[1:]  # not a view on a memory-mapped file
+        data = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        entry_file = self.entry_file(key)
+        tmp_file = entry_file + '.%d.tmp' % (os.getpid())
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            if os.path.exists(entry_file):
+                # cached by another worker in the meantime
+                os.remove(tmp_file)
+                return
+            self._evict(self.counters[BYTES] + len(data) - self.max_bytes)
+            os.rename(tmp_file, entry_file)
+            self.counters[BYTES] += len(data)
+
+    def _evict(self, nbytes):
+        # called with the lock held, remove the least recently used entries until nbytes are freed
+        if nbytes <= 0:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        for _, size, path in sorted(entries):
+            if nbytes <= 0:
+                break
+            os.remove(path)
+            self.counters[BYTES] -= size
+            self.counters[EVICTIONS] += 1
+            nbytes -= size
+
+    def _count(self, counter):
+        with self.counters.get_lock():
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.counters.get_lock():
+            hits, misses, evictions, nbytes = self.counters[:]
+        return {'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'bytes': nbytes,
+                'hit_rate': hits / float(max(hits + misses, 1))}
+
+    def close(self):
+        if os.getpid() == self.owner_pid and os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,202 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import io
+import json
+import time
+import zlib
+import zipfile
+import asyncio
+import concurrent.futures
+import numpy as np
+import torch
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class ClipScoringService(object):
+    """ Long-lived clip scoring over HTTP: the model is loaded once, and the concurrent requests are coalesced into
+    batches of UString.predict(). A batch is run as soon as it has max_batch_size clips, or when its first clip has
+    waited for max_latency seconds.
+    POST /score with a feature file of demo.py (or of the datasets) as body returns the per-frame 'score', 'aleatoric'
+    and 'epistemic' as JSON, GET /stats returns the number of requests and batches.
+    """
+    def __init__(self, model, device=torch.device('cpu'), max_batch_size=8, max_latency=0.01, npass=10, graph_radius=None, key='data'):
+        self.model = model.to(device=device)
+        self.model.eval()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.npass = npass
+        self.graph_radius = graph_radius
+        self.key = key
+        # the model runs in a single thread, the clips are decoded in the default executor meanwhile
+        self.model_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.num_requests, self.num_batches = 0, 0
+
+    def load_clip(self, data):
+        """ Decode a feature file and build its graph as demo.load_input_data().
+        :param data: the bytes of an .npz file with the features and the detections ('det') of a clip
+        :return: the sample of collate_batch(), the labels and the time of accident are not used
+        """
+        from src.DataLoader import build_st_graph
+        from src.quantize import dequantize
+        from src.rois import load_rois, load_detections
+        data = np.load(io.BytesIO(data))
+        features, node_mask = load_rois(data, self.key, self.model.n_obj)
+        detections = load_detections(data, self.model.n_obj)
+        graph_edges, edge_weights = build_st_graph(detections, knn=self.model.graph_knn, radius=self.graph_radius, node_mask=node_mask)
+        return dequantize(features), np.array([0, 1]), graph_edges, edge_weights, np.array([0.0]), node_mask
+
+    def run_batch(self, samples):
+        from src.DataLoader import collate_batch
+        batch = collate_batch(samples)
+        batch_xs, _, graph_edges, edge_weights, _, batch_lens, node_masks = [data.to(self.device) for data in batch[:7]]
+        results = self.model.predict(batch_xs, graph_edges, edge_weights=edge_weights, lengths=batch_lens, node_mask=node_masks, npass=self.npass)
+        results = {name: value.cpu().numpy() for name, value in results.items()}
+        lengths = batch_lens.tolist()
+        return [{name: value[b, :lengths[b]].tolist() for name, value in results.items()} for b in range(len(samples))]
+
+    async def score(self, data):
+        loop = asyncio.get_event_loop()
+        sample = await loop.run_in_executor(None, self.load_clip, data)
+        future = loop.create_future()
+        await self.queue.put((sample, future, loop.time()))
+        return await future
+
+    async def batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = requests[0][-1] + self.max_latency
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout <= 0:
+                        # past the deadline, only the clips already waiting join the batch
+                        requests.append(self.queue.get_nowait())
+                    else:
+                        requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            try:
+                results = await loop.run_in_executor(self.model_executor, self.run_batch, [request[0] for request in requests])
+            except Exception as e:
+                for _, future, _ in requests:
+                    future.set_exception(e)
+                continue
+            self.num_batches += 1
+            for (_, future, start), result in zip(requests, results):
+                result.update(batch_size=len(requests), queue_time=loop.time() - start)
+                future.set_result(result)
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/score':
+            self.num_requests += 1
+            try:
+                return 200, await self.score(body)
+            except (ValueError, KeyError, IOError, zipfile.BadZipFile, zlib.error) as e:
+                # a truncated or corrupt upload is a bad request, not an error of the service
+                return 400, {'error': 'Invalid clip: %s' % (e)}
+        if method == 'GET' and path == '/stats':
+            return 200, {'requests': self.num_requests, 'batches': self.num_batches,
+                         'batch_size': self.num_requests / float(max(self.num_batches, 1))}
+        return 404, {'error': 'Unknown request: %s %s' % (method, path)}
+
+    async def handle(self, reader, writer):
+        """ A minimal HTTP/1.1 connection, with keep-alive.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, result = await self.route(method, path, body)
+                except Exception as e:
+                    status, result = 500, {'error': repr(e)}
+                payload = json.dumps(result).encode('utf-8')
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % (
+                    status, HTTP_STATUS[status], len(payload))).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://%s:%d (max_batch_size=%d, max_latency=%.3fs)' % (host, port, self.max_batch_size, self.max_latency))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT_PATH)
+    from demo import init_accident_model
+
+    parser = argparse.ArgumentParser(description='Serve the clip scoring of a trained UString model over HTTP on a local port.')
+    parser.add_argument('--ckpt_file', type=str, default=None,
+                        help='The trained model file, the model is initialized randomly if not given. Default: None')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The host to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='The port to listen on. Default: 8000')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='The maximum number of clips of a batch. Default: 8')
+    parser.add_argument('--max_latency', type=float, default=0.01,
+                        help='The maximum time (s) a clip waits for its batch to fill up. Default: 0.01')
+    parser.add_argument('--npass', type=int, default=10,
+                        help='The number of MC passes of the Bayesian predictor. Default: 10')
+    parser.add_argument('--dim_feature', type=int, default=4096,
+                        help='The dimension of the features. Default: 4096')
+    parser.add_argument('--hidden_dim', type=int, default=256,
+                        help='The dimension of hidden states in RNN. Default: 256')
+    parser.add_argument('--latent_dim', type=int, default=256,
+                        help='The dimension of latent space. Default: 256')
+    parser.add_argument('--num_rnn', type=int, default=1,
+                        help='The number of RNN cells for each timestamp. Default: 1')
+    parser.add_argument('--n_obj', type=int, default=19,
+                        help='The number of objects per frame. Default: 19')
+    parser.add_argument('--n_frames', type=int, default=50,
+                        help='The number of frames of the SAA branch of the model. Default: 50')
+    parser.add_argument('--graph_knn', type=int, default=None,
+                        help='The number of neighbours of the kNN graphs, None for the complete graphs. Default: None')
+    parser.add_argument('--graph_radius', type=float, default=None,
+                        help='The radius of the sparse graphs, with --graph_knn. Default: None')
+    p = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    # the model of demo.py
+    model = init_accident_model(p.ckpt_file, dim_feature=p.dim_feature, hidden_dim=p.hidden_dim, latent_dim=p.latent_dim, n_obj=p.n_obj,
+                                n_frames=p.n_frames, n_layers=p.num_rnn, graph_knn=p.graph_knn, device=device)
+    if p.ckpt_file is None:
+        print("Warning: no model file is given, the model is initialized randomly.")
+    service = ClipScoringService(model, device=device, max_batch_size=p.max_batch_size, max_latency=p.max_latency,
+                                 npass=p.npass, graph_radius=p.graph_radius)
+    try:
+        asyncio.run(service.serve(p.host, p.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,258 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import io
+import json
+import tarfile
+import itertools
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+from src.DataLoader import sample_to_tensor
+from src.quantize import QuantizedArray
+
+INDEX_FILE = 'index.json'
+SHARD_FORMAT = 'npz'
+
+
+class StreamDataset(IterableDataset):
+    """ Streaming dataset of sequential tar shards, for datasets larger than the local disk.
+    Shards are read sequentially (from local files or http urls), split over the distributed ranks and the worker processes,
+    and the samples are shuffled within a bounded buffer. The samples are the same tuples as those of the map-style datasets.
+    With several ranks, every rank yields the same number of samples per epoch, so that they run the same number of steps:
+    their shards are read again or truncated to it.
+    Each sample is stored as plain arrays (.npz, read without pickle) with a small JSON header, so that the shards of
+    an untrusted source cannot run any code.
+    """
+    def __init__(self, shard_path, shuffle=True, shuffle_buffer=1000, seed=123, toTensor=False, device=torch.device('cuda'), rank=None, world_size=None):
+        """
+        :param: shard_path: the directory (or http url) of the shards and the index, written by write_shards()
+        :param: shuffle_buffer: the number of samples in the shuffle buffer of each worker
+        :param: rank, world_size: the distributed rank and the number of ranks, from torch.distributed if not given
+        """
+        self.shard_path = shard_path
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.toTensor = toTensor
+        self.device = device
+        if rank is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank, world_size = (torch.distributed.get_rank(), torch.distributed.get_world_size()) if distributed else (0, 1)
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        with open_stream(join_path(shard_path, INDEX_FILE)) as f:
+            index = json.loads(f.read().decode('utf-8'))
+        assert index.get('format') == SHARD_FORMAT, "Unsupported shard format, please write the shards again: %s"%(shard_path)
+        self.shard_files = index['shards']
+        self.shard_samples = index['num_samples']
+        assert len(self.shard_files) > 0, "No shards in %s"%(shard_path)
+        self.n_frames = index['n_frames']
+        self.n_obj = index['n_obj']
+        self.fps = index['fps']
+        self.dim_feature = index['dim_feature']
+        self.vis = index['vis']
+
+    def __len__(self):
+        # the number of samples of each rank per epoch
+        return sum(self.shard_samples) // self.world_size
+
+    def set_epoch(self, epoch):
+        # the shard order and the shuffle buffer are seeded by the epoch, set it before iterating
+        self.epoch = epoch
+
+    def get_shards(self):
+        # the shards of the current rank and worker process
+        shards = list(range(len(self.shard_files)))
+        if self.shuffle:
+            shards = list(np.random.RandomState(self.seed + self.epoch).permutation(shards))
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        slot = self.rank + worker_id * self.world_size
+        if self.world_size > 1 and slot >= len(shards):
+            # fewer shards than the workers of all ranks, every one reads a shard anyway
+            return [shards[slot % len(shards)]]
+        return shards[slot::self.world_size * num_workers]
+
+    def get_num_samples(self):
+        """ The number of samples of the current rank and worker process per epoch, None to read its shards once.
+        """
+        if self.world_size == 1:
+            return None
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return len(self) // num_workers + int(worker_id < len(self) % num_workers)
+
+    def read_samples(self):
+        # the samples of the shards, which are read again until get_num_samples() are read
+        shards, num_samples = self.get_shards(), self.get_num_samples()
+        while True:
+            empty = True
+            for shard_id in shards:
+                for sample in read_shard(join_path(self.shard_path, self.shard_files[shard_id])):
+                    empty = False
+                    yield sample
+            if num_samples is None or empty:
+                return
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+        samples = self.read_samples()
+        num_samples = self.get_num_samples()
+        if num_samples is not None:
+            samples = itertools.islice(samples, num_samples)
+        buffer = []
+        for sample in samples:
+            if not self.shuffle:
+                yield self.prepare(sample)
+                continue
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randint(len(buffer))
+            sample, buffer[i] = buffer[i], sample
+            yield self.prepare(sample)
+        for i in rng.permutation(len(buffer)):
+            yield self.prepare(buffer[i])
+
+    def prepare(self, sample):
+        return sample_to_tensor(sample, self.device) if self.toTensor else sample
+
+
+def read_shard(shard_file):
+    """ Read the samples of a shard sequentially, without seeking. The header (.json) of each sample precedes its arrays (.npz).
+    """
+    with open_stream(shard_file) as f:
+        with tarfile.open(fileobj=f, mode='r|') as tar:
+            header = None
+            for member in tar:
+                if not member.isfile():
+                    continue
+                data = tar.extractfile(member).read()
+                if member.name.endswith('.json'):
+                    header = json.loads(data.decode('utf-8'))
+                elif member.name.endswith('.npz'):
+                    assert header is not None and header['key'] == member.name[:-4], "Missing header of %s"%(member.name)
+                    yield decode_sample(header, data)
+                    header = None
+
+
+def encode_sample(key, sample):
+    """
+    :param: sample: features, labels, graph_edges, edge_weights, toa, node_mask[, detections, video_id]
+    :return: the JSON header and the .npz bytes of the sample
+    """
+    features = sample[0]
+    if isinstance(features, QuantizedArray):
+        arrays = {'features': features.data, 'features_scale': features.scale, 'features_offset': features.offset}
+    else:
+        arrays = {'features': np.asarray(features)}
+    arrays.update(labels=np.asarray(sample[1]), graph_edges=np.asarray(sample[2]), edge_weights=np.asarray(sample[3]),
+                  toa=np.asarray(sample[4], dtype=np.float32), node_mask=np.asarray(sample[5]))
+    header = {'key': key, 'quantized': isinstance(features, QuantizedArray), 'vis': len(sample) > 6}
+    if len(sample) > 6:
+        arrays['detections'] = np.asarray(sample[6])
+        header['video_id'] = str(sample[7])
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return json.dumps(header).encode('utf-8'), buf.getvalue()
+
+
+def decode_sample(header, data):
+    arrays = np.load(io.BytesIO(data), allow_pickle=False)
+    if header['quantized']:
+        features = QuantizedArray(arrays['features'], arrays['features_scale'], arrays['features_offset'])
+    else:
+        features = arrays['features']
+    sample = (features, arrays['labels'], arrays['graph_edges'], arrays['edge_weights'], arrays['toa'], arrays['node_mask'])
+    if header['vis']:
+        sample += (arrays['detections'], header['video_id'])
+    return sample
+
+
+def open_stream(path):
+    if path.startswith('http://') or path.startswith('https://'):
+        from urllib.request import urlopen
+        return urlopen(path)
+    return open(path, 'rb')
+
+
+def join_path(shard_path, filename):
+    if shard_path.startswith('http://') or shard_path.startswith('https://'):
+        return shard_path.rstrip('/') + '/' + filename
+    return os.path.join(shard_path, filename)
+
+
+def write_shards(dataset, out_dir, samples_per_shard=500, shuffle=False, seed=123):
+    """ Write the samples of a map-style dataset (toTensor=False) into tar shards.
+    :param: shuffle: if True, samples are written in a random order, so that each shard mixes all videos
+    """
+    from tqdm import tqdm
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    order = np.random.RandomState(seed).permutation(len(dataset)) if shuffle else np.arange(len(dataset))
+    shards, num_samples = [], []
+    tar = None
+    for n, index in enumerate(tqdm(order, desc='Writing')):
+        if n % samples_per_shard == 0:
+            if tar is not None:
+                tar.close()
+            shards.append('shard_%05d.tar' % (len(shards)))
+            num_samples.append(0)
+            tar = tarfile.open(os.path.join(out_dir, shards[-1]), mode='w')
+        key = '%08d' % (index)
+        header, data = encode_sample(key, dataset.load_sample(index))
+        for name, content in [(key + '.json', header), (key + '.npz', data)]:
+            info = tarfile.TarInfo(name=name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        num_samples[-1] += 1
+    if tar is not None:
+        tar.close()
+    # the index is written last, an interrupted conversion leaves no valid shards behind
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump({'format': SHARD_FORMAT, 'shards': shards, 'num_samples': num_samples, 'n_frames': dataset.n_frames, 'n_obj': dataset.n_obj,
+                   'fps': dataset.fps, 'dim_feature': dataset.dim_feature, 'vis': dataset.vis}, f)
+    return len(order)
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT_PATH)
+    from src.DataLoader import DADDataset, A3DDataset, CrashDataset
+
+    parser = argparse.ArgumentParser(description='Write the samples of a dataset into tar shards for streaming.')
+    parser.add_argument('--data_path', type=str, default='./data',
+                        help='The relative path of dataset.')
+    parser.add_argument('--dataset', type=str, default='dad', choices=['a3d', 'dad', 'crash'],
+                        help='The name of dataset. Default: dad')
+    parser.add_argument('--feature_name', type=str, default='vgg16', choices=['vgg16', 'res101'],
+                        help='The name of feature embedding methods. Default: vgg16')
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='The output directory, the shards of each phase are written into a sub-directory.')
+    parser.add_argument('--samples_per_shard', type=int, default=500,
+                        help='The number of samples of each shard. Default: 500')
+    parser.add_argument('--vis', action='store_true',
+                        help='Include the detections and video ids in the samples. Default: False')
+    p = parser.parse_args()
+
+    data_path = os.path.join(p.data_path, p.dataset)
+    if p.dataset == 'dad':
+        datasets = [DADDataset(data_path, p.feature_name, phase, vis=p.vis) for phase in ['training', 'testing']]
+    elif p.dataset == 'a3d':
+        datasets = [A3DDataset(data_path, p.feature_name, phase, vis=p.vis) for phase in ['train', 'test']]
+    else:
+        datasets = [CrashDataset(data_path, p.feature_name, phase, vis=p.vis) for phase in ['train', 'test']]
+    for dataset in datasets:
+        # training samples are written in a random order, so that a bounded shuffle buffer mixes them well
+        num_samples = write_shards(dataset, os.path.join(p.out_dir, dataset.phase), samples_per_shard=p.samples_per_shard,
+                                   shuffle=dataset.phase in ['training', 'train'])
+        print('%s samples: %d' % (dataset.phase, num_samples))
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import collections
+import numpy as np
+import torch
+
+
+class StreamRuntime(object):
+    """ Continuous batching of many live streams on one UString model. The hidden states of all streams are kept in a
+    pool of fixed capacity, each stream owns a slot of it from join() to leave(). At each tick(), the streams which have
+    a new frame are gathered into one batched step (graph, GCN/GRU and BNN) of UString.step(), and the new hidden states
+    are scattered back into their slots, so that streams of different rates join or leave without any reallocation.
+    """
+    def __init__(self, model, capacity=256, max_batch_size=None, npass=10, graph_radius=None, device=torch.device('cpu'), history=1000):
+        """
+        :param capacity: the maximum number of concurrent streams
+        :param max_batch_size: the maximum number of streams of a tick, the capacity if not given. The streams waiting
+                               for the longest time are taken first.
+        :param history: the number of the latest latencies and batch sizes kept for the statistics
+        """
+        self.model = model.to(device=device)
+        self.model.eval()
+        self.capacity = capacity
+        self.max_batch_size = capacity if max_batch_size is None else max_batch_size
+        self.npass = npass
+        self.graph_radius = graph_radius
+        self.device = device
+        # the pool of the hidden states of all slots, n_layers x capacity x 19 x 256
+        self.hidden = torch.zeros(model.n_layers, capacity, model.n_obj, model.h_dim, device=device)
+        self.free_slots = collections.deque(range(capacity))
+        self.slots = {}  # stream id --> slot
+        self.pending = {}  # stream id --> deque of (frame_features, detections, node_mask, arrival time)
+        self.num_frames = {}  # stream id --> the number of frames scored
+        self.latencies = {}  # stream id --> the latest latencies (s), from push() to the end of the tick
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.history = history
+        self.num_ticks = 0
+
+    def join(self, stream_id):
+        assert stream_id not in self.slots, "Stream %s has already joined."%(stream_id)
+        if len(self.free_slots) == 0:
+            raise RuntimeError("All %d slots are taken."%(self.capacity))
+        slot = self.free_slots.popleft()
+        self.hidden[:, slot].zero_()
+        self.slots[stream_id] = slot
+        self.pending[stream_id] = collections.deque()
+        self.num_frames[stream_id] = 0
+        self.latencies[stream_id] = collections.deque(maxlen=self.history)
+        return slot
+
+    def leave(self, stream_id):
+        """ Release the slot of a stream, its pending frames are dropped.
+        :return: the latency statistics of the stream
+        """
+        stats = self.stream_stats(stream_id)
+        self.free_slots.append(self.slots.pop(stream_id))
+        for store in [self.pending, self.num_frames, self.latencies]:
+            del store[stream_id]
+        return stats
+
+    def push(self, stream_id, frame_features, detections, node_mask=None):
+        """ Queue the next frame of a stream, it is scored by one of the next ticks (one frame per stream and tick).
+        :param frame_features: 20 x 4096, numpy array or tensor
+        :param detections: 19 x 6
+        :param node_mask: 19, True for the real objects, None if all are real
+        """
+        self.pending[stream_id].append((frame_features, detections, node_mask, time.time()))
+
+    def tick(self):
+        """ Score the oldest pending frame of the waiting streams in one batch.
+        :return: dict of stream id --> dict of 'frame' (the frame index in the stream), 'score', 'aleatoric', 'epistemic'
+                 and 'latency' (s)
+        """
+        waiting = [stream_id for stream_id, frames in self.pending.items() if len(frames) > 0]
+        if len(waiting) == 0:
+            return {}
+        waiting = sorted(waiting, key=lambda stream_id: self.pending[stream_id][0][-1])[:self.max_batch_size]
+        frames = [self.pending[stream_id].popleft() for stream_id in waiting]
+        idx = torch.tensor([self.slots[stream_id] for stream_id in waiting], dtype=torch.long, device=self.device)
+
+        features = torch.stack([torch.as_tensor(frame[0], dtype=torch.float32) for frame in frames]).to(self.device)  # B x 20 x 4096
+        detections = np.stack([np.asarray(frame[1]) for frame in frames])  # B x 19 x 6
+        node_mask = None
+        if any(frame[2] is not None for frame in frames):
+            node_mask = np.stack([np.asarray(frame[2], dtype=bool) if frame[2] is not None else np.ones(self.model.n_obj, dtype=bool)
+                                  for frame in frames])  # B x 19
+        state = {'hidden': self.hidden.index_select(1, idx), 'num_frames': 0, 'history': None}
+        results, state = self.model.step(features, detections, state, node_mask=node_mask, npass=self.npass, graph_radius=self.graph_radius)
+        self.hidden.index_copy_(1, idx, state['hidden'])
+        results = {name: value.tolist() for name, value in results.items()}
+        end = time.time()
+
+        outputs = {}
+        for b, stream_id in enumerate(waiting):
+            latency = end - frames[b][-1]
+            self.latencies[stream_id].append(latency)
+            outputs[stream_id] = dict({name: value[b] for name, value in results.items()},
+                                      frame=self.num_frames[stream_id], latency=latency)
+            self.num_frames[stream_id] += 1
+        self.batch_sizes.append(len(waiting))
+        self.num_ticks += 1
+        return outputs
+
+    def stream_stats(self, stream_id):
+        latencies = np.array(self.latencies[stream_id]) if len(self.latencies[stream_id]) > 0 else np.zeros(1)
+        return {'frames': self.num_frames[stream_id],
+                'pending': len(self.pending[stream_id]),
+                'latency_mean': float(np.mean(latencies)),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p99': float(np.percentile(latencies, 99))}
+
+    def stats(self):
+        """ The latency statistics of each stream, and the batch occupancy of the latest ticks (the mean batch size
+        over max_batch_size).
+        """
+        batch_sizes = np.array(self.batch_sizes) if len(self.batch_sizes) > 0 else np.zeros(1)
+        return {'streams': {stream_id: self.stream_stats(stream_id) for stream_id in self.slots},
+                'ticks': self.num_ticks,
+                'batch_size': float(np.mean(batch_sizes)),
+                'occupancy': float(np.mean(batch_sizes)) / self.max_batch_size}
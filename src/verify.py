@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import numpy as np
+from src.quantize import dequantize
+
+
+def manifest_file(manifest_dir, name, feature, phase):
+    return os.path.join(manifest_dir, '%s_%s_%s.json' % (name, feature, phase))
+
+
+def load_manifest(manifest_file):
+    assert os.path.exists(manifest_file), "Manifest does not exist, run src/verify.py first: %s"%(manifest_file)
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def apply_manifest(dataset, manifest):
+    """ Restrict a dataset to the verified samples of a manifest. The dataset then skips the existence checks of its files,
+    reads the number of frames of each video from the manifest, and its graph cache uses the recorded modification times.
+    """
+    samples = manifest['samples']
+    keep = [index for index, filename in enumerate(dataset.files_list) if filename in samples]
+    if len(keep) < len(dataset.files_list):
+        print("%d of %d %s samples are not verified and skipped." % (len(dataset.files_list) - len(keep), len(dataset.files_list), dataset.phase))
+    dataset.files_list = [dataset.files_list[index] for index in keep]
+    if hasattr(dataset, 'labels_list'):
+        dataset.labels_list = [dataset.labels_list[index] for index in keep]
+    if getattr(dataset, 'anno', None) is not None:
+        dataset.anno = {name: value[keep] for name, value in dataset.anno.items()}
+    if dataset.graph_cache is not None:
+        dataset.graph_cache.mtimes.update(manifest['mtimes'])
+    dataset.manifest = manifest
+
+
+def check_sample(dataset, index):
+    """ Decode all files of a sample and check their shapes.
+    :param: dataset: with vis=True and without graph or sample cache, so that nothing is skipped
+    :return: the number of frames of the video
+    """
+    features, labels, graph_edges, edge_weights, toa, node_mask, detections = dataset.load_sample(index)[:7]
+    features = dequantize(features)
+    num_frames = features.shape[0]
+    assert 0 < num_frames <= dataset.n_frames, "Invalid number of frames: %d"%(num_frames)
+    assert features.shape[1:] == (dataset.n_obj + 1, dataset.dim_feature), "Invalid feature shape: %s"%(str(features.shape))
+    assert np.all(np.isfinite(features)), "Non-finite features"
+    assert np.shape(labels) == (2,), "Invalid label shape: %s"%(str(np.shape(labels)))
+    assert np.shape(detections) == (num_frames, dataset.n_obj, 6), "Invalid detection shape: %s"%(str(np.shape(detections)))
+    assert np.shape(node_mask) == (num_frames, dataset.n_obj), "Invalid node mask shape: %s"%(str(np.shape(node_mask)))
+    assert edge_weights.shape[0] == num_frames, "Invalid graph shape: %s"%(str(edge_weights.shape))
+    return num_frames
+
+
+def _verify_init(dataset):
+    global _verify_dataset
+    _verify_dataset = dataset
+
+
+def _verify_one(index):
+    filename = _verify_dataset.files_list[index]
+    try:
+        num_frames = check_sample(_verify_dataset, index)
+        mtimes = {src_file: os.stat(src_file).st_mtime_ns for src_file in _verify_dataset.get_sample_files(index)}
+    except Exception as e:
+        return filename, None, None, '%s: %s' % (type(e).__name__, e)
+    return filename, num_frames, mtimes, None
+
+
+def verify_dataset(dataset, out_file, num_workers=8):
+    """ Verify all samples of a dataset with a process pool and write the manifest of the valid ones.
+    :return: dict of the errors of the invalid samples
+    """
+    from multiprocessing import Pool
+    from tqdm import tqdm
+    samples, mtimes, errors = {}, {}, {}
+    pool = Pool(num_workers, initializer=_verify_init, initargs=(dataset,))
+    for filename, num_frames, sample_mtimes, error in tqdm(pool.imap_unordered(_verify_one, range(len(dataset)), chunksize=16),
+                                                           desc='Phase: %s' % (dataset.phase), total=len(dataset)):
+        if error is not None:
+            errors[filename] = error
+            continue
+        samples[filename] = {'num_frames': num_frames}
+        mtimes.update(sample_mtimes)
+    pool.close()
+    pool.join()
+
+    manifest = {'phase': dataset.phase, 'feature': dataset.feature, 'n_frames': dataset.n_frames, 'n_obj': dataset.n_obj,
+                'dim_feature': dataset.dim_feature, 'samples': samples, 'mtimes': mtimes, 'errors': errors}
+    if not os.path.exists(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    tmp_file = out_file + '.%d.tmp' % (os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, out_file)
+    return errors
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT_PATH)
+    from src.DataLoader import DADDataset, A3DDataset, CrashDataset
+
+    parser = argparse.ArgumentParser(description='Verify all samples of a dataset and write the manifest of the valid ones.')
+    parser.add_argument('--data_path', type=str, default='./data',
+                        help='The relative path of dataset.')
+    parser.add_argument('--dataset', type=str, default='dad', choices=['a3d', 'dad', 'crash'],
+                        help='The name of dataset. Default: dad')
+    parser.add_argument('--feature_name', type=str, default='vgg16', choices=['vgg16', 'res101'],
+                        help='The name of feature embedding methods. Default: vgg16')
+    parser.add_argument('--manifest', type=str, required=True,
+                        help='The directory of the manifests, one for each phase.')
+    parser.add_argument('--feature_store', type=str, default=None,
+                        help='The directory of the packed feature store, if the dataset is used with it. Default: None')
+    parser.add_argument('--anno_index', type=str, default=None,
+                        help='The directory of the compiled annotation index, if the dataset is used with it. Default: None')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='The number of worker processes. Default: 8')
+    p = parser.parse_args()
+
+    data_path = os.path.join(ROOT_PATH, p.data_path, p.dataset)
+    if p.dataset == 'dad':
+        all_data = [DADDataset(data_path, p.feature_name, phase, vis=True, feature_store=p.feature_store) for phase in ['training', 'testing']]
+    elif p.dataset == 'a3d':
+        all_data = [A3DDataset(data_path, p.feature_name, phase, vis=True, feature_store=p.feature_store, anno_index=p.anno_index) for phase in ['train', 'test']]
+    elif p.dataset == 'crash':
+        all_data = [CrashDataset(data_path, p.feature_name, phase, vis=True, feature_store=p.feature_store, anno_index=p.anno_index) for phase in ['train', 'test']]
+    else:
+        raise NotImplementedError
+
+    num_errors = 0
+    for dataset in all_data:
+        errors = verify_dataset(dataset, manifest_file(p.manifest, p.dataset, p.feature_name, dataset.phase), num_workers=p.num_workers)
+        for filename, error in sorted(errors.items()):
+            print('%s: %s' % (filename, error))
+        print('%s: %d samples, %d errors' % (dataset.phase, len(dataset) - len(errors), len(errors)))
+        num_errors += len(errors)
+    sys.exit(1 if num_errors > 0 else 0)
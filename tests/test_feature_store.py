@@ -0,0 +1,35 @@
+import os
+import sys
+import pickle
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.feature_store import FeatureStore, pack_features
+from src.quantize import quantize_features
+
+
+def test_pack_features_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    src_dir = tmp_path / 'vgg16_features'
+    samples = {}
+    for key in ['training/positive/000001.npz', 'training/negative/000002.npz', 'testing/positive/000003.npz']:
+        record = dict(quantize_features(rng.randn(10, 20, 64), 'int8'),
+                      det=rng.rand(10, 19, 6).astype(np.float32), labels=np.array([0., 1.]), ID=np.array('b001_%s' % key[-10:-4]),
+                      empty=np.zeros((0, 6), dtype=np.float32))
+        os.makedirs(str((src_dir / key).parent), exist_ok=True)
+        np.savez_compressed(str(src_dir / key), **record)
+        samples[key] = record
+    # shards smaller than a sample, one sample per shard
+    assert pack_features(str(src_dir), str(tmp_path / 'store'), shard_size=1024) == len(samples)
+    store = FeatureStore(str(tmp_path / 'store'))
+    assert len(store) == len(samples) and len(store.shard_files) == len(samples)
+    # also through pickling, e.g., to the DataLoader workers
+    for store in [store, pickle.loads(pickle.dumps(store))]:
+        for key, record in samples.items():
+            assert key in store
+            loaded = store[key]
+            assert set(loaded) == set(record)
+            for name, array in record.items():
+                assert loaded[name].dtype == array.dtype and loaded[name].shape == array.shape
+                np.testing.assert_array_equal(loaded[name], array)
+            # zero-copy views on the memory-mapped shards
+            assert isinstance(loaded['data'].base, np.memmap)
@@ -0,0 +1,82 @@
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.graph_cache import GraphCache, detection_hash
+from src.DataLoader import load_st_graph
+
+
+def write_sample(sample_file, detections):
+    np.savez(sample_file, det=detections, labels=np.array([0, 1]))
+
+
+def counted_hash(detections, calls):
+    def det_hash():
+        calls.append(1)
+        return detection_hash(detections)
+    return det_hash
+
+
+def test_graph_cache_invalidation(tmp_path):
+    rng = np.random.RandomState(0)
+    detections = rng.rand(10, 19, 6).astype(np.float32)
+    sample_file = str(tmp_path / 'sample.npz')
+    write_sample(sample_file, detections)
+    cache = GraphCache(str(tmp_path / 'cache'))
+    edge_weights = rng.rand(10, 171).astype(np.float32)
+    cache.save(sample_file, [sample_file], detection_hash(detections), edge_weights, np.array([90.0], dtype=np.float32),
+               np.array([0, 1]), 19)
+
+    # hit when nothing changed, without hashing the detections
+    calls = []
+    entry = cache.load(sample_file, [sample_file], det_hash=counted_hash(detections, calls))
+    np.testing.assert_array_equal(entry['edge_weights'], edge_weights)
+    assert entry['num_boxes'] == 19 and len(calls) == 0
+    # the entries of the other graph modes are kept apart
+    assert cache.load(sample_file, [sample_file], det_hash=counted_hash(detections, calls), mode=':knn4:rNone') is None
+
+    # a touched source is a miss, unless the same detections are given to check
+    stat = os.stat(sample_file)
+    os.utime(sample_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.load(sample_file, [sample_file]) is None
+    assert cache.load(sample_file, [sample_file], det_hash=counted_hash(detections * 2, calls)) is None
+    entry = cache.load(sample_file, [sample_file], det_hash=counted_hash(detections, calls))
+    np.testing.assert_array_equal(entry['edge_weights'], edge_weights)
+    # the entry was stamped with the new modification time
+    del calls[:]
+    assert cache.load(sample_file, [sample_file], det_hash=counted_hash(detections, calls)) is not None
+    assert len(calls) == 0
+
+    # changed detections with the same modification time are only found by verify
+    stat = os.stat(sample_file)
+    write_sample(sample_file, detections * 2)
+    os.utime(sample_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.load(sample_file, [sample_file], det_hash=counted_hash(detections * 2, calls)) is not None
+    assert cache.load(sample_file, [sample_file], det_hash=counted_hash(detections * 2, calls), verify=True) is None
+
+
+def test_load_st_graph_round_trip(tmp_path):
+    rng = np.random.RandomState(1)
+    detections = (rng.rand(10, 19, 6) * 3).astype(np.float32)
+    node_mask = rng.rand(10, 19) > 0.2
+    sample_file = str(tmp_path / 'sample.npz')
+    write_sample(sample_file, detections)
+    cache = GraphCache(str(tmp_path / 'cache'))
+    loads = []
+
+    def load_inputs():
+        loads.append(1)
+        return detections, [90.0], np.array([0, 1]), node_mask
+    for knn in [None, 4]:
+        del loads[:]
+        graph = load_st_graph(cache, sample_file, [sample_file], load_inputs, knn=knn)
+        cached = load_st_graph(cache, sample_file, [sample_file], load_inputs, knn=knn)
+        assert len(loads) == 1
+        for computed, read in zip(graph, cached):
+            np.testing.assert_array_equal(np.asarray(computed), np.asarray(read))
+        # the node mask is part of the hash of verify
+        assert load_st_graph(cache, sample_file, [sample_file], load_inputs, knn=knn, verify=True) is not None
+        assert len(loads) == 2
+        node_mask[0, 0] = not node_mask[0, 0]
+        load_st_graph(cache, sample_file, [sample_file], load_inputs, knn=knn, verify=True)
+        assert len(loads) == 4  # hashed, then computed again
@@ -0,0 +1,359 @@
+import os
+import sys
+import numpy as np
+import torch
+import torch.nn.functional as F
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.Models import UString, GCNConv, NormalizedGraph, Graph_GRU_GCN, BayesianPredictor
+from src.DataLoader import build_st_graph
+from src.eval_tools import early_exit_alerts
+
+N_OBJ, X_DIM, H_DIM, Z_DIM = 5, 8, 6, 4
+
+
+def make_model(seed=0, graph_knn=None, with_saa=True, n_frames=12):
+    torch.manual_seed(seed)
+    return UString(X_DIM, H_DIM, Z_DIM, n_obj=N_OBJ, n_frames=n_frames, with_saa=with_saa, graph_knn=graph_knn).eval()
+
+
+def make_batch(batch_size=3, num_frames=12, seed=0, knn=None, node_mask=None):
+    """ Random features and detections, with the graphs of the datasets.
+    :param node_mask: B x T x n_obj, True for the real objects, None if all are real
+    :return: x (B x T x (1 + n_obj) x D), graph (B x 2 x E, or B x T x 2 x E for knn), edge_weights (B x T x E), detections
+    """
+    rng = np.random.RandomState(seed)
+    x = torch.from_numpy(rng.randn(batch_size, num_frames, N_OBJ + 1, X_DIM)).float()
+    detections = (rng.rand(batch_size, num_frames, N_OBJ, 6) * 3).astype(np.float32)
+    graph_edges, edge_weights = build_st_graph(detections.reshape(-1, N_OBJ, 6), knn=knn,
+                                               node_mask=node_mask.reshape(-1, N_OBJ) if node_mask is not None else None)
+    if knn is None:
+        graph = torch.from_numpy(graph_edges).long().unsqueeze(0).repeat(batch_size, 1, 1)
+    else:
+        graph = torch.from_numpy(graph_edges).long().view(batch_size, num_frames, 2, -1)
+    edge_weights = torch.from_numpy(edge_weights).float().view(batch_size, num_frames, -1)
+    return x, graph, edge_weights, detections
+
+
+def dense_gcn(conv, x, edge_index, edge_weight, node_mask=None):
+    """ The reference convolution of each sample, act(D^-1/2 (A + I) D^-1/2 x W + b) on the dense adjacency.
+    :param x: B x N x C, edge_index: B x 2 x E, edge_weight: B x E, node_mask: B x N
+    """
+    out = []
+    for i in range(x.size(0)):
+        num_nodes = x.size(1)
+        real = node_mask[i].double() if node_mask is not None else torch.ones(num_nodes, dtype=torch.float64)
+        adj = torch.zeros(num_nodes, num_nodes, dtype=torch.float64)
+        for (row, col), weight in zip(edge_index[i].t().tolist(), edge_weight[i].tolist()):
+            adj[row, col] += weight * real[row] * real[col]
+        adj += torch.diag(real)
+        deg_inv = adj.sum(1).pow(-0.5)
+        deg_inv[deg_inv == float('inf')] = 0
+        norm = deg_inv[:, None] * adj * deg_inv[None, :]
+        out.append(conv.act(conv.update(norm @ x[i] @ conv.weight)) * real[:, None])
+    return torch.stack(out)
+
+
+def make_graphs(batch_size=4, knn=None, seed=0, masked=False):
+    rng = np.random.RandomState(seed)
+    node_mask = rng.rand(batch_size, N_OBJ) > 0.3 if masked else None
+    graph_edges, edge_weights = build_st_graph(rng.rand(batch_size, N_OBJ, 6) * 3, knn=knn, node_mask=node_mask)
+    edge_index = torch.from_numpy(graph_edges).long()
+    if knn is None:
+        edge_index = edge_index.unsqueeze(0).repeat(batch_size, 1, 1)
+    return edge_index, torch.from_numpy(edge_weights).double(), torch.from_numpy(node_mask) if masked else None
+
+
+def test_normalized_graph_matches_dense_reference():
+    # the complete and the kNN graphs, with and without missing nodes
+    for knn in [None, 2]:
+        for masked in [False, True]:
+            torch.manual_seed(0)
+            conv = GCNConv(X_DIM, 3, num_neighbors=knn).double()
+            x = torch.randn(4, N_OBJ, X_DIM, dtype=torch.float64)
+            edge_index, edge_weight, node_mask = make_graphs(knn=knn, masked=masked)
+            ref = dense_gcn(conv, x, edge_index, edge_weight, node_mask=node_mask)
+            # the normalized graph shared by several convolutions
+            graph = NormalizedGraph(edge_index, edge_weight, N_OBJ, node_mask=node_mask, num_neighbors=knn)
+            torch.testing.assert_close(conv(x, graph), ref, rtol=0, atol=1e-12)
+            # the graphs of several frames at once, e.g., 2 x 2 x N x C, and a frame of them
+            graph = NormalizedGraph(edge_index.view((2, 2) + edge_index.shape[1:]), edge_weight.view(2, 2, -1), N_OBJ,
+                                    node_mask=node_mask.view(2, 2, -1) if masked else None, num_neighbors=knn)
+            torch.testing.assert_close(conv(x.view(2, 2, N_OBJ, -1), graph), ref.view(2, 2, N_OBJ, -1), rtol=0, atol=1e-12)
+            torch.testing.assert_close(conv(x.view(2, 2, N_OBJ, -1)[:, 1], graph.select(1)), ref.view(2, 2, N_OBJ, -1)[:, 1],
+                                       rtol=0, atol=1e-12)
+
+
+def test_gcn_conv_matches_dense_reference():
+    # the edge index and weights given to GCNConv, with the bias and activation
+    for knn in [None, 2]:
+        for masked in [False, True]:
+            torch.manual_seed(0)
+            conv = GCNConv(X_DIM, 3, bias=True, num_neighbors=knn).double()
+            conv.bias.data.normal_()
+            x = torch.randn(4, N_OBJ, X_DIM, dtype=torch.float64)
+            edge_index, edge_weight, node_mask = make_graphs(knn=knn, masked=masked)
+            ref = dense_gcn(conv, x, edge_index, edge_weight, node_mask=node_mask)
+            torch.testing.assert_close(conv(x, edge_index, edge_weight, node_mask=node_mask), ref, rtol=0, atol=1e-12)
+            # unit weights
+            ref = dense_gcn(conv, x, edge_index, torch.ones_like(edge_weight), node_mask=node_mask)
+            torch.testing.assert_close(conv(x, edge_index, node_mask=node_mask), ref, rtol=0, atol=1e-12)
+
+
+def split_gru(gru, i):
+    """ The separate gate convolutions of the layer i of a fused Graph_GRU_GCN, as in the former layout.
+    :return: dict of xz, xr, xh, hz, hr, hh
+    """
+    convs = {}
+    for name, fused in [('x', gru.weight_x[i]), ('h', gru.weight_h[i])]:
+        gates = ['z', 'r', 'h'] if name == 'x' else ['z', 'r']
+        for gate, weight, bias in zip(gates, fused.weight.split(gru.hidden_size, dim=1), fused.bias.split(gru.hidden_size)):
+            conv = GCNConv(fused.in_channels, gru.hidden_size, act=lambda x: x, bias=True).double()
+            conv.weight.data.copy_(weight)
+            conv.bias.data.copy_(bias)
+            convs[name + gate] = conv
+    convs['hh'] = gru.weight_hh[i]
+    return convs
+
+
+def test_fused_gru_gates_match_separate_gates():
+    torch.manual_seed(0)
+    gru = Graph_GRU_GCN(X_DIM, H_DIM, 2).double()
+    for param in gru.parameters():
+        param.data.normal_()
+    x = torch.randn(4, N_OBJ, X_DIM, dtype=torch.float64)
+    h = torch.randn(2, 4, N_OBJ, H_DIM, dtype=torch.float64)
+    edge_index, edge_weight, _ = make_graphs()
+    h_ref, inp = [], x
+    for i in range(2):
+        c = split_gru(gru, i)
+        z_g = torch.sigmoid(c['xz'](inp, edge_index, edge_weight) + c['hz'](h[i], edge_index, edge_weight))
+        r_g = torch.sigmoid(c['xr'](inp, edge_index, edge_weight) + c['hr'](h[i], edge_index, edge_weight))
+        h_tilde_g = torch.tanh(c['xh'](inp, edge_index, edge_weight) + c['hh'](r_g * h[i], edge_index, edge_weight))
+        h_ref.append(z_g * h[i] + (1 - z_g) * h_tilde_g)
+        inp = h_ref[-1]
+    torch.testing.assert_close(gru(x, edge_index, h, edge_weight), torch.stack(h_ref), rtol=0, atol=1e-12)
+    # the input already multiplied by the weight of weight_x[0]
+    graph = NormalizedGraph(edge_index, edge_weight, N_OBJ)
+    torch.testing.assert_close(gru(None, graph, h, inp_w=torch.matmul(x, gru.weight_x[0].weight)), torch.stack(h_ref), rtol=0, atol=1e-12)
+
+
+def test_load_baseline_checkpoint():
+    # the GRU weights were not registered in the former layout, its checkpoints have no 'rnn.' keys
+    state_dict = {key: value for key, value in make_model(seed=1).state_dict().items() if not key.startswith('rnn.')}
+    model = make_model(seed=2)
+    rnn_state = {key: value.clone() for key, value in model.rnn.state_dict().items()}
+    model.load_state_dict(state_dict)
+    for key, value in model.state_dict().items():
+        expected = rnn_state[key[len('rnn.'):]] if key.startswith('rnn.') else state_dict[key]
+        torch.testing.assert_close(value, expected, rtol=0, atol=0)
+    # the GRU weights are required in the other checkpoints
+    try:
+        model.load_state_dict(dict(state_dict, **{'rnn.weight_x.0.weight': rnn_state['weight_x.0.weight']}))
+        assert False, "incomplete GRU weights were loaded"
+    except RuntimeError:
+        pass
+
+
+def run_recurrence(model, x, graph, edge_weights, lengths=None, node_mask=None, encode_chunk=None):
+    """ The BNN inputs and the hidden states of each frame of UString._recurrence(), zeros for the ended videos.
+    :return: embeds (B x T x (n_obj x z_dim)), hiddens (T x n_layers x B x n_obj x h_dim)
+    """
+    lengths_list = lengths.tolist() if lengths is not None else [x.size(1)] * x.size(0)
+    embeds = torch.zeros(x.size(0), x.size(1), N_OBJ * Z_DIM)
+    hiddens = []
+    with torch.no_grad():
+        for t, idx, embed, h in model._recurrence(x, graph, edge_weights, None, lengths_list, node_mask, encode_chunk=encode_chunk):
+            embeds[:, t] = embed if idx is None else embeds[:, t].index_copy(0, idx, embed)
+            hiddens.append(model._pad_nodes(h))
+    return embeds, torch.stack(hiddens)
+
+
+def test_hoisted_encoder_matches_loop():
+    model = make_model()
+    x, graph, edge_weights, _ = make_batch()
+    # the former encoder and recurrence of each frame
+    h = torch.zeros(1, x.size(0), N_OBJ, H_DIM)
+    ref_embeds, ref_hiddens = [], []
+    with torch.no_grad():
+        for t in range(x.size(1)):
+            x_t = model.phi_x(x[:, t])
+            x_t = torch.cat([x_t[:, 1:], x_t[:, :1].repeat(1, N_OBJ, 1)], dim=-1)
+            enc = model.enc_gcn1(x_t, graph, edge_weight=edge_weights[:, t])
+            z_t = model.enc_gcn2(torch.cat([enc, h[-1]], -1), graph, edge_weight=edge_weights[:, t])
+            h = model.rnn(torch.cat([x_t, z_t], -1), graph, h, edge_weight=edge_weights[:, t])
+            ref_embeds.append(z_t.view(z_t.size(0), -1))
+            ref_hiddens.append(h)
+    ref_embeds, ref_hiddens = torch.stack(ref_embeds, dim=1), torch.stack(ref_hiddens)
+    for encode_chunk in [None, 1, 5, x.size(1)]:
+        embeds, hiddens = run_recurrence(model, x, graph, edge_weights, encode_chunk=encode_chunk)
+        torch.testing.assert_close(embeds, ref_embeds, rtol=0, atol=1e-5)
+        torch.testing.assert_close(hiddens, ref_hiddens, rtol=0, atol=1e-5)
+
+
+def test_lengths_match_unpadded_videos():
+    lengths = torch.tensor([12, 3, 7])
+    for knn in [None, 2]:
+        model = make_model(graph_knn=knn)
+        x, graph, edge_weights, _ = make_batch(knn=knn)
+        embeds, hiddens = run_recurrence(model, x, graph, edge_weights, lengths=lengths)
+        for b, length in enumerate(lengths.tolist()):
+            ref_embeds, ref_hiddens = run_recurrence(model, x[b:b + 1, :length], graph[b:b + 1, :length] if knn else graph[b:b + 1],
+                                                     edge_weights[b:b + 1, :length])
+            torch.testing.assert_close(embeds[b:b + 1, :length], ref_embeds, rtol=0, atol=1e-5)
+            torch.testing.assert_close(hiddens[:length, :, b:b + 1], ref_hiddens, rtol=0, atol=1e-5)
+            # padded frames: zero BNN inputs, the hidden states are carried over
+            assert not embeds[b, length:].any()
+            torch.testing.assert_close(hiddens[length:, :, b], hiddens[length - 1:length, :, b].expand_as(hiddens[length:, :, b]), rtol=0, atol=0)
+
+
+def test_trimmed_nodes_match_untrimmed():
+    rng = np.random.RandomState(1)
+    # the last two objects are missing in all frames, some others in some frames
+    node_mask = rng.rand(3, 12, N_OBJ) > 0.3
+    node_mask[..., 3:] = False
+    for knn in [None, 2]:
+        for lengths in [None, torch.tensor([12, 3, 7])]:
+            model = make_model(graph_knn=knn)
+            x, graph, edge_weights, _ = make_batch(knn=knn, node_mask=node_mask)
+            x[..., 1:, :] *= torch.from_numpy(node_mask).unsqueeze(-1).float()
+            encoded = []
+            encode = model._encode
+            model._encode = lambda x, graphs: encoded.append(x.size(-2)) or encode(x, graphs)
+            embeds, hiddens = run_recurrence(model, x, graph, edge_weights, lengths=lengths, node_mask=torch.from_numpy(node_mask))
+            assert set(encoded) == {1 + 3}
+            model._trim_nodes = lambda x, h, node_mask, graph, edge_weights: (x, h, node_mask, graph, edge_weights)
+            ref_embeds, ref_hiddens = run_recurrence(model, x, graph, edge_weights, lengths=lengths, node_mask=torch.from_numpy(node_mask))
+            assert set(encoded) == {1 + 3, 1 + N_OBJ}
+            torch.testing.assert_close(embeds, ref_embeds, rtol=0, atol=1e-5)
+            torch.testing.assert_close(hiddens, ref_hiddens, rtol=0, atol=1e-5)
+
+
+def test_predict_matches_step():
+    for knn in [None, 2]:
+        model = make_model(graph_knn=knn)
+        x, graph, edge_weights, detections = make_batch(knn=knn)
+        torch.manual_seed(3)
+        results = model.predict(x, graph, edge_weights=edge_weights)
+        # the same MC samples are drawn frame by frame
+        torch.manual_seed(3)
+        state = model.init_state(x.size(0))
+        for t in range(x.size(1)):
+            step_results, state = model.step(x[:, t], detections[:, t], state)
+            for name in ['score', 'aleatoric', 'epistemic']:
+                torch.testing.assert_close(step_results[name], results[name][:, t], rtol=0, atol=1e-5)
+        assert state['num_frames'] == x.size(1)
+
+
+def test_clip_score_matches_forward():
+    model = make_model()
+    x, graph, edge_weights, detections = make_batch()
+    y = torch.tensor([[0., 1.]] * 3)
+    toa = torch.tensor([5., 2., 6.])
+    with torch.no_grad():
+        _, _, all_hidden = model(x, y, toa, graph, edge_weights=edge_weights)
+        ref = F.softmax(model.predictor_aux(model.self_aggregation(torch.stack(all_hidden, dim=-1), 'avg')), dim=-1)[:, 1]
+    state = model.init_state(x.size(0), with_saa=True)
+    for t in range(x.size(1)):
+        _, state = model.step(x[:, t], detections[:, t], state)
+    torch.testing.assert_close(model.clip_score(state), ref, rtol=0, atol=1e-5)
+
+
+def test_predict_alerts_match_early_exit_alerts():
+    model = make_model()
+    x, graph, edge_weights, _ = make_batch(batch_size=8)
+    recurrence = model._recurrence
+    for seed in range(10):
+        rng = np.random.RandomState(seed)
+        # synthetic scores and uncertainties given to the alert rule of predict() instead of those of the BNN
+        scores = torch.from_numpy(rng.rand(8, 12)).float()
+        epistemic = torch.from_numpy(rng.rand(8, 12) * 0.1).float()
+        lengths = torch.from_numpy(rng.randint(1, 13, size=8))
+        frame = {}
+
+        def _recurrence(*args, **kwargs):
+            for t, idx, embed, h in recurrence(*args, **kwargs):
+                frame['t'] = t
+                yield t, idx, torch.arange(8) if idx is None else idx, h
+        model._recurrence = _recurrence
+        model.predictor.predict = lambda rows, **kwargs: {'score': scores[rows, frame['t']], 'aleatoric': torch.zeros(len(rows)),
+                                                          'epistemic': epistemic[rows, frame['t']]}
+        for threshold, max_epistemic, num_frames in [(0.5, float('inf'), 1), (0.4, 0.05, 2), (0.3, 0.08, 3)]:
+            results = model.predict(x, graph, edge_weights=edge_weights, lengths=lengths, alert_threshold=threshold,
+                                    alert_epistemic=max_epistemic, alert_frames=num_frames)
+            alerts = early_exit_alerts(scores.numpy(), epistemic.numpy(), threshold, max_epistemic, num_frames, lengths=lengths.numpy())
+            np.testing.assert_array_equal(results['alert'].numpy(), alerts)
+            np.testing.assert_array_equal(results['num_frames'].numpy(), np.where(alerts >= 0, alerts + 1, lengths.numpy()))
+
+
+def make_predictor(rho, seed=0):
+    # rho sets the posterior sigma = log(1 + exp(rho)) of all weights
+    torch.manual_seed(seed)
+    predictor = BayesianPredictor(20, 2).eval()
+    for layer in [predictor.l1, predictor.l2]:
+        layer.weight_rho.data.fill_(rho)
+        layer.bias_rho.data.fill_(rho)
+    return predictor, torch.randn(6, 20)
+
+
+def test_sample_adaptive_stops_on_low_variance():
+    predictor, x = make_predictor(rho=-20)
+    npass = predictor.sample_adaptive(x, tol=1e-3, min_pass=4, max_pass=10)['npass']
+    assert npass.tolist() == [4] * 6
+
+
+def test_sample_adaptive_reaches_max_pass_on_high_variance():
+    predictor, x = make_predictor(rho=-1)
+    npass = predictor.sample_adaptive(x, tol=1e-4, min_pass=4, max_pass=10)['npass']
+    assert npass.tolist() == [10] * 6
+
+
+def test_sample_adaptive_without_stopping_matches_fixed_passes():
+    predictor, x = make_predictor(rho=-1)
+    torch.manual_seed(1)
+    # with tol=0, no sample ever converges
+    output_dict = predictor.sample_adaptive(x, tol=0, min_pass=4, max_pass=10, block=2)
+    assert output_dict['npass'].tolist() == [10] * 6
+    # the same MC samples, drawn by blocks of 2 passes as sample_adaptive() does
+    torch.manual_seed(1)
+    outputs = torch.cat([predictor(x, sample=True, npass=2, calculate_log_probs=False) for _ in range(5)])
+    aleatoric, epistemic = predictor.uncertainties(torch.softmax(outputs, dim=-1))
+    torch.testing.assert_close(output_dict['pred_mean'], outputs.mean(0), rtol=0, atol=1e-6)
+    torch.testing.assert_close(output_dict['aleatoric'], aleatoric, rtol=0, atol=1e-6)
+    torch.testing.assert_close(output_dict['epistemic'], epistemic, rtol=0, atol=1e-6)
+    # and through predict()
+    torch.manual_seed(1)
+    scores = predictor.predict(x, npass=10, mc_tol=0, min_pass=4)['score']
+    torch.testing.assert_close(scores, torch.softmax(outputs.mean(0), dim=-1)[:, 1], rtol=0, atol=1e-6)
+
+
+def count_encoded_frames(model):
+    """ Wrap model._encode() to record the number of frames of each call. """
+    encoded = []
+    encode = model._encode
+
+    def _encode(x, graphs):
+        encoded.append(x.shape[:-2].numel())
+        assert torch.isfinite(x).all()
+        return encode(x, graphs)
+    model._encode = _encode
+    return encoded
+
+
+def test_padded_frames_are_not_encoded():
+    model = make_model()
+    x, graph, edge_weights, _ = make_batch()
+    lengths = torch.tensor([12, 3, 7])
+    for b, length in enumerate(lengths.tolist()):
+        x[b, length:] = float('nan')
+    encoded = count_encoded_frames(model)
+    model.predict(x, graph, edge_weights=edge_weights, lengths=lengths)
+    assert sum(encoded) == int(lengths.sum())
+    del encoded[:]
+    # by chunks of 5 frames, the chunks within the lengths only
+    model.predict(x, graph, edge_weights=edge_weights, lengths=lengths, alert_threshold=2.0, encode_chunk=5)
+    assert sum(encoded) == int(lengths.sum())
+    del encoded[:]
+    y = torch.tensor([[0., 1.]] * 3)
+    toa = torch.tensor([5., 2., 6.])
+    model(x, y, toa, graph, edge_weights=edge_weights, lengths=lengths)
+    assert sum(encoded) == int(lengths.sum())
@@ -0,0 +1,56 @@
+import os
+import sys
+import pickle
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.sample_cache import SampleCache
+from src.quantize import QuantizedArray
+
+
+def make_sample(seed):
+    rng = np.random.RandomState(seed)
+    return rng.randn(10, 20, 64).astype(np.float32), np.array([0., 1.]), rng.rand(10, 171).astype(np.float32)
+
+
+def age(cache, key, seconds):
+    # the LRU order is the modification time of the entries
+    os.utime(cache.entry_file(key), (seconds, seconds))
+
+
+def test_sample_cache_lru_eviction(tmp_path):
+    size = len(pickle.dumps(make_sample(0), protocol=pickle.HIGHEST_PROTOCOL))
+    cache = SampleCache(int(2.5 * size), root=str(tmp_path))
+    assert cache.get('a') is None
+    cache.put('a', make_sample(0))
+    cache.put('b', make_sample(1))
+    age(cache, 'a', 1000)
+    age(cache, 'b', 2000)
+    for loaded, expected in zip(cache.get('a'), make_sample(0)):
+        np.testing.assert_array_equal(loaded, expected)
+    # 'a' was used last, 'b' is evicted
+    cache.put('c', make_sample(2))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats() == {'hits': 3, 'misses': 2, 'evictions': 1, 'bytes': 2 * size, 'hit_rate': 0.6}
+    # samples larger than the budget are not cached
+    cache.put('d', (np.zeros((100, 20, 64), dtype=np.float32),))
+    assert cache.get('d') is None and cache.stats()['bytes'] == 2 * size
+    cache.close()
+    assert not os.path.exists(cache.cache_dir)
+
+
+def test_sample_cache_features(tmp_path):
+    cache = SampleCache(10 * 1024**2, feature_dtype='float16', root=str(tmp_path))
+    features, labels, edge_weights = make_sample(0)
+    cache.put('float', (features, labels, edge_weights))
+    loaded = cache.get('float')
+    assert loaded[0].dtype == np.float16
+    np.testing.assert_array_equal(loaded[0], features.astype(np.float16))
+    np.testing.assert_array_equal(loaded[2], edge_weights)
+    # int8 features are kept as they are
+    quantized = QuantizedArray(np.arange(-100, 100, dtype=np.int8).reshape(10, 20), np.ones(10, dtype=np.float32), np.zeros(10, dtype=np.float32))
+    cache.put('int8', (quantized, labels))
+    loaded = cache.get('int8')[0]
+    np.testing.assert_array_equal(loaded.data, quantized.data)
+    np.testing.assert_array_equal(loaded.dequantize(), quantized.dequantize())
+    cache.close()
@@ -0,0 +1,23 @@
+import io
+import os
+import sys
+import asyncio
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from src.serve import ClipScoringService
+from test_models import make_model
+
+
+def test_corrupt_clips_are_bad_requests():
+    rng = np.random.RandomState(0)
+    buf = io.BytesIO()
+    np.savez_compressed(buf, data=rng.randn(5, 20, 64).astype(np.float32), det=rng.rand(5, 19, 6).astype(np.float32))
+    content = buf.getvalue()
+    corrupt = bytearray(content)
+    corrupt[300:310] = b'x' * 10
+    service = ClipScoringService(make_model())
+    # truncated, corrupt, and not a feature file at all
+    for body in [content[:len(content) // 2], bytes(corrupt), b'garbage']:
+        status, result = asyncio.run(service.route('POST', '/score', body))
+        assert status == 400 and result['error'].startswith('Invalid clip')
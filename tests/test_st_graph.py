@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.DataLoader import build_st_graph, generate_st_graph
+
+# on float32 detections, the scalar '**2' of generate_st_graph() may differ from the array square of build_st_graph()
+# in the last ulp of the squared distance, which is below 2e-9 on the normalized weights
+ATOL = 1e-8
+
+
+def test_build_st_graph_matches_reference():
+    for seed in range(20):
+        rng = np.random.RandomState(seed)
+        detections = (rng.rand(30, 19, 6) * 3).astype(np.float32)
+        ref_edges, ref_weights = generate_st_graph(detections)
+        graph_edges, edge_weights = build_st_graph(detections)
+        for edges in ref_edges:
+            np.testing.assert_array_equal(edges, graph_edges)
+        assert edge_weights.dtype == ref_weights.dtype
+        np.testing.assert_allclose(edge_weights, ref_weights, rtol=0, atol=ATOL)
+        # exact on float64 detections
+        _, ref_weights = generate_st_graph(detections.astype(np.float64))
+        _, edge_weights = build_st_graph(detections.astype(np.float64))
+        np.testing.assert_array_equal(edge_weights, ref_weights)
+
+
+def test_build_st_graph_without_positive_weights():
+    # boxes far apart from each other, all weights underflow and each frame falls back to all-ones
+    detections = np.zeros((5, 19, 4), dtype=np.float32)
+    detections[:, :, [0, 2]] = np.arange(19)[None, :, None] * 100
+    _, ref_weights = generate_st_graph(detections)
+    _, edge_weights = build_st_graph(detections)
+    np.testing.assert_array_equal(edge_weights, ref_weights)
+    np.testing.assert_array_equal(edge_weights, np.ones_like(edge_weights))
@@ -0,0 +1,79 @@
+import os
+import sys
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.stream_dataset import StreamDataset, write_shards
+from src.quantize import QuantizedArray, quantize_features
+
+
+class ToyDataset(object):
+    """ The samples of a map-style dataset, the toa of each sample is its index. """
+    n_frames, n_obj, fps, dim_feature = 10, 19, 20.0, 64
+
+    def __init__(self, num_samples, quantized=False, vis=False):
+        self.num_samples = num_samples
+        self.quantized = quantized
+        self.vis = vis
+
+    def __len__(self):
+        return self.num_samples
+
+    def load_sample(self, index):
+        rng = np.random.RandomState(index)
+        features = rng.randn(10, 20, 64).astype(np.float32)
+        if self.quantized:
+            arrays = quantize_features(features, 'int8')
+            features = QuantizedArray(arrays['data'], arrays['data_scale'], arrays['data_offset'])
+        sample = (features, np.array([0., 1.]), np.tile(np.arange(171), (2, 1)), rng.rand(10, 171).astype(np.float32),
+                  [float(index)], rng.rand(10, 19) > 0.5)
+        if self.vis:
+            sample += (rng.rand(10, 19, 6).astype(np.float32), 'video_%03d' % (index))
+        return sample
+
+
+def assert_samples_equal(loaded, sample):
+    assert len(loaded) == len(sample)
+    for a, b in zip(loaded, sample):
+        if isinstance(b, QuantizedArray):
+            for name in ['data', 'scale', 'offset']:
+                np.testing.assert_array_equal(getattr(a, name), getattr(b, name))
+        elif isinstance(b, str):
+            assert a == b
+        else:
+            np.testing.assert_array_equal(a, np.asarray(b, dtype=np.float32) if isinstance(b, list) else b)
+            assert np.asarray(a).dtype == (np.float32 if isinstance(b, list) else b.dtype)
+
+
+def test_write_shards_round_trip(tmp_path):
+    for quantized in [False, True]:
+        for vis in [False, True]:
+            dataset = ToyDataset(10, quantized=quantized, vis=vis)
+            shard_path = str(tmp_path / ('shards_%d_%d' % (quantized, vis)))
+            assert write_shards(dataset, shard_path, samples_per_shard=4) == 10
+            stream = StreamDataset(shard_path, shuffle=False, rank=0, world_size=1)
+            assert len(stream.shard_files) == 3 and len(stream) == 10 and stream.vis == vis
+            loaded = list(stream)
+            assert len(loaded) == 10
+            for index, sample in enumerate(loaded):
+                assert_samples_equal(sample, dataset.load_sample(index))
+            # shuffled, every sample once
+            stream = StreamDataset(shard_path, shuffle=True, shuffle_buffer=3, rank=0, world_size=1)
+            assert sorted(int(sample[4][0]) for sample in stream) == list(range(10))
+
+
+def test_ranks_read_the_same_number_of_samples(tmp_path):
+    shard_path = str(tmp_path / 'shards')
+    # shards of 4, 4 and 2 samples
+    write_shards(ToyDataset(10), shard_path, samples_per_shard=4)
+    for world_size in [2, 3, 4]:
+        for epoch in range(3):
+            counts = []
+            for rank in range(world_size):
+                stream = StreamDataset(shard_path, shuffle=True, shuffle_buffer=3, rank=rank, world_size=world_size)
+                stream.set_epoch(epoch)
+                counts.append(len(list(stream)))
+                # also split over the worker processes
+                loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=2, collate_fn=lambda sample: sample)
+                assert len(list(loader)) == len(stream)
+            assert counts == [10 // world_size] * world_size
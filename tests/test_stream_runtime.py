@@ -0,0 +1,41 @@
+import os
+import sys
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from src.stream_runtime import StreamRuntime
+from test_models import make_model, make_batch
+
+
+def test_runtime_matches_predict():
+    model = make_model()
+    # the mean weights only, so that the scores do not depend on the batches of the ticks
+    for layer in [model.predictor.l1, model.predictor.l2]:
+        layer.weight_rho.data.fill_(-100)
+        layer.bias_rho.data.fill_(-100)
+    x, graph, edge_weights, detections = make_batch()
+    lengths = [12, 5, 8]
+    refs = [model.predict(x[b:b + 1, :length], graph[b:b + 1], edge_weights=edge_weights[b:b + 1, :length])['score'][0]
+            for b, length in enumerate(lengths)]
+    # two slots: the stream 2 joins once the stream 1 has left, with frames pushed ahead of the ticks
+    runtime = StreamRuntime(model, capacity=2)
+    scores = {0: [], 1: [], 2: []}
+    runtime.join(0)
+    runtime.join(1)
+    for t in range(lengths[0]):
+        runtime.push(0, x[0, t], detections[0, t])
+        if t < lengths[1]:
+            runtime.push(1, x[1, t], detections[1, t])
+        if t == lengths[1]:
+            runtime.leave(1)
+            runtime.join(2)
+            for s in range(lengths[2]):
+                runtime.push(2, x[2, s], detections[2, s])
+        for stream_id, output in runtime.tick().items():
+            assert output['frame'] == len(scores[stream_id])
+            scores[stream_id].append(output['score'])
+    assert runtime.stats()['streams'][2]['pending'] == lengths[2] - (lengths[0] - lengths[1])
+    while len(scores[2]) < lengths[2]:
+        scores[2].append(runtime.tick()[2]['score'])
+    for stream_id, ref in enumerate(refs):
+        torch.testing.assert_close(torch.tensor(scores[stream_id]), ref, rtol=0, atol=1e-5)
@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.DataLoader import DADDataset
+from src.verify import verify_dataset, manifest_file, load_manifest
+
+
+def write_dad_sample(filename, num_frames=3, seed=0):
+    rng = np.random.RandomState(seed)
+    np.savez_compressed(filename, data=rng.randn(num_frames, 20, 2048).astype(np.float32), det=rng.rand(num_frames, 19, 6).astype(np.float32),
+                        labels=np.array([0., 1.]), ID=np.array('b001_%06d_x' % (seed)))
+
+
+def test_verify_drops_corrupt_samples(tmp_path):
+    data_path = str(tmp_path / 'dad')
+    phase_dir = os.path.join(data_path, 'res101_features', 'training')
+    os.makedirs(phase_dir)
+    for i in range(4):
+        write_dad_sample(os.path.join(phase_dir, '%06d.npz' % (i)), seed=i)
+    # a truncated file, non-finite features, and detections of the wrong shape
+    with open(os.path.join(phase_dir, '000001.npz'), 'rb') as f:
+        content = f.read()
+    with open(os.path.join(phase_dir, '000001.npz'), 'wb') as f:
+        f.write(content[:len(content) // 2])
+    data = dict(np.load(os.path.join(phase_dir, '000002.npz')))
+    data['data'][1, 3, 5] = np.nan
+    np.savez(os.path.join(phase_dir, '000002.npz'), **data)
+    data = dict(np.load(os.path.join(phase_dir, '000003.npz')))
+    data['det'] = data['det'][:, :, :4]
+    np.savez(os.path.join(phase_dir, '000003.npz'), **data)
+    write_dad_sample(os.path.join(phase_dir, '000004.npz'), num_frames=5, seed=4)
+
+    dataset = DADDataset(data_path, 'res101', 'training', vis=True, device=torch.device('cpu'))
+    manifest_dir = str(tmp_path / 'manifest')
+    errors = verify_dataset(dataset, manifest_file(manifest_dir, 'dad', 'res101', 'training'), num_workers=2)
+    assert sorted(errors) == ['000001.npz', '000002.npz', '000003.npz']
+    manifest = load_manifest(manifest_file(manifest_dir, 'dad', 'res101', 'training'))
+    assert manifest['samples'] == {'000000.npz': {'num_frames': 3}, '000004.npz': {'num_frames': 5}}
+    assert sorted(manifest['mtimes']) == [os.path.join(phase_dir, '000000.npz'), os.path.join(phase_dir, '000004.npz')]
+
+    # the datasets only use the verified samples
+    dataset = DADDataset(data_path, 'res101', 'training', device=torch.device('cpu'), manifest=manifest_dir, graph_cache=str(tmp_path / 'cache'))
+    assert dataset.files_list == ['000000.npz', '000004.npz']
+    assert dataset.graph_cache.mtimes == manifest['mtimes']
+    assert dataset.get_num_frames(1) == 5
+    assert dataset.load_sample(1)[0].shape == (5, 20, 2048)